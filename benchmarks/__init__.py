@@ -0,0 +1,2 @@
+from .catalog import Catalog
+from .mock_tmdb import MockTMDB
\ No newline at end of file
@@ -0,0 +1,41 @@
+import concurrent.futures
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+import movies
+from benchmarks.mock_tmdb import MockTMDB
+
+
+def fetch_year(catalog, year: int, threads: int) -> list:
+    """
+    Fetch every page of a year the way run_main does, pages spread over a thread pool
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        pages = executor.map(lambda page: movies.get_data('US', year, page, False), range(1, catalog.pages + 1))
+        return [page for page in pages if page[2] != None]
+
+
+def test_get_data_page(benchmark, catalog):
+    # One page of 20 movies, requests sent one after another with 5ms of server latency each
+    with MockTMDB(catalog, latency=0.005) as server, server.patch_tmdb(movies.adapter):
+        result = benchmark(movies.get_data, 'US', 1999, 1, False)
+    assert result[2] == None and len(result[3]) == 20
+
+
+@pytest.mark.parametrize('threads', [1, 8, 20])
+def test_get_data_year(benchmark, catalog, threads):
+    # A year of 200 movies over a pool of threads sharing the TMDB client
+    movies.configure_client(threads)
+    with MockTMDB(catalog, latency=0.005) as server, server.patch_tmdb(movies.adapter):
+        failed = benchmark.pedantic(fetch_year, args=(catalog, 1999, threads), rounds=3)
+    assert failed == []
+
+
+def test_get_data_unreliable(benchmark, catalog):
+    # 2% server errors and 2% throttling, retried by with_retries() and throttled by the AIMD limiter
+    movies.configure_client(8)
+    with MockTMDB(catalog, latency=0.005, error_rate=0.02, throttle_rate=0.02, retry_after=0.05) as server, \
+         server.patch_tmdb(movies.adapter):
+        benchmark.pedantic(fetch_year, args=(catalog, 1999, 8), rounds=3)
+    benchmark.extra_info.update(server.counts)
@@ -0,0 +1,127 @@
+import json
+import pymysql
+import pytest
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+pytest.importorskip('pytest_benchmark')
+
+import movies
+import sinks
+import storage
+
+
+class CountingCursor:
+    """
+    Cursor that only counts what would be sent to MySQL, isolating the client side cost of to_mysql().
+    A latency stands in for the server round trip every statement takes
+    """
+    def __init__(self, latency: float=0):
+        self.rows = 0
+        self.latency = latency
+
+    def execute(self, sql, args=None):
+        self.rows += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def executemany(self, sql, args):
+        self.rows += len(args)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def merged(catalog):
+    """
+    Merged dataframe and normalized tables of the catalog's first year
+    """
+    year = catalog.years[0]
+    batch = movies.MovieBatch()
+    for page in range(1, catalog.pages + 1):
+        for movie_id in catalog.discover[(year, page)]:
+            movie = SimpleNamespace(**json.loads(json.dumps(catalog.movies[movie_id])))
+            batch.add(movies.extract_movie(movie_id, movie, catalog.credits[movie_id]))
+    df = movies.sort_by_revenue(batch.to_frame())
+    return year, df, movies.normalize(df)
+
+
+@pytest.fixture
+def mysql():
+    """
+    Connection to the MySQL database of config.json, the benchmark is skipped when it isn't reachable
+    """
+    try:
+        conn = storage.settings.connect(connect_timeout=2)
+    except pymysql.Error as e:
+        pytest.skip(f"MySQL is not reachable: {e}")
+    conn.close()
+
+
+@pytest.mark.parametrize('batch, chunk_size', [(False, None), (True, 1), (True, 100), (True, 1000)],
+                         ids=['per-row', 'chunk-1', 'chunk-100', 'chunk-1000'])
+def test_to_mysql_client(benchmark, merged, batch, chunk_size):
+    # Row collection, entity dedup and statement batching without a server round trip.
+    # per-row is the old path of one execute() per row and table, the baseline for the batched ones
+    year, df, tables = merged
+
+    def load():
+        storage.settings.entity_cache.clear()
+        with patch('storage.pymysql.connect') as mock_connect:
+            mock_connect.return_value.cursor.return_value = CountingCursor()
+            if batch:
+                storage.to_mysql(df=df, year=year, chunk_size=chunk_size, tables=tables)
+            else:
+                storage.to_mysql(df=df, year=year, batch=False)
+
+    benchmark(load)
+
+
+@pytest.mark.parametrize('batch, chunk_size', [(False, None), (True, 1), (True, 1000)],
+                         ids=['per-row', 'chunk-1', 'chunk-1000'])
+def test_to_mysql_round_trips(benchmark, merged, batch, chunk_size):
+    # Same loads with a 0.2 ms round trip per statement, where batching pays off without a MySQL server
+    year, df, tables = merged
+
+    def load():
+        storage.settings.entity_cache.clear()
+        with patch('storage.pymysql.connect') as mock_connect:
+            mock_connect.return_value.cursor.return_value = CountingCursor(latency=0.0002)
+            if batch:
+                storage.to_mysql(df=df, year=year, chunk_size=chunk_size, tables=tables)
+            else:
+                storage.to_mysql(df=df, year=year, batch=False)
+
+    benchmark.pedantic(load, rounds=3)
+
+
+@pytest.mark.parametrize('loader', ['per-row', 'batched', 'infile'])
+def test_to_mysql(benchmark, mysql, merged, loader):
+    # per-row sends one execute() per row and table, a round trip each, the baseline for the other two
+    year, df, tables = merged
+
+    def load():
+        storage.settings.entity_cache.clear()
+        if loader == 'infile':
+            storage.to_mysql_infile(df=df, year=year, tables=tables)
+        elif loader == 'batched':
+            storage.to_mysql(df=df, year=year, tables=tables)
+        else:
+            storage.to_mysql(df=df, year=year, batch=False)
+
+    benchmark.pedantic(load, rounds=3)
+
+
+def test_sqlite_sink(benchmark, workdir, merged):
+    # SQLiteSink.write of the same normalized tables, upserted in one transaction. It does not measure to_mysql
+    year, df, tables = merged
+    sink = sinks.SQLiteSink(path=str(workdir / 'movies.sqlite'))
+    benchmark(sink.write, 'US', year, df, tables)
+    sink.close()
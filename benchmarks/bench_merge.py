@@ -0,0 +1,40 @@
+import json
+import pytest
+from types import SimpleNamespace
+
+pytest.importorskip('pytest_benchmark')
+
+import movies
+
+
+@pytest.fixture
+def saved_pages(workdir, catalog):
+    """
+    Save every page of the catalog's first year the way get_data does
+    """
+    year = catalog.years[0]
+    for page in range(1, catalog.pages + 1):
+        ids = catalog.discover[(year, page)]
+        batch = movies.MovieBatch(len(ids))
+        for movie_id in ids:
+            # round trip through json so extraction can't modify the catalog
+            movie = SimpleNamespace(**json.loads(json.dumps(catalog.movies[movie_id])))
+            batch.add(movies.extract_movie(movie_id, movie, catalog.credits[movie_id]))
+        movies.save_output('US', year, movies.sort_by_revenue(batch.to_frame()), f"US_movie_data_{year}-{page}")
+    return year
+
+
+def test_merge_dfs(benchmark, saved_pages):
+    df = benchmark(movies.merge_dfs, 'US', saved_pages)
+    assert len(df) == 200
+
+
+def test_merge_stream(benchmark, saved_pages):
+    stats = benchmark(movies.merge_stream, 'US', saved_pages, spill_rows=50)
+    assert stats != None
+
+
+def test_normalize(benchmark, saved_pages):
+    df = movies.merge_dfs('US', saved_pages)
+    tables = benchmark(movies.normalize, df)
+    assert len(tables['movies']) == 200
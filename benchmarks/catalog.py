@@ -0,0 +1,107 @@
+import math
+import random
+
+# Discover results per page, as returned by TMDB
+PER_PAGE = 20
+GENRES = [(28, 'Action'), (12, 'Adventure'), (16, 'Animation'), (35, 'Comedy'), (80, 'Crime'), (99, 'Documentary'),
+          (18, 'Drama'), (14, 'Fantasy'), (27, 'Horror'), (9648, 'Mystery'), (10749, 'Romance'), (878, 'Science Fiction'),
+          (53, 'Thriller')]
+COUNTRIES = [('US', 'United States of America'), ('GB', 'United Kingdom'), ('FR', 'France'), ('DE', 'Germany'),
+             ('JP', 'Japan'), ('IN', 'India'), ('CA', 'Canada')]
+CREW_JOBS = [('Director', 'Directing'), ('Screenplay', 'Writing'), ('Writer', 'Writing'), ('Producer', 'Production'),
+             ('Executive Producer', 'Production'), ('Director of Photography', 'Camera'), ('Editor', 'Editing'),
+             ('Original Music Composer', 'Sound'), ('Casting', 'Production'), ('Art Direction', 'Art')]
+
+
+class Catalog:
+    """
+    Synthetic TMDB catalog of years x pages of movies, every movie with its details and credits.
+    Cast and crew sizes are log-normal like TMDB's: most movies credit a few dozen people, blockbusters hundreds.
+    People and companies are drawn from shared pools so they repeat across movies, as real actors do
+
+    Args:
+        years: list[int]
+            Years of the catalog
+        pages: int
+            Discover pages per year
+        per_page: int
+            Movies per discover page
+        cast_mean: int
+            Median cast size
+        crew_mean: int
+            Median crew size
+        cast_max: int
+            Largest cast of any movie
+        seed: int
+            Same seed, same catalog
+    """
+    def __init__(self, years: list, pages: int, per_page: int=PER_PAGE, cast_mean: int=30, crew_mean: int=40,
+                 cast_max: int=400, seed: int=0) -> None:
+        rng = random.Random(seed)
+        self.years = list(years)
+        self.pages = pages
+        self.discover = {}
+        self.movies = {}
+        self.credits = {}
+        people = max(1000, len(self.years) * pages * per_page * 5)
+        movie_id = 1
+        for year in self.years:
+            for page in range(1, pages + 1):
+                ids = []
+                for _ in range(per_page):
+                    self.movies[movie_id] = self.movie(rng, movie_id, year)
+                    self.credits[movie_id] = {
+                        'id': movie_id,
+                        'cast': [self.person(rng, people, order=order)
+                                 for order in range(self.size(rng, cast_mean, cast_max))],
+                        'crew': [self.person(rng, people, job=rng.choice(CREW_JOBS))
+                                 for _ in range(self.size(rng, crew_mean, cast_max))],
+                    }
+                    ids.append(movie_id)
+                    movie_id += 1
+                self.discover[(year, page)] = ids
+
+    @staticmethod
+    def size(rng: random.Random, mean: int, cap: int) -> int:
+        return max(1, min(cap, int(rng.lognormvariate(math.log(mean), 0.8))))
+
+    @staticmethod
+    def movie(rng: random.Random, movie_id: int, year: int) -> dict:
+        budget = rng.choice([0, 0, rng.randrange(100000, 300000000)])
+        return {
+            'id': movie_id,
+            'title': f"Movie {movie_id}",
+            'original_title': f"Movie {movie_id}",
+            'release_date': f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            'original_language': rng.choice(['en', 'en', 'en', 'fr', 'ja', 'hi']),
+            'overview': ' '.join(rng.choice(['a', 'hacker', 'joins', 'the', 'fight', 'against', 'machines']) for _ in range(60)),
+            'runtime': rng.randint(40, 200),
+            'genres': [{'id': genre_id, 'name': name} for genre_id, name in rng.sample(GENRES, rng.randint(1, 3))],
+            'production_countries': [{'iso_3166_1': iso, 'name': name} for iso, name in rng.sample(COUNTRIES, rng.randint(1, 2))],
+            'production_companies': [{'id': company, 'logo_path': None, 'name': f"Company {company}",
+                                      'origin_country': rng.choice(['US', 'GB', ''])}
+                                     for company in rng.sample(range(1, 2000), rng.randint(1, 4))],
+            'budget': budget,
+            'revenue': budget * rng.randint(0, 5),
+        }
+
+    @staticmethod
+    def person(rng: random.Random, people: int, order: int=None, job: tuple=None) -> dict:
+        person_id = rng.randrange(1, people)
+        member = {'adult': False, 'gender': rng.randint(0, 2), 'id': person_id, 'known_for_department': 'Acting',
+                  'name': f"Person {person_id}", 'original_name': f"Person {person_id}", 'popularity': rng.random() * 50,
+                  'profile_path': None, 'credit_id': f"{person_id:024x}"}
+        if job != None:
+            member.update({'job': job[0], 'department': job[1]})
+        else:
+            member.update({'cast_id': order, 'character': f"Character {order}", 'order': order})
+        return member
+
+    def discover_response(self, year: int, page: int) -> dict:
+        """
+        Body of a discover.movie() response, an empty page past the last one
+        """
+        ids = self.discover.get((year, page), [])
+        return {'page': page, 'results': [{'id': movie_id, 'title': self.movies[movie_id]['title']} for movie_id in ids],
+                'total_pages': self.pages if year in self.years else 0,
+                'total_results': self.pages * len(ids) if year in self.years else 0}
@@ -0,0 +1,43 @@
+import os
+from pathlib import Path
+import pytest
+import sys
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.append(str(BENCH_DIR.parent))
+
+import movies
+from benchmarks.catalog import Catalog
+
+
+def pytest_collect_file(file_path, parent):
+    # bench_*.py files are only collected when the benchmarks are asked for, e.g. 'python -m pytest benchmarks',
+    # so the regular test run stays fast. Files named on the command line are collected by pytest itself
+    if file_path.suffix != '.py' or not file_path.name.startswith('bench_') or parent.session.isinitpath(file_path):
+        return None
+    args = [Path(arg.split('::')[0]).resolve() for arg in parent.config.args]
+    if any(arg == BENCH_DIR or BENCH_DIR in arg.parents for arg in args):
+        return pytest.Module.from_parent(parent, path=file_path)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Run the benchmark in an empty directory, page and merged outputs are written under its ./data
+    """
+    # data_dir() resolves against the directory the program started in, not the working directory.
+    # config.json is read from the real one first
+    movies.get_config()
+    monkeypatch.setattr('movies.config.START_DIR', str(tmp_path))
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    yield tmp_path
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def catalog():
+    """
+    Two years of 10 pages, 400 movies
+    """
+    return Catalog(years=[1999, 2000], pages=10)
@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import requests
+import threading
+import time
+import tmdbsimple as tmdb
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+from .catalog import Catalog
+
+MOVIE_PATH = re.compile(r"/3/movie/(\d+)(/credits)?")
+
+
+class MockTMDB:
+    """
+    Local HTTP stand-in for the TMDB discover, movie and credits endpoints serving a Catalog.
+    Every response can be delayed, fail with a 503 or be throttled with a 429 and Retry-After, at random
+    but reproducibly for a given seed
+
+    Args:
+        catalog: Catalog
+            Movies served
+        latency: float
+            Seconds every response is delayed by
+        error_rate: float
+            Share of requests answered with a 503
+        throttle_rate: float
+            Share of requests answered with a 429
+        retry_after: float
+            Retry-After of the 429s, in seconds
+        seed: int
+            Seed of the error and throttle draws
+    """
+    def __init__(self, catalog: Catalog, latency: float=0.0, error_rate: float=0.0, throttle_rate: float=0.0,
+                 retry_after: float=1, seed: int=0) -> None:
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.counts = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> 'MockTMDB':
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, status: int) -> None:
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def draw(self) -> int:
+        """
+        Status of the next response: 200, or a 503 or 429 at the configured rates
+        """
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return 503
+        if roll < self.error_rate + self.throttle_rate:
+            return 429
+        return 200
+
+    def respond(self, path: str, query: dict) -> tuple:
+        """
+        Status and body of a request
+        """
+        if path == '/3/discover/movie':
+            return 200, self.catalog.discover_response(int(query['primary_release_year'][0]), int(query.get('page', ['1'])[0]))
+        match = MOVIE_PATH.fullmatch(path)
+        if match == None or int(match.group(1)) not in self.catalog.movies:
+            return 404, {'status_code': 34, 'status_message': 'The resource you requested could not be found.'}
+        movie_id = int(match.group(1))
+        if match.group(2) != None:
+            return 200, self.catalog.credits[movie_id]
+        body = dict(self.catalog.movies[movie_id])
+        if 'credits' in query.get('append_to_response', [''])[0].split(','):
+            body['credits'] = self.catalog.credits[movie_id]
+        return 200, body
+
+    def handler(self) -> type:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, Nagle's algorithm would hold the body back for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                if mock.latency > 0:
+                    time.sleep(mock.latency)
+                url = urlparse(self.path)
+                status = mock.draw()
+                headers = {}
+                if status == 503:
+                    body = {'status_code': 11, 'status_message': 'Internal error'}
+                elif status == 429:
+                    body = {'status_code': 25, 'status_message': 'Your request count is over the allowed limit'}
+                    headers['Retry-After'] = str(mock.retry_after)
+                else:
+                    status, body = mock.respond(url.path, parse_qs(url.query))
+                mock.count(status)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json;charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return Handler
+
+    @contextmanager
+    def patch_tmdb(self, adapter: requests.adapters.HTTPAdapter=None):
+        """
+        Point tmdbsimple at the server for the duration of the block, through a session without the response cache
+
+        Args:
+            adapter: HTTPAdapter, default None
+                (Optional) Adapter of the session, e.g. movies.adapter to measure the real client
+        """
+        session = requests.Session()
+        if adapter != None:
+            session.mount(self.url, adapter)
+        with patch.object(tmdb.base.TMDB, '_get_complete_url', lambda obj, path: f"{self.url}/3/{path}"), \
+             patch.object(tmdb, 'REQUESTS_SESSION', session):
+            yield session
+        session.close()
@@ -1,8 +1,16 @@
+import asyncio
 import concurrent.futures
+from datetime import date, timedelta
+from functools import partial
+import heapq
 import logging
 from logging import INFO
 import movies
-from storage import blob_upload, to_mysql
+import multiprocessing
+from pathlib import Path
+import requests
+from sinks import SinkError, make_sinks, write_all
+from storage import blob_upload, to_mysql, to_mysql_infile
 import sys
 import time
 import typer
@@ -14,7 +22,11 @@ logger: logging.Logger = logging
 
 
 @app.command("run_main")
-def main(region: str, year_start: int, year_end: int, blob: bool=True, sql: bool=True) -> any:
+def main(region: str, year_start: int, year_end: int, blob: bool=True, sql: bool=True, append: str='credits',
+         engine: str='threads', max_in_flight: int=20, rate: float=movies.TMDB_RATE, chunk_size: int=1000,
+         infile: bool=False, top_n: int=None, stream_merge: bool=False, spill_rows: int=50000, resume: bool=False,
+         merge_workers: int=1, load_workers: int=1, stage_queue: int=2, sinks: str=None, report: str=None,
+         metrics_port: int=None) -> any:
     """
     Pipeline orchestration to get all data for every page in a specified range of years
 
@@ -29,34 +41,378 @@ def main(region: str, year_start: int, year_end: int, blob: bool=True, sql: bool
             (Optional) Upload data to Azure storage blob container
         sql: bool, default True
             (Optional) Upload data to MySQL database
+        append: str, default 'credits'
+            (Optional) Sub-resources fetched in the same request as each movie's details
+        engine: str, default 'threads'
+            (Optional) Fetch engine to use, 'threads' or 'async'
+        max_in_flight: int, default 20
+            (Optional) Worker threads, connection pool size and cap on concurrent requests, lowered while TMDB answers 429
+        rate: float, default movies.TMDB_RATE
+            (Optional) Requests per second allowed by the async engine's token bucket
+        chunk_size: int, default 1000
+            (Optional) Rows sent per multi-row INSERT when loading into MySQL
+        infile: bool, default False
+            (Optional) Load MySQL through staged LOAD DATA LOCAL INFILE files, for large backfills
+        top_n: int, default None
+            (Optional) Only keep each year's top_n highest earning movies
+        stream_merge: bool, default False
+            (Optional) Merge pages in chunks with a bounded memory footprint instead of all at once.
+            Only the merge is bounded, the merged year is still read back whole to normalize and load it
+        spill_rows: int, default 50000
+            (Optional) Rows the streaming merge holds in memory before spilling a sorted run to disk
+        resume: bool, default False
+            (Optional) Pick up an interrupted run from its manifest, skipping pages and stages already completed.
+            Only the threads engine records pages in the manifest, so it can't be combined with --engine async
+        merge_workers: int, default 1
+            (Optional) Years merged at once while later years are still being fetched
+        load_workers: int, default 1
+            (Optional) Years uploaded and loaded into MySQL at once
+        stage_queue: int, default 2
+            (Optional) Years allowed to wait for the merge and load stages before fetching waits for them
+        sinks: str, default None
+            (Optional) Comma separated sinks to write merged years to instead of --blob/--sql, e.g. local,sqlite.
+            See sinks.SINKS for the backends, configured by the "sinks" section of config.json
+        report: str, default None
+            (Optional) Where to save the json run report of stage timings, request, retry, byte and row counts,
+            movies.REPORT_FILE under the data_dir by default
+        metrics_port: int, default None
+            (Optional) Serve the same metrics in the Prometheus text format on http://0.0.0.0:<port>/metrics during the run
     Returns: None
     """
+    if resume and engine == 'async':
+        raise typer.BadParameter("--resume needs the threads engine, the async engine doesn't record pages in the manifest")
     tm1 = time.perf_counter()
     year_range = range(year_start, year_end + 1)
-    futures = []
+    discovering = {}
+    fetching = {}
+    retrying = []
+    attempts = {}
     mssng_pages = {}
-    
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for year in year_range:
-            pages = movies.list_pages(region, year)
-            mssng_pages[year] = []
-            for page in pages:
-                futures.append(executor.submit(movies.get_data, region, year, page))
-
-        for future in concurrent.futures.as_completed(futures):
-            f_year = future.result()[1]
-            f_page = future.result()[2]
-            mssng_pages[f_year].append(f_page) if f_page != None else None
-            
+    movies.configure_client(max_in_flight)
+    movies.METRICS.reset()
+    server = movies.METRICS.serve(metrics_port) if metrics_port != None else None
+    manifest = movies.RunManifest()
+    if not resume:
+        manifest.reset(region, year_start, year_end)
+
+    # A year is merged as soon as its last page is fetched and loaded while later years are still being fetched
+    sink_list = make_sinks(sinks) if sinks != None else None
+    loading = movies.Stage('load', partial(load_year, region, manifest=manifest, blob=blob, sql=sql, chunk_size=chunk_size,
+                                           infile=infile, sinks=sink_list), workers=load_workers, maxsize=stage_queue)
+    merging = movies.Stage('merge', partial(merge_year, region, mssng_pages=mssng_pages, manifest=manifest, csv=blob,
+                                            top_n=top_n, stream_merge=stream_merge, spill_rows=spill_rows),
+                           workers=merge_workers, maxsize=stage_queue, downstream=loading)
+    # Pages of each year still being fetched, a year is handed to the merge stage once it reaches 0
+    unfinished = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        if engine == 'async':
+            def year_done(year, missing, failed_ids, df):
+                # Pages with movies still failing after the final retries are missing as well
+                mssng_pages[year] = missing + [page for page in failed_ids if page not in missing]
+                merging.put(year)
+            # Each year is merged as soon as its final retries are done, while later years are still being fetched
+            movies.run_async(region, year_start, year_end, append=append, max_in_flight=max_in_flight, rate=rate,
+                             on_year=year_done)
+        else:
+            # Discover every year at once, page 1's response is reused and the rest of a year's pages
+            # are scheduled as soon as its total is known. Discovering a year is recorded as its page 0
+            for year in year_range:
+                mssng_pages[year] = []
+                if manifest.pages(region, year) not in ([], [0]):
+                    # Year was discovered by an earlier run, only its unfinished pages are fetched again
+                    unfinished[year] = 0
+                    for page in manifest.pages(region, year, states=['pending', 'failed']):
+                        fetching[executor.submit(movies.get_data, region, year, page, True, append)] = (year, page)
+                        unfinished[year] += 1
+                    if unfinished[year] == 0:
+                        merging.put(year)
+                else:
+                    discovering[executor.submit(movies.discover_year, region, year)] = year
+            futures = set(discovering) | set(fetching)
+
+            # Failed pages go back into the pool after a jittered backoff instead of waiting for a serial retry pass
+            while futures or retrying:
+                timeout = max(0, retrying[0][0] - time.monotonic()) if retrying else None
+                done, futures = concurrent.futures.wait(futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                while retrying and retrying[0][0] <= time.monotonic():
+                    _, r_year, r_page, r_ids = heapq.heappop(retrying)
+                    if r_ids == ():
+                        page_future = executor.submit(movies.get_data, region, r_year, r_page, True, append)
+                    else:
+                        # Only the movies that failed are fetched again, the rest of the page is already saved
+                        page_future = executor.submit(movies.fetch_page_movies, region, r_year, r_page, list(r_ids), True,
+                                                      append, keep_saved=True)
+                    fetching[page_future] = (r_year, r_page)
+                    futures.add(page_future)
+                for future in done:
+                    if future in discovering:
+                        d_year = discovering.pop(future)
+                        try:
+                            _, pages, response = future.result()
+                        except requests.exceptions.RequestException as e:
+                            # Only this year is given up on, --resume discovers it again
+                            logger.info(f"Failed to discover YEAR: {d_year}, {e}")
+                            manifest.mark(region, d_year, 0, 'failed')
+                            mssng_pages[d_year].append(0)
+                            merging.put(d_year)
+                            continue
+                        manifest.mark(region, d_year, 0, 'fetched')
+                        manifest.add_pages(region, d_year, pages)
+                        unfinished[d_year] = max(len(pages), 1)
+                        page_1 = executor.submit(movies.get_page_data, region, d_year, 1, response, True, append)
+                        fetching[page_1] = (d_year, 1)
+                        futures.add(page_1)
+                        for page in pages[1:]:
+                            page_future = executor.submit(movies.get_data, region, d_year, page, True, append)
+                            fetching[page_future] = (d_year, page)
+                            futures.add(page_future)
+                    else:
+                        f_year, f_page = fetching.pop(future)
+                        _, _, failed_page, page_df, failed_ids = future.result()
+                        if failed_page != None:
+                            manifest.mark(region, f_year, f_page, 'failed')
+                            attempts[(f_year, f_page)] = attempts.get((f_year, f_page), 0) + 1
+                            if attempts[(f_year, f_page)] < movies.MAX_ATTEMPTS:
+                                # a page whose discover request failed is fetched again in full
+                                r_ids = () if page_df is None else tuple(failed_ids)
+                                heapq.heappush(retrying, (time.monotonic() + movies.backoff(attempts[(f_year, f_page)]),
+                                                          f_year, f_page, r_ids))
+                                continue
+                            mssng_pages[f_year].append(f_page)
+                        else:
+                            manifest.mark(region, f_year, f_page, 'fetched')
+                        unfinished[f_year] -= 1
+                        if unfinished[f_year] == 0:
+                            merging.put(f_year)
+
         logger.info(f"Missing: {mssng_pages}")
+    merging.close()
+    for sink in sink_list or []:
+        sink.close()
+    logger.info(f"Stages: merge {merging.stats()}, load {loading.stats()}")
+
+    extra = {'pipeline': {'merge': merging.stats(), 'load': loading.stats()}, 'client': movies.client_stats()}
+    logger.info(f"TMDB client: {extra['client']}")
+    if isinstance(movies.sess, movies.CachedSession):
+        extra['cache'] = movies.sess.stats()
+        logger.info(f"TMDB cache: {extra['cache']}")
+    report = report if report != None else str(movies.data_dir() / movies.REPORT_FILE)
+    run_report = movies.METRICS.write_report(report, extra)
+    for stage in run_report['stages']:
+        logger.info(f"Stage {stage}")
+    logger.info(f"Run report saved to {report}")
+    if server != None:
+        server.shutdown()
+    tm2 = time.perf_counter()
+    print(f"Total time elapsed: {tm2 - tm1:0.2f} seconds")
+
+
+def merge_year(region: str, year: int, mssng_pages: dict, manifest: movies.RunManifest, csv: bool=True,
+               top_n: int=None, stream_merge: bool=False, spill_rows: int=50000) -> tuple:
+    """
+    Merge a fetched year's pages and normalize it, unless the manifest records it as merged already
+
+    Args:
+        region: str
+            Country of the year
+        year: int
+            Year to merge
+        mssng_pages: dict
+            Pages missing by year, a year with missing pages is not merged
+        manifest: movies.RunManifest
+            Manifest recording how far the year got
+        csv: bool, default True
+            Also export the merged output to csv for blob uploads
+        see main() for the remaining arguments
+    Returns: tuple[int, pd.DataFrame, dict[str, pd.DataFrame]] of the year, its merged dataframe and its tables,
+        or None if it could not be merged
+    """
+    merged = movies.year_dir(region, year) / f"{region}_movie_data_{year}-merged.{movies.output_format()}"
+    if manifest.reached(region, year, 'merged') and merged.exists():
+        logger.info(f"YEAR: {year} already merged, resuming from {merged}")
+        df = movies.read_output(merged)
+    elif stream_merge:
+        with movies.METRICS.timer('merge'):
+            stats = movies.merge_stream(region, year, mssng_pages, csv=csv, top_n=top_n, spill_rows=spill_rows)
+            # normalize() and the loaders need the whole year, only the merge above runs in bounded memory
+            df = movies.read_output(merged) if stats != None else None
+    else:
+        with movies.METRICS.timer('merge'):
+            df = movies.merge_dfs(region, year, mssng_pages, csv=csv, top_n=top_n)
+    if df is None:
+        return None
+    movies.METRICS.inc('rows', len(df), stage='merge')
+    if not manifest.reached(region, year, 'merged'):
+        manifest.mark_year(region, year, 'merged')
+    with movies.METRICS.timer('normalize'):
+        tables = movies.normalize(df)
+    movies.save_tables(region, year, tables)
+    return year, df, tables
+
+
+def load_year(region: str, merged: tuple, manifest: movies.RunManifest, blob: bool=True, sql: bool=True,
+              chunk_size: int=1000, infile: bool=False, sinks: list=None) -> None:
+    """
+    Upload a merged year to blob storage and load it into MySQL, or write it to the given sinks,
+    skipping what the manifest records as done
+
+    Args:
+        region: str
+            Country of the year
+        merged: tuple
+            (year, df, tables) returned by merge_year()
+        manifest: movies.RunManifest
+            Manifest recording how far the year got
+        sinks: list[sinks.Sink], default None
+            (Optional) Write the year to every sink concurrently, blob and sql are ignored
+        see main() for the remaining arguments
+    Returns: None, raises SinkError if the year failed to upload or load. Only what succeeded is marked in the manifest
+    """
+    year, df, tables = merged
+    if sinks != None:
+        if not manifest.reached(region, year, 'loaded'):
+            asyncio.run(write_all(sinks, region, year, df, tables))
+            manifest.mark_year(region, year, 'loaded')
+        return
+    failed = []
+    if blob and not manifest.reached(region, year, 'uploaded'):
+        if blob_upload(region=region, year=year) != 'failed':
+            manifest.mark_year(region, year, 'uploaded')
+        else:
+            failed.append('blob upload')
+    if sql and not manifest.reached(region, year, 'loaded'):
+        if infile:
+            loaded = to_mysql_infile(df=df, year=year, tables=tables)
+        else:
+            loaded = to_mysql(df=df, year=year, chunk_size=chunk_size, tables=tables)
+        if loaded:
+            manifest.mark_year(region, year, 'loaded')
+        else:
+            failed.append('MySQL load')
+    if failed != []:
+        raise SinkError(f"YEAR: {year} failed its {' and '.join(failed)}, --resume tries again")
+
+
+@app.command("shard")
+def shard(regions: str, year_start: int, year_end: int, workers: int=4, threads: int=4, queue: str=None,
+          blob: bool=True, sql: bool=True, append: str='credits', chunk_size: int=1000, infile: bool=False,
+          top_n: int=None, resume: bool=False) -> None:
+    """
+    Crawl several regions and years by sharding (region, year, page) units over worker processes pulling from a
+    shared queue, then merge and load every year once the queue is drained
+
+    Args:
+        regions: str
+            Comma separated countries to filter by, e.g. US,GB,FR
+        year_start: int
+            Year to start filtering at
+        year_end: int
+            Year to stop filtering at
+        workers: int, default 4
+            (Optional) Local worker processes, 0 to only enqueue and wait for workers started with the worker command
+        threads: int, default 4
+            (Optional) Units each worker process handles at once
+        queue: str, default None
+            (Optional) SQLite queue file, movies.QUEUE_FILE under the data_dir by default. Put it and the data_dir
+            on shared storage to add workers on other machines
+        resume: bool, default False
+            (Optional) Keep the units of an interrupted crawl instead of starting over, pages are picked up from the
+            queue and the merge, upload and load of every year from the manifest
+        see run_main for the remaining options
+    Returns: None
+    """
+    tm1 = time.perf_counter()
+    region_list = [region.strip() for region in regions.split(',') if region.strip() != '']
+    year_range = range(year_start, year_end + 1)
+    # Resolved once so every worker process opens the same file
+    queue = queue if queue != None else str(movies.data_dir() / movies.QUEUE_FILE)
+    work_queue = movies.WorkQueue(queue)
+    if not resume:
+        work_queue.reset()
+    work_queue.enqueue([(region, year, 0) for region in region_list for year in year_range])
+
+    # Workers are spawned rather than forked so none of them inherits this process's SQLite connections
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(workers, 1), mp_context=multiprocessing.get_context('spawn')) as executor:
+        processed = sum(executor.map(movies.work, [queue] * workers, [append] * workers, [threads] * workers))
+    while work_queue.active() > 0:
+        time.sleep(movies.POLL)
+    logger.info(f"Processed {processed} units locally, queue: {work_queue.counts()}")
+
+    manifest = movies.RunManifest()
+    for region in region_list:
+        if not resume:
+            manifest.reset(region, year_start, year_end)
+        mssng_pages = work_queue.missing(region)
+        logger.info(f"{region} missing: {mssng_pages}")
         for year in year_range:
-            movies.retry_missing(region, year, mssng_pages) if mssng_pages[year] != [] else None
-            df = movies.merge_dfs(region, year, mssng_pages)
-            if blob:
-                blob_upload(region=region, year=year)
-            if sql:
-                to_mysql(df=df, year=year)
+            # Workers only record pages in the queue, the manifest gets them once it is drained
+            units = work_queue.pages(region, year)
+            manifest.add_pages(region, year, list(units))
+            for page, state in units.items():
+                manifest.mark(region, year, page, 'fetched' if state == 'done' else 'failed')
+            merged = merge_year(region, year, mssng_pages, manifest, csv=blob, top_n=top_n)
+            if merged != None:
+                try:
+                    load_year(region, merged, manifest, blob=blob, sql=sql, chunk_size=chunk_size, infile=infile)
+                except SinkError as e:
+                    logger.info(e)
+    tm2 = time.perf_counter()
+    print(f"Total time elapsed: {tm2 - tm1:0.2f} seconds")
+
+
+@app.command("worker")
+def worker(queue: str=None, threads: int=4, append: str='credits') -> None:
+    """
+    Join a sharded crawl, processing units of its queue until it is drained
+
+    Args:
+        queue: str, default None
+            (Optional) SQLite queue file of the crawl, movies.QUEUE_FILE under the data_dir by default
+        threads: int, default 4
+            (Optional) Units handled at once
+        append: str, default 'credits'
+            (Optional) Sub-resources fetched in the same request as each movie's details
+    Returns: None
+    """
+    movies.work(queue, append=append, threads=threads)
+
+
+@app.command("incremental")
+def incremental(region: str, blob: bool=True, sql: bool=True, append: str='credits') -> None:
+    """
+    Re-fetch only the movies changed since the last successful incremental run and patch them into the merged outputs
+
+    Args:
+        region: str
+            Country whose merged outputs are patched
+        blob: bool, default True
+            (Optional) Upload patched years to Azure storage blob container
+        sql: bool, default True
+            (Optional) Upload patched rows to MySQL database
+        append: str, default 'credits'
+            (Optional) Sub-resources fetched in the same request as each movie's details
+    Returns: None
+    """
+    tm1 = time.perf_counter()
+    run_date = date.today()
+    start = movies.read_watermark(region) or run_date - timedelta(days=1)
+    ids = movies.changed_ids(start, run_date)
+    patched, failed = movies.patch_merged(region, ids, append=append, csv=blob)
+    unsynced = []
+    for year, df in patched.items():
+        if blob and blob_upload(region=region, year=year) == 'failed':
+            unsynced.append(year)
+        if sql and not to_mysql(df=df, year=year, tables=movies.normalize(df)) and year not in unsynced:
+            unsynced.append(year)
 
+    # Only move the watermark forward once every changed movie made it in, and out to blob storage and MySQL
+    if failed != []:
+        logger.info(f"Failed to patch: {failed}, watermark left at {start}")
+    elif unsynced != []:
+        logger.info(f"Failed to upload or load YEARS: {unsynced}, watermark left at {start}")
+    else:
+        movies.write_watermark(region, run_date)
     tm2 = time.perf_counter()
     print(f"Total time elapsed: {tm2 - tm1:0.2f} seconds")
 
@@ -1 +1,16 @@
-from .movies import *
\ No newline at end of file
+from .movies import *
+from .async_engine import TMDB_BURST, TMDB_RATE, AsyncFetcher, TokenBucket, run_async
+from .incremental import changed_ids, patch_merged, read_merged, read_watermark, write_watermark
+from .merge import merge_stream
+from .manifest import STATES, YEAR_STAGES, RunManifest
+from .shard import LEASE, POLL, QUEUE_FILE, WorkQueue, process_unit, work
+from .pipeline import Stage
+from .metrics import BUCKETS, METRICS, REPORT_FILE, Metrics
+from .config import CONFIG_FILE, DATA_DIR, data_dir, get_config, reset_config
+from .lazy import LazyModule
+
+
+def __getattr__(name: str):
+    # sess, limiter, adapter, config, OUTPUT_FORMAT and MOVIE_SCHEMA are built on first access, see movies.movies
+    from . import movies
+    return getattr(movies, name)
@@ -0,0 +1,315 @@
+import asyncio
+import concurrent.futures
+from functools import partial
+import requests
+import threading
+import time
+
+from . import movies
+from .metrics import METRICS
+from .movies import (COLUMNS, MovieBatch, discover_movies, extract_movie, fetch_movie, logger, output_format, pd,
+                     read_output, save_output, sort_by_revenue, year_dir)
+from .retry import MAX_ATTEMPTS, backoff, retry_after, retryable
+
+# TMDB allows roughly 50 requests per second per IP, stay a little under it
+TMDB_RATE = 40
+TMDB_BURST = 20
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter shared by every request of an async run. Tokens are taken by the TMDB adapter for
+    every HTTP request it sends, retries and second requests included, from whichever thread sends it
+
+    Args:
+        rate: float
+            Tokens added to the bucket per second
+        capacity: int
+            Maximum number of tokens, i.e. the largest allowed burst
+    """
+    def __init__(self, rate: float=TMDB_RATE, capacity: int=TMDB_BURST) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        # Take a token, possibly ahead of time, and return how long to wait until it is due
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def take(self) -> None:
+        """
+        Block until a token is available and take it
+        """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire(self) -> None:
+        """
+        Wait on the event loop until a token is available and take it
+        """
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AsyncFetcher:
+    """
+    Run blocking tmdbsimple calls on an event loop, limited by a global in-flight cap and a token bucket
+    taking one token per HTTP request
+
+    Args:
+        max_in_flight: int
+            Maximum number of requests running at the same time
+        rate: float
+            Requests allowed per second
+        burst: int
+            Requests allowed in a single burst
+    """
+    def __init__(self, max_in_flight: int=20, rate: float=TMDB_RATE, burst: int=TMDB_BURST) -> None:
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.bucket = TokenBucket(rate, burst)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Await a blocking call once the concurrency limit allows it, its requests wait for the rate limit in the adapter
+        """
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def call_with_retries(self, func, *args, attempts: int=MAX_ATTEMPTS):
+        """
+        Async counterpart of retry.with_retries(): retryable failures are retried with jittered backoff that honors
+        Retry-After, waiting on the event loop so the request's in-flight slot is free in the meantime
+        """
+        for attempt in range(attempts):
+            try:
+                return await self.call(func, *args)
+            except requests.exceptions.RequestException as e:
+                if attempt == attempts - 1 or not retryable(e):
+                    raise
+                delay = backoff(attempt + 1, retry_after(getattr(e, 'response', None)))
+                METRICS.inc('retries', call=getattr(func, '__name__', 'call'))
+                logger.info(f"{e}, retrying in {delay:0.2f}s")
+                await asyncio.sleep(delay)
+
+    async def discover(self, region: str, year: int, page: int=1) -> dict:
+        """
+        Send a discover.movie() request with retries, see movies.discover_movies()
+        """
+        return await self.call_with_retries(discover_movies, region, year, page)
+
+    async def fetch_record(self, movie_id: int, append: str='credits') -> movies.MovieRecord:
+        """
+        Retrieve a movie with retries and extract it, so only its record is kept while the rest of its page is fetched.
+        See movies.fetch_movie()
+        """
+        movie, credits = await self.call_with_retries(fetch_movie, movie_id, append)
+        with METRICS.timer('extract'):
+            return extract_movie(movie_id, movie, credits)
+
+    async def get_page(self, region: str, year: int, page: int, output: bool=True, append: str='credits',
+                       response: dict=None) -> tuple:
+        """
+        Async counterpart of movies.get_data(), every movie on the page is fetched concurrently.
+        An already retrieved discover response for the page can be passed to skip requesting it again.
+        A failed movie is recorded by id and the rest of the page is kept
+
+        Returns: tuple[str, int, int, pd.DataFrame, list[int]], see movies.get_page_data()
+        """
+        try:
+            if response == None:
+                response = await self.discover(region, year, page)
+        except requests.exceptions.RequestException as e:
+            logger.info(e)
+            logger.info(f"Failed to get YEAR: {year}, PAGE: {page}")
+            return region, year, page, None, []
+        results = response['results']
+        # Movies are extracted as soon as they arrive, only their records are held until the page is complete
+        fetched = await asyncio.gather(*[self.fetch_record(result['id'], append) for result in results],
+                                       return_exceptions=True)
+        batch = MovieBatch(len(results))
+        failed_ids = []
+        for result, record in zip(results, fetched):
+            if isinstance(record, requests.exceptions.RequestException):
+                logger.info(record)
+                logger.info(f"Failed to get MOVIE: {result['id']} of YEAR: {year}, PAGE: {page}")
+                failed_ids.append(result['id'])
+            elif isinstance(record, BaseException):
+                raise record
+            else:
+                batch.add(record)
+        df = sort_by_revenue(batch.to_frame())
+        if output:
+            logger.info(f"Saving YEAR: {year}, PAGE: {page} to {output_format()}")
+            save_output(region, year, df, f"{region}_movie_data_{year}-{page}")
+        return region, year, page if failed_ids != [] else None, df, failed_ids
+
+    async def get_movies(self, region: str, year: int, page: int, ids: list, output: bool=True,
+                         append: str='credits') -> tuple:
+        """
+        Async counterpart of movies.fetch_page_movies(..., keep_saved=True), the movies are fetched concurrently
+        and added to those already saved for the page
+
+        Returns: tuple[str, int, int, pd.DataFrame, list[int]], see movies.get_page_data()
+        """
+        fetched = await asyncio.gather(*[self.fetch_record(movie_id, append) for movie_id in ids], return_exceptions=True)
+        batch = MovieBatch(len(ids))
+        failed_ids = []
+        for movie_id, record in zip(ids, fetched):
+            if isinstance(record, requests.exceptions.RequestException):
+                logger.info(record)
+                logger.info(f"Failed to get MOVIE: {movie_id} of YEAR: {year}, PAGE: {page}")
+                failed_ids.append(movie_id)
+            elif isinstance(record, BaseException):
+                raise record
+            else:
+                batch.add(record)
+        df = batch.to_frame()
+        saved = year_dir(region, year) / f"{region}_movie_data_{year}-{page}.{output_format()}"
+        if saved.exists():
+            df = pd.concat([read_output(saved), df])
+            df = df.drop_duplicates(subset=['ID'], keep='last')
+        df = sort_by_revenue(df)
+        if output:
+            logger.info(f"Saving YEAR: {year}, PAGE: {page} to {output_format()}")
+            save_output(region, year, df, f"{region}_movie_data_{year}-{page}")
+        return region, year, page if failed_ids != [] else None, df, failed_ids
+
+    async def get_year(self, region: str, year: int, output: bool=True, append: str='credits') -> tuple:
+        """
+        Fetch every page of a year, scheduling them all at once. Pages with failed movies keep the movies
+        that were fetched. A page whose discover request failed is queued again after a backoff and is only
+        missing once it has failed MAX_ATTEMPTS times. A year that can't be discovered has page 1 missing
+
+        Returns: tuple[int, list[int], dict[int, list[int]], pd.DataFrame] of the year, its missing pages,
+            the ids of its failed movies by page and its combined dataframe
+        """
+        try:
+            response = await self.discover(region, year)
+        except requests.exceptions.RequestException as e:
+            logger.info(e)
+            logger.info(f"Failed to discover YEAR: {year}")
+            return year, [1], {}, pd.DataFrame({column: [] for column in COLUMNS})
+        pages = [page for page in range(1, response['total_pages'] + 1)]
+        logger.info(f"YEAR {year}: PAGES {pages}")
+        page_results = await asyncio.gather(self.get_page(region, year, 1, output, append, response),
+                                            *[self.get_page(region, year, page, output, append) for page in pages[1:]])
+        for attempt in range(1, MAX_ATTEMPTS):
+            requeued = [result[2] for result in page_results if result[3] is None]
+            if requeued == []:
+                break
+            await asyncio.sleep(backoff(attempt))
+            logger.info(f"Requeueing YEAR: {year}, PAGES: {requeued}")
+            retried = await asyncio.gather(*[self.get_page(region, year, page, output, append) for page in requeued])
+            page_results = [result for result in page_results if result[3] is not None] + retried
+        missing = [result[2] for result in page_results if result[3] is None]
+        failed_ids = {result[2]: result[4] for result in page_results if result[3] is not None and result[4] != []}
+        frames = [result[3] for result in page_results if result[3] is not None]
+        if frames == []:
+            return year, missing, failed_ids, pd.DataFrame({column: [] for column in COLUMNS})
+        df = pd.concat(frames)
+        df.drop_duplicates(subset=['ID'], inplace=True)
+        df = sort_by_revenue(df)
+        return year, missing, failed_ids, df
+
+    async def finish_year(self, region: str, year: int, output: bool=True, append: str='credits',
+                          on_year=None) -> tuple:
+        """
+        Fetch a year with get_year(), then give its missing pages and failed movies a final retry.
+        A year that couldn't be discovered is fetched once more, missing pages are requested again and
+        failed movies are fetched again and added to their saved pages
+
+        Args:
+            on_year: callable, default None
+                Called with the year's results once they are final, see get_year()
+        Returns: tuple[int, list[int], dict[int, list[int]], pd.DataFrame], see get_year()
+        """
+        year, missing, failed_ids, df = await self.get_year(region, year, output, append)
+        if 1 in missing:
+            # Only a year that couldn't be discovered misses page 1, every one of its pages is missing
+            logger.info(f"Attempting discovery of YEAR: {year} again...")
+            year, missing, failed_ids, df = await self.get_year(region, year, output, append)
+        frames = [df]
+        if missing != [] and 1 not in missing:
+            logger.info("Attempting retrieval of missing pages...")
+            retried = await asyncio.gather(*[self.get_page(region, year, page, output, append) for page in missing])
+            # A page that still has failed movies stays missing, as in movies.retry_missing()
+            missing = [result[2] for result in retried if result[2] != None]
+            frames += [result[3] for result in retried if result[3] is not None]
+        # Only the movies that failed are fetched again, the rest of their pages is already saved
+        retried = await asyncio.gather(*[self.get_movies(region, year, page, ids, output, append)
+                                         for page, ids in failed_ids.items()])
+        failed_ids = {result[2]: result[4] for result in retried if result[4] != []}
+        frames += [result[3] for result in retried]
+        if len(frames) > 1:
+            df = pd.concat(frames)
+            df = df.drop_duplicates(subset=['ID'], keep='last')
+            df = sort_by_revenue(df)
+        if on_year != None:
+            # on_year may block, e.g. on a full pipeline queue, so it waits off the event loop
+            await asyncio.to_thread(on_year, year, missing, failed_ids, df)
+        return year, missing, failed_ids, df
+
+    async def run(self, region: str, year_start: int, year_end: int, output: bool=True, append: str='credits',
+                  on_year=None) -> tuple:
+        """
+        Fetch every page of every year in the range concurrently, final retries included, see finish_year()
+
+        Returns: tuple[dict[int, pd.DataFrame], dict[int, list[int]], dict[int, dict[int, list[int]]]]
+        """
+        # Every request the TMDB session sends during the run takes a token
+        movies.adapter.bucket = self.bucket
+        try:
+            year_results = await asyncio.gather(*[self.finish_year(region, year, output, append, on_year)
+                                                  for year in range(year_start, year_end + 1)])
+        finally:
+            movies.adapter.bucket = None
+            self.executor.shutdown(wait=False)
+        dfs = {year: df for year, _, _, df in year_results}
+        mssng_pages = {year: missing for year, missing, _, _ in year_results}
+        failed_ids = {year: failed for year, _, failed, _ in year_results}
+        return dfs, mssng_pages, failed_ids
+
+
+def run_async(region: str, year_start: int, year_end: int, output: bool=True, append: str='credits',
+              max_in_flight: int=20, rate: float=TMDB_RATE, burst: int=TMDB_BURST, on_year=None) -> tuple:
+    """
+    Fetch a range of years with the asyncio engine
+
+    Args:
+        region: str
+            Country to filter by
+        year_start: int
+            Year to start filtering at
+        year_end: int
+            Year to stop filtering at
+        output: bool, default True
+            Save each page to output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+        max_in_flight: int, default 20
+            Global cap on concurrent requests
+        rate: float, default TMDB_RATE
+            Requests allowed per second
+        burst: int, default TMDB_BURST
+            Requests allowed in a single burst
+        on_year: callable, default None
+            Called with (year, missing pages, failed ids by page, dataframe) as soon as each year is finished
+    Returns: tuple[dict[int, pd.DataFrame], dict[int, list[int]], dict[int, dict[int, list[int]]]] of revenue sorted
+        dataframes, missing pages and the ids of failed movies by page, per year, after their final retries
+    """
+    async def _run():
+        fetcher = AsyncFetcher(max_in_flight, rate, burst)
+        return await fetcher.run(region, year_start, year_end, output, append, on_year)
+
+    return asyncio.run(_run())
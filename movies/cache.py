@@ -0,0 +1,200 @@
+import json
+from pathlib import Path
+import re
+import requests
+from requests.structures import CaseInsensitiveDict
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+# Seconds a cached response is served without revalidation, matched against the request path in order
+DEFAULT_TTLS = [
+    (r'/discover/', 60 * 60 * 24),
+    (r'/movie/changes', 0),
+    (r'/movie/\d+', 60 * 60 * 24 * 7),
+]
+DEFAULT_TTL = 60 * 60 * 24
+# Query parameters that never change a response and must not end up on disk
+IGNORED_PARAMS = ['api_key']
+# Cache hits whose access times are held in memory before they are written in one transaction
+TOUCH_BATCH = 1000
+
+
+class CachedSession(requests.Session):
+    """
+    requests.Session that keeps GET responses in an on-disk SQLite cache
+
+    Fresh entries are served without touching the network, stale entries are revalidated with
+    If-None-Match/If-Modified-Since and least recently used entries are evicted past max_bytes.
+    Access times of hits are written in batches, before an eviction and when the session is closed.
+
+    Args:
+        path: str
+            Location of the SQLite cache file
+        ttls: list[tuple[str, int]], default DEFAULT_TTLS
+            (path regex, seconds) pairs, the first match decides how long a response stays fresh
+        default_ttl: int, default DEFAULT_TTL
+            Seconds a response stays fresh when no pattern matches
+        max_bytes: int, default 1 GiB
+            Size cap of all cached bodies
+    """
+    def __init__(self, path: str='./data/tmdb_cache.sqlite', ttls: list=None, default_ttl: int=DEFAULT_TTL,
+                 max_bytes: int=1024 ** 3) -> None:
+        super().__init__()
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in (ttls if ttls != None else DEFAULT_TTLS)]
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._accessed = {}
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                            key TEXT PRIMARY KEY, body BLOB, headers TEXT, etag TEXT, last_modified TEXT,
+                            stored_at REAL, accessed_at REAL, size INTEGER)""")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def cache_key(self, url: str, params: dict=None) -> str:
+        """
+        Build a cache key from an endpoint and its query parameters, ignoring the api key
+        """
+        params = {k: v for k, v in (params or {}).items() if k not in IGNORED_PARAMS}
+        return f"{url}?{urlencode(sorted(params.items()))}"
+
+    def ttl(self, url: str) -> int:
+        """
+        Seconds a response of the given endpoint stays fresh
+        """
+        path = urlsplit(url).path
+        for pattern, ttl in self.ttls:
+            if pattern.search(path):
+                return ttl
+        return self.default_ttl
+
+    def request(self, method, url, params=None, headers=None, **kwargs) -> requests.Response:
+        if method.upper() != 'GET':
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+        key = self.cache_key(url, params)
+        with self._lock:
+            entry = self.conn.execute("SELECT body, headers, etag, last_modified, stored_at FROM responses WHERE key = ?",
+                                      (key,)).fetchone()
+        if entry != None and time.time() - entry[4] < self.ttl(url):
+            with self._lock:
+                self.hits += 1
+            self._touch(key)
+            return self._build_response(url, entry[0], entry[1])
+
+        headers = dict(headers or {})
+        if entry != None:
+            if entry[2]:
+                headers['If-None-Match'] = entry[2]
+            if entry[3]:
+                headers['If-Modified-Since'] = entry[3]
+        response = super().request(method, url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and entry != None:
+            with self._lock:
+                self.revalidated += 1
+                self.conn.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?",
+                                  (time.time(), time.time(), key))
+                self.conn.commit()
+            return self._build_response(url, entry[0], entry[1])
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200:
+            self._store(key, response)
+        return response
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters of this session and the current size of the cache
+
+        Returns: dict[str, int]
+        """
+        with self._lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated,
+                    'entries': entries, 'bytes': self.size}
+
+    def invalidate(self, url: str) -> int:
+        """
+        Remove every cached response of an endpoint, whatever its query parameters
+
+        Args:
+            url: str
+                Endpoint url, e.g. https://api.themoviedb.org/3/movie/603
+        Returns: int of the number of entries removed
+        """
+        with self._lock:
+            removed = self.conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM responses WHERE key LIKE ?",
+                                        (f"{url}?%",)).fetchone()
+            self.conn.execute("DELETE FROM responses WHERE key LIKE ?", (f"{url}?%",))
+            self.conn.commit()
+            self.size -= removed[0]
+        return removed[1]
+
+    def clear(self) -> None:
+        """
+        Remove every cached response
+        """
+        with self._lock:
+            self._accessed.clear()
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            self.size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_accessed()
+            self.conn.commit()
+        super().close()
+
+    def _build_response(self, url: str, body: bytes, headers: str) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response.url = url
+        response.encoding = 'utf-8'
+        return response
+
+    def _touch(self, key: str) -> None:
+        # A hit only records its access time in memory, a commit per hit would sync the disk on the hot path
+        with self._lock:
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= TOUCH_BATCH:
+                self._flush_accessed()
+                self.conn.commit()
+
+    def _flush_accessed(self) -> None:
+        # Called with the lock held, the caller commits
+        if self._accessed != {}:
+            self.conn.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                                  [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+
+    def _store(self, key: str, response: requests.Response) -> None:
+        body = response.content
+        headers = json.dumps({k: v for k, v in response.headers.items() if k.lower() in ('content-type', 'etag', 'last-modified')})
+        now = time.time()
+        with self._lock:
+            self._accessed.pop(key, None)
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.size -= old[0] if old != None else 0
+            self.conn.execute("REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (key, body, headers, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                               now, now, len(body)))
+            self.size += len(body)
+            # Evict least recently used entries until the cache fits its cap again
+            if self.size > self.max_bytes:
+                self._flush_accessed()
+            while self.size > self.max_bytes:
+                oldest = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1").fetchone()
+                if oldest == None:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+                self.size -= oldest[1]
+            self.conn.commit()
@@ -0,0 +1,110 @@
+import requests
+import threading
+import time
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .metrics import METRICS
+from .retry import AIMDLimiter, ThrottledAdapter
+
+
+class PoolStats:
+    """
+    Connection pool counters shared by every thread: connections opened, requests sent over them and
+    time spent waiting for a free connection
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.connections = 0
+            self.pool_wait = 0.0
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict:
+        """
+        Current counters, 'reused' is the number of requests sent over an already open connection
+
+        Returns: dict[str, float]
+        """
+        with self._lock:
+            return {'requests': self.requests, 'connections': self.connections,
+                    'reused': max(0, self.requests - self.connections),
+                    'pool_wait': round(self.pool_wait, 3)}
+
+
+POOL_STATS = PoolStats()
+
+
+class TimedPool:
+    """
+    Connection pool mixin recording new connections and the time spent waiting for a free one in POOL_STATS
+    """
+    def _new_conn(self):
+        POOL_STATS.add(connections=1)
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        tm1 = time.perf_counter()
+        try:
+            return super()._get_conn(timeout)
+        finally:
+            POOL_STATS.add(pool_wait=time.perf_counter() - tm1)
+
+
+class TimedHTTPConnectionPool(TimedPool, HTTPConnectionPool):
+    pass
+
+
+class TimedHTTPSConnectionPool(TimedPool, HTTPSConnectionPool):
+    pass
+
+
+class TMDBAdapter(ThrottledAdapter):
+    """
+    Adapter of the TMDB session: a blocking connection pool sized to the number of workers, connections
+    kept alive between requests and every request going through the shared AIMDLimiter.
+    While bucket is set (by an async run), every request also takes one of its tokens first
+
+    Args:
+        limiter: AIMDLimiter
+            Limiter shared by every request of the session
+        pool_size: int
+            Connections kept open to TMDB, match it to the number of threads sending requests
+    """
+    def __init__(self, limiter: AIMDLimiter, pool_size: int=20, **kwargs) -> None:
+        self.bucket = None
+        super().__init__(limiter, pool_connections=1, pool_maxsize=pool_size, pool_block=True, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs) -> None:
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    def resize(self, pool_size: int) -> None:
+        """
+        Replace the connection pool with one of pool_size connections
+        """
+        self.poolmanager.clear()
+        self.init_poolmanager(self._pool_connections, pool_size, self._pool_block)
+
+    def send(self, request, **kwargs) -> requests.Response:
+        # tmdbsimple asks for 'Connection: close' on every request, which would open a new TLS connection each time
+        if request.headers.get('Connection', '').lower() == 'close':
+            del request.headers['Connection']
+        if self.bucket != None:
+            self.bucket.take()
+        POOL_STATS.add(requests=1)
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            METRICS.inc('requests', status='error')
+            raise
+        METRICS.inc('requests', status=str(response.status_code))
+        METRICS.inc('bytes_received', len(response.content))
+        return response
@@ -0,0 +1,51 @@
+import json
+import os
+from pathlib import Path
+import threading
+
+# Read from the working directory unless the TMDB_CONFIG environment variable points elsewhere
+CONFIG_FILE = './config.json'
+# Relative paths are resolved against the directory the program started in, as when the file was read at import
+START_DIR = os.getcwd()
+# Root of page, merged and normalized outputs unless config.json sets "data_dir"
+DATA_DIR = './data'
+
+_config = None
+_lock = threading.Lock()
+
+
+def get_config() -> dict:
+    """
+    Settings of config.json, read on first use instead of at import so modules can be imported from anywhere
+
+    Returns: dict
+    """
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                path = Path(START_DIR) / os.environ.get('TMDB_CONFIG', CONFIG_FILE)
+                if not path.exists():
+                    raise FileNotFoundError(f"{path} not found, run from the directory holding config.json "
+                                            f"or set TMDB_CONFIG to its location")
+                _config = json.loads(path.read_text())
+    return _config
+
+
+def data_dir() -> Path:
+    """
+    Directory every region's outputs are saved under, "data_dir" of config.json or DATA_DIR.
+    A relative directory is resolved against START_DIR, like config.json itself
+
+    Returns: Path
+    """
+    return Path(START_DIR) / get_config().get('data_dir', DATA_DIR)
+
+
+def reset_config() -> None:
+    """
+    Forget the loaded settings, the next get_config() reads the file again
+    """
+    global _config
+    with _lock:
+        _config = None
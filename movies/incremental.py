@@ -0,0 +1,151 @@
+from datetime import date, timedelta
+import json
+from pathlib import Path
+import requests
+import tmdbsimple as tmdb
+
+from . import movies
+from .cache import CachedSession
+from .config import data_dir
+from .movies import MovieBatch, extract_movie, fetch_movie, logger, normalize, output_csv, output_format, pd, read_output, save_output, save_tables, sort_by_revenue, with_retries
+
+# Saved under data_dir()
+WATERMARK_FILE = 'incremental_watermark.json'
+# The changes endpoint accepts at most 14 days per query
+CHANGES_WINDOW = 14
+
+
+def read_watermark(region: str, path: str=None) -> date:
+    """
+    Read the date of a region's last successful incremental run
+
+    Args:
+        region: str
+            Country the watermark belongs to
+        path: str, default None
+            (Optional) Location of the watermark file, WATERMARK_FILE under data_dir() by default
+    Returns: datetime.date, or None if the region was never synced
+    """
+    watermark_file = Path(path) if path != None else data_dir() / WATERMARK_FILE
+    if not watermark_file.exists():
+        return None
+    watermarks = json.loads(watermark_file.read_text())
+    if region not in watermarks:
+        return None
+    return date.fromisoformat(watermarks[region])
+
+
+def write_watermark(region: str, day: date, path: str=None) -> None:
+    """
+    Persist the date of a region's last successful incremental run
+
+    Args:
+        region: str
+            Country the watermark belongs to
+        day: datetime.date
+            Date the next run should read changes from
+        path: str, default None
+            (Optional) Location of the watermark file, WATERMARK_FILE under data_dir() by default
+    Returns: None
+    """
+    watermark_file = Path(path) if path != None else data_dir() / WATERMARK_FILE
+    watermark_file.parent.mkdir(parents=True, exist_ok=True)
+    watermarks = json.loads(watermark_file.read_text()) if watermark_file.exists() else {}
+    watermarks[region] = day.isoformat()
+    watermark_file.write_text(json.dumps(watermarks, indent=2))
+
+
+def changed_ids(start: date, end: date) -> set:
+    """
+    Collect the ids of every movie changed between two dates, in windows of CHANGES_WINDOW days
+
+    Args:
+        start: datetime.date
+            First day to read changes for
+        end: datetime.date
+            Last day to read changes for
+    Returns: set[int]
+    """
+    movies.init_client()
+    ids = set()
+    window_start = start
+    while window_start <= end:
+        window_end = min(window_start + timedelta(days=CHANGES_WINDOW - 1), end)
+        page = 1
+        total_pages = 1
+        while page <= total_pages:
+            response = with_retries(tmdb.Changes().movie, start_date=window_start.isoformat(), end_date=window_end.isoformat(),
+                                    page=page)
+            ids.update(result['id'] for result in response['results'])
+            total_pages = response['total_pages']
+            page += 1
+        window_start = window_end + timedelta(days=1)
+    logger.info(f"{len(ids)} movies changed from {start} to {end}")
+    return ids
+
+
+def read_merged(region: str) -> dict:
+    """
+    Read every merged output saved for a region
+
+    Args:
+        region: str
+            Country included in the merged output filenames
+    Returns: dict[int, pd.DataFrame] of merged dataframes by year
+    """
+    merged = {}
+    suffix = f"-merged.{output_format()}"
+    for path in data_dir().glob(f"{region}_movie_data_*/{region}_movie_data_*{suffix}"):
+        year = int(path.name[len(f"{region}_movie_data_"):-len(suffix)])
+        merged[year] = read_output(path)
+    return merged
+
+
+def patch_merged(region: str, ids: set, output=True, append: str='credits', csv: bool=False) -> tuple:
+    """
+    Re-fetch the changed movies found in a region's merged outputs and patch their rows in place,
+    the year's normalized tables are saved again from the patched output
+
+    Args:
+        region: str
+            Country whose merged outputs are patched
+        ids: set[int]
+            Ids of changed movies, ids that are not in any merged output are ignored
+        output: bool, default True
+            Save the patched merged dataframes to output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+        csv: bool, default False
+            Also export the patched merged dataframes to csv
+    Returns: tuple[dict[int, pd.DataFrame], list[int]] of the patched rows by year and the ids that failed
+    """
+    patched = {}
+    failed = []
+    for year, merged in read_merged(region).items():
+        year_ids = [movie_id for movie_id in merged['ID'] if movie_id in ids]
+        if year_ids == []:
+            continue
+        batch = MovieBatch(len(year_ids))
+        for movie_id in year_ids:
+            # Cached details of a changed movie are out of date
+            if isinstance(movies.sess, CachedSession):
+                movies.sess.invalidate(f"https://api.themoviedb.org/{tmdb.API_VERSION}/movie/{movie_id}")
+            try:
+                movie, credits = with_retries(fetch_movie, movie_id, append)
+                batch.add(extract_movie(movie_id, movie, credits))
+            except requests.exceptions.RequestException as e:
+                logger.info(e)
+                logger.info(f"Failed to re-fetch MOVIE: {movie_id}")
+                failed.append(movie_id)
+        rows = batch.to_frame()
+        merged = pd.concat([merged[~merged['ID'].isin(rows['ID'])], rows])
+        merged = sort_by_revenue(merged)
+        if output:
+            logger.info(f"Patching {len(rows)} rows of YEAR: {year}")
+            save_output(region, year, merged, f"{region}_movie_data_{year}-merged")
+            # The normalized tables saved with the merged output would otherwise still hold the old rows
+            save_tables(region, year, normalize(merged))
+            if csv and output_format() != 'csv':
+                output_csv(region, year, merged, f"{region}_movie_data_{year}-merged.csv")
+        patched[year] = rows
+    return patched, failed
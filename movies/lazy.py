@@ -0,0 +1,27 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    """
+    Stand-in for a heavy module that is only imported when one of its attributes is first used,
+    e.g. pd = LazyModule('pandas') keeps pandas out of short commands and worker start up
+
+    Args:
+        name: str
+            Module to import
+    """
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module is not None else ''}>"
@@ -0,0 +1,106 @@
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from .config import data_dir
+
+# Page states in the order a page moves through them
+STATES = ['pending', 'failed', 'fetched']
+# Stages a fetched year goes through, each recorded on its own so one failing doesn't hide or skip another
+YEAR_STAGES = ['merged', 'uploaded', 'loaded']
+
+
+class RunManifest:
+    """
+    SQLite record of every (region, year, page) of a run and how far it got, and of the stages each year completed,
+    so an interrupted run can resume
+
+    Args:
+        path: str
+            Location of the SQLite manifest file, run_manifest.sqlite under data_dir() by default
+    """
+    def __init__(self, path: str=None) -> None:
+        path = path if path != None else str(data_dir() / 'run_manifest.sqlite')
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                            region TEXT, year INTEGER, page INTEGER, state TEXT, updated_at REAL,
+                            PRIMARY KEY (region, year, page))""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS years (
+                            region TEXT, year INTEGER, stage TEXT, updated_at REAL,
+                            PRIMARY KEY (region, year, stage))""")
+        self.conn.commit()
+
+    def reset(self, region: str, year_start: int, year_end: int) -> None:
+        """
+        Forget every page and stage of a region's year range
+        """
+        with self._lock:
+            self.conn.execute("DELETE FROM pages WHERE region = ? AND year BETWEEN ? AND ?", (region, year_start, year_end))
+            self.conn.execute("DELETE FROM years WHERE region = ? AND year BETWEEN ? AND ?", (region, year_start, year_end))
+            self.conn.commit()
+
+    def add_pages(self, region: str, year: int, pages: list) -> None:
+        """
+        Record a year's pages as pending, pages already recorded keep their state
+        """
+        with self._lock:
+            self.conn.executemany("INSERT OR IGNORE INTO pages VALUES (?, ?, ?, 'pending', ?)",
+                                  [(region, year, page, time.time()) for page in pages])
+            self.conn.commit()
+
+    def mark(self, region: str, year: int, page: int, state: str) -> None:
+        """
+        Set the state of a single page
+        """
+        with self._lock:
+            self.conn.execute("REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (region, year, page, state, time.time()))
+            self.conn.commit()
+
+    def mark_year(self, region: str, year: int, stage: str) -> None:
+        """
+        Record that a year completed one of YEAR_STAGES, used by the merge, upload and load stages
+        """
+        if stage not in YEAR_STAGES:
+            raise ValueError(f"Unknown year stage: {stage}, choose from {YEAR_STAGES}")
+        with self._lock:
+            self.conn.execute("REPLACE INTO years VALUES (?, ?, ?, ?)", (region, year, stage, time.time()))
+            self.conn.commit()
+
+    def pages(self, region: str, year: int, states: list=None) -> list:
+        """
+        List a year's recorded pages, optionally only those in the given states
+
+        Returns: list[int]
+        """
+        states = states or STATES
+        with self._lock:
+            rows = self.conn.execute(f"""SELECT page FROM pages WHERE region = ? AND year = ?
+                                     AND state IN ({', '.join('?' * len(states))}) ORDER BY page""",
+                                     (region, year, *states)).fetchall()
+        return [row[0] for row in rows]
+
+    def year_state(self, region: str, year: int) -> str:
+        """
+        State of a year, the least advanced state of any of its pages. 'pending' if none are recorded
+
+        Returns: str
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT DISTINCT state FROM pages WHERE region = ? AND year = ?", (region, year)).fetchall()
+        if rows == []:
+            return 'pending'
+        return min((row[0] for row in rows), key=STATES.index)
+
+    def reached(self, region: str, year: int, state: str) -> bool:
+        """
+        Whether every page of a year has reached one of STATES, or the year has completed one of YEAR_STAGES
+        """
+        if state in YEAR_STAGES:
+            with self._lock:
+                row = self.conn.execute("SELECT 1 FROM years WHERE region = ? AND year = ? AND stage = ?",
+                                        (region, year, state)).fetchone()
+            return row != None
+        return STATES.index(self.year_state(region, year)) >= STATES.index(state)
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import heapq
+import os
+from pathlib import Path
+import tempfile
+
+from .lazy import LazyModule
+from .movies import logger, movie_schema, output_format, page_files, pa, pd, restore_types, year_dir
+
+pq = LazyModule('pyarrow.parquet')
+
+
+def iter_output(path: Path, chunk_rows: int) -> iter:
+    """
+    Read a page or merged output in chunks of at most chunk_rows rows
+
+    Args:
+        path: Path
+            parquet or csv file to read
+        chunk_rows: int
+            Rows per chunk
+    Returns: iterator of pd.DataFrame
+    """
+    if path.suffix == '.parquet':
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield restore_types(batch.to_pandas(), from_csv=False)
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_rows):
+            yield restore_types(chunk, from_csv=True)
+
+
+class OutputWriter:
+    """
+    Append dataframes to an output file chunk by chunk, the file only replaces its destination once closed
+
+    Args:
+        path: Path
+            Destination parquet or csv file
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tmp_path = path.with_name(f".{path.name}.tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.path.suffix == '.parquet':
+            table = pa.Table.from_pandas(df, schema=movie_schema(), preserve_index=False)
+            if self.writer == None:
+                self.writer = pq.ParquetWriter(self.tmp_path, movie_schema())
+            self.writer.write_table(table)
+        else:
+            df.to_csv(self.tmp_path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+    def close(self) -> None:
+        if self.writer != None:
+            self.writer.close()
+        elif self.rows == 0 and self.path.suffix == '.parquet':
+            pq.write_table(movie_schema().empty_table(), self.tmp_path)
+        elif self.rows == 0:
+            # Nothing was written, a year without movies still gets an output with just the header
+            pd.DataFrame(columns=movie_schema().names).to_csv(self.tmp_path, index=False)
+        os.replace(self.tmp_path, self.path)
+
+
+def spill_run(df: pd.DataFrame, spill_dir: str, run: int) -> Path:
+    """
+    Sort a buffer of rows by revenue and spill it to a parquet run file
+
+    Returns: Path of the run file
+    """
+    path = Path(spill_dir) / f"run-{run}.parquet"
+    df = df.sort_values(by='REVENUE', ascending=False, kind='stable')
+    pq.write_table(pa.Table.from_pandas(df, schema=movie_schema(), preserve_index=False), path)
+    return path
+
+
+def iter_run(path: Path, run: int, chunk_rows: int) -> iter:
+    """
+    Yield the rows of a sorted run as (-revenue, run, position, row) so runs merge in revenue order,
+    ties keep the order rows were read in
+    """
+    revenue = movie_schema().names.index('REVENUE')
+    position = 0
+    for chunk in iter_output(path, chunk_rows):
+        for row in chunk.itertuples(index=False, name=None):
+            yield -row[revenue], run, position, row
+            position += 1
+
+
+def merge_stream(region: str, year: int, missing=None, csv: bool=False, top_n: int=None,
+                 chunk_rows: int=5000, spill_rows: int=50000) -> dict:
+    """
+    Merge a year's page outputs without loading every page at once. Pages are read in chunks, duplicate movie ids
+    are dropped with a set of the ids already seen and rows are ordered by revenue with a bounded top-K or an
+    external sort that spills sorted runs of at most spill_rows rows to disk. The merged output is written as it goes.
+    Memory is only bounded for the merge itself, callers that read the merged output back (e.g. run_main to normalize
+    and load the year) still hold the whole year.
+
+    Args:
+        region: str
+            Country that will be included in the output filename
+        year: int
+            Year that will be included in the output filename
+        missing: dict, default None
+            (Optional) The dictionary to check for any pages missing
+        csv: bool, default False
+            (Optional) Also export the merged output to csv
+        top_n: int, default None
+            (Optional) Only keep the year's top_n highest earning movies
+        chunk_rows: int, default 5000
+            Rows read from a page or run file at a time
+        spill_rows: int, default 50000
+            Rows buffered in memory before a sorted run is spilled to disk
+    Returns: dict[str, int] of merge statistics, None if pages are missing
+    """
+    if missing != None and missing[year] != []:
+        logger.info("All pages not found, cannot merge")
+        return
+    sub_dir = year_dir(region, year)
+    name = f"{region}_movie_data_{year}-merged"
+    stats = {'pages': 0, 'rows_read': 0, 'duplicates': 0, 'runs': 0, 'rows_written': 0, 'peak_buffer_bytes': 0}
+    seen = set()
+    buffer = []
+    buffered_rows = 0
+    buffered_bytes = 0
+    runs = []
+    top = None
+    logger.info(f"Streaming merge of {region} movie dataframes for YEAR: {year}")
+    with tempfile.TemporaryDirectory() as spill_dir:
+        for page in page_files(region, year):
+            stats['pages'] += 1
+            for chunk in iter_output(page, chunk_rows):
+                read = len(chunk)
+                chunk = chunk.drop_duplicates(subset=['ID'])
+                chunk = chunk[~chunk['ID'].isin(seen)]
+                stats['rows_read'] += read
+                stats['duplicates'] += read - len(chunk)
+                seen.update(chunk['ID'].tolist())
+                chunk = chunk.astype({'BUDGET': 'int64', 'REVENUE': 'int64'})
+                if top_n != None:
+                    top = chunk.nlargest(top_n, 'REVENUE') if top is None else \
+                        pd.concat([top, chunk]).nlargest(top_n, 'REVENUE')
+                    held = top.memory_usage(deep=True).sum()
+                else:
+                    buffer.append(chunk)
+                    buffered_rows += len(chunk)
+                    # Each chunk is measured once, measuring the whole buffer again would make merges quadratic in pages
+                    buffered_bytes += chunk.memory_usage(deep=True).sum()
+                    held = buffered_bytes
+                    if buffered_rows >= spill_rows:
+                        runs.append(spill_run(pd.concat(buffer), spill_dir, len(runs)))
+                        buffer, buffered_rows, buffered_bytes = [], 0, 0
+                stats['peak_buffer_bytes'] = max(stats['peak_buffer_bytes'], int(held))
+        if stats['pages'] == 0:
+            logger.info(f"No pages found for YEAR: {year}")
+            return
+
+        writers = [OutputWriter(sub_dir / f"{name}.{output_format()}")]
+        if csv and output_format() != 'csv':
+            writers.append(OutputWriter(sub_dir / f"{name}.csv"))
+        if top_n != None:
+            chunks = [top] if top is not None else []
+        else:
+            if buffer != []:
+                runs.append(spill_run(pd.concat(buffer), spill_dir, len(runs)))
+            stats['runs'] = len(runs)
+            chunks = merge_runs(runs, chunk_rows)
+        for chunk in chunks:
+            for writer in writers:
+                writer.write(chunk)
+            stats['rows_written'] += len(chunk)
+        for writer in writers:
+            writer.close()
+    logger.info(f"Merged YEAR: {year}, {stats}")
+    return stats
+
+
+def merge_runs(runs: list, chunk_rows: int) -> iter:
+    """
+    K-way merge of sorted run files into dataframes of at most chunk_rows rows, highest revenue first
+
+    Returns: iterator of pd.DataFrame
+    """
+    rows = []
+    for _, _, _, row in heapq.merge(*[iter_run(path, run, chunk_rows) for run, path in enumerate(runs)]):
+        rows.append(row)
+        if len(rows) == chunk_rows:
+            yield pd.DataFrame(rows, columns=movie_schema().names)
+            rows = []
+    if rows != []:
+        yield pd.DataFrame(rows, columns=movie_schema().names)
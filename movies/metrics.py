@@ -0,0 +1,178 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from pathlib import Path
+import threading
+import time
+
+from .config import data_dir
+
+# Saved under data_dir()
+REPORT_FILE = 'run_report.json'
+# Upper bounds in seconds of the histogram buckets, from a cached response to a large MySQL table
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """
+    Timing histogram with cumulative buckets, as exported to Prometheus
+    """
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q quantile, the largest observation if it is past the last bucket
+        """
+        rank = q * self.count
+        for bound, count in zip(BUCKETS, self.counts):
+            if count >= rank:
+                return bound
+        return round(self.max, 3)
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'sum': round(self.sum, 3), 'mean': round(self.sum / self.count, 4) if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'max': round(self.max, 3)}
+
+
+class Metrics:
+    """
+    Stage timings and counters of a run shared by every thread: seconds spent per stage (discover, movie_info,
+    credits, extract, write, merge, blob_upload, mysql per table), requests, retries, bytes and rows.
+    Metrics are keyed on their name and labels, e.g. observe('stage_seconds', 0.2, stage='mysql', table='movies')
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started = time.time()
+            self.histograms = {}
+            self.counters = {}
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """
+        Add an observation to a timing histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.histograms.setdefault(key, Histogram()).observe(seconds)
+
+    def inc(self, name: str, value: float=1, **labels) -> None:
+        """
+        Increase a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """
+        Time the wrapped block as an observation of stage_seconds, failed attempts included
+        """
+        tm1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - tm1, stage=stage, **labels)
+
+    def report(self, extra: dict=None) -> dict:
+        """
+        JSON run report: stage timings, counters and rows per second of every stage that counted rows
+
+        Args:
+            extra: dict, default None
+                (Optional) Other stats to include, e.g. the pipeline stages and TMDB client
+        Returns: dict
+        """
+        with self._lock:
+            elapsed = time.time() - self.started
+            stages = [{**dict(labels), **histogram.snapshot()} for (name, labels), histogram in sorted(self.histograms.items())
+                      if name == 'stage_seconds']
+            counters = [{'name': name, **dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            busy = {labels: histogram.sum for (name, labels), histogram in self.histograms.items() if name == 'stage_seconds'}
+            throughput = {'/'.join(str(value) for _, value in labels): round(value / busy[labels], 1)
+                          for (name, labels), value in sorted(self.counters.items())
+                          if name == 'rows' and busy.get(labels, 0) > 0}
+        return {'started': self.started, 'elapsed': round(elapsed, 3), 'stages': stages, 'counters': counters,
+                'rows_per_second': throughput, **(extra or {})}
+
+    def write_report(self, path: str=None, extra: dict=None) -> dict:
+        """
+        Save report() as json, to REPORT_FILE under data_dir() unless given a path
+        """
+        path = path if path != None else data_dir() / REPORT_FILE
+        report = self.report(extra)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(report, indent=2))
+        return report
+
+    def prometheus(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format, prefixed with tmdb_
+        """
+        def label_text(labels: tuple, **more) -> str:
+            pairs = list(labels) + list(more.items())
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}' if pairs else ''
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE tmdb_{name} histogram")
+                for (h_name, labels), histogram in sorted(self.histograms.items()):
+                    if h_name != name:
+                        continue
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        lines.append(f"tmdb_{name}_bucket{label_text(labels, le=bound)} {count}")
+                    lines.append(f"tmdb_{name}_bucket{label_text(labels, le='+Inf')} {histogram.count}")
+                    lines.append(f"tmdb_{name}_sum{label_text(labels)} {histogram.sum}")
+                    lines.append(f"tmdb_{name}_count{label_text(labels)} {histogram.count}")
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE tmdb_{name}_total counter")
+                for (c_name, labels), value in sorted(self.counters.items()):
+                    if c_name == name:
+                        lines.append(f"tmdb_{name}_total{label_text(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """
+        Serve prometheus() on http://0.0.0.0:<port>/metrics from a daemon thread
+
+        Returns: ThreadingHTTPServer, shutdown() stops it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+METRICS = Metrics()
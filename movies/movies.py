@@ -1,32 +1,169 @@
+from __future__ import annotations
+
 from ast import literal_eval
-import json
+import atexit
+import functools
+import heapq
 import logging
 from logging import INFO
-import pandas as pd
 from pathlib import Path
+import re
 import requests
-from requests.adapters import HTTPAdapter, Retry
 import sys
+import threading
 import tmdbsimple as tmdb
 import typer
+from typing import NamedTuple
 
-movies_app = typer.Typer(no_args_is_help=True)
+if __name__ == "__main__" and not __package__:
+    # Run as a script (python movies/movies.py <command>), hand over to the movies package so the imports below resolve
+    sys.path[0] = str(Path(__file__).resolve().parent.parent)
+    from movies.movies import movies_app
+    sys.exit(movies_app())
 
-# tmdb configuration
-file = open('./config.json', 'r')
-config = json.loads(file.read())
-tmdb.API_KEY = config['tmdb_api_key']
+from .cache import CachedSession, DEFAULT_TTL
+from .client import POOL_STATS, TMDBAdapter
+from .config import data_dir, get_config
+from .lazy import LazyModule
+from .metrics import METRICS
+from .retry import MAX_ATTEMPTS, TIMEOUT, AIMDLimiter, backoff, with_retries
 
-sess = requests.Session()
-retries = Retry(total=5, backoff_factor=0.7, status_forcelist=[500, 503, 504])
-tmdb.REQUESTS_SESSION = sess
-tmdb.REQUESTS_SESSION.mount("https://", HTTPAdapter(max_retries=retries))
-tmdb.REQUESTS_TIMEOUT = (3600)
-discover = tmdb.Discover()
+# pandas and pyarrow are only imported once a dataframe is built, so short commands and workers start quickly
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+
+movies_app = typer.Typer(no_args_is_help=True)
+
+# TMDB session shared by every thread, built by init_client() on first use. tmdbsimple objects hold their
+# last response so a new one is created per request instead
+_sess = None
+_limiter = None
+_adapter = None
+_client_lock = threading.Lock()
 
 logging.basicConfig(format='[%(asctime)s][%(module)s:%(lineno)04d] : %(message)s', level=INFO, stream=sys.stderr)
 logger: logging.Logger = logging
 
+COLUMNS = ['ID', 'TITLE', 'ORIGINAL_TITLE', 'RELEASE_DATE', 'ORIGINAL_LANGUAGE', 'PLOT', 'DIRECTORS', 'CAST', 'CREW', 'GENRES', 'PRODUCTION_COUNTRIES', 'PRODUCTION_COMPANIES', 'BUDGET', 'REVENUE']
+# Columns holding a list[dict] per movie
+NESTED_COLUMNS = ['DIRECTORS', 'CAST', 'CREW', 'GENRES', 'PRODUCTION_COUNTRIES', 'PRODUCTION_COMPANIES']
+# Keys of TMDB cast and crew members that extraction can keep, with their Arrow types
+CREDIT_FIELDS = {'id': 'int64', 'name': 'string', 'original_name': 'string', 'character': 'string', 'order': 'int64',
+                 'cast_id': 'int64', 'credit_id': 'string', 'gender': 'int64', 'known_for_department': 'string',
+                 'popularity': 'float64', 'profile_path': 'string', 'department': 'string', 'job': 'string'}
+# Every credited cast member and no crew besides the directors, unless config.json sets "credits"
+DEFAULT_CREDITS = {'cast_limit': None, 'cast_fields': ['id', 'name'], 'crew_jobs': [], 'crew_fields': ['id', 'name', 'job']}
+# Key of every normalized table, None when a row is keyed on all of its columns
+TABLE_KEYS = {'movies': 'id', 'plots': 'movie_id', 'genres': 'id', 'movie_genres': None, 'directors': 'id',
+              'movie_directors': None, 'actors': 'id', 'movie_actors': None, 'countries': 'id', 'companies': 'id',
+              'movie_revenue': 'movie_id'}
+
+
+@functools.lru_cache(maxsize=None)
+def movie_schema() -> pa.Schema:
+    """
+    Parquet schema of page and merged outputs, so every file has the same nested types even when a column is all empty lists
+
+    Returns: pa.Schema
+    """
+    person_type = pa.struct([('id', pa.int64()), ('name', pa.string())])
+    options = credit_options()
+    cast_type = pa.struct([(field, getattr(pa, CREDIT_FIELDS[field])()) for field in options['cast_fields']])
+    crew_type = pa.struct([(field, getattr(pa, CREDIT_FIELDS[field])()) for field in options['crew_fields']])
+    return pa.schema([('ID', pa.int64()), ('TITLE', pa.string()), ('ORIGINAL_TITLE', pa.string()),
+                      ('RELEASE_DATE', pa.string()), ('ORIGINAL_LANGUAGE', pa.string()), ('PLOT', pa.string()),
+                      ('DIRECTORS', pa.list_(person_type)), ('CAST', pa.list_(cast_type)), ('CREW', pa.list_(crew_type)),
+                      ('GENRES', pa.list_(person_type)),
+                      ('PRODUCTION_COUNTRIES', pa.list_(pa.struct([('iso_3166_1', pa.string()), ('name', pa.string())]))),
+                      ('PRODUCTION_COMPANIES', pa.list_(pa.struct([('id', pa.int64()), ('name', pa.string()),
+                                                                   ('origin_country', pa.string())]))),
+                      ('BUDGET', pa.int64()), ('REVENUE', pa.int64())])
+
+
+def credit_options() -> dict:
+    """
+    What extraction keeps of a movie's credits, DEFAULT_CREDITS overridden by "credits" in config.json:
+    cast_limit top billed cast members by their order (all when None), cast_fields the keys kept of each,
+    crew_jobs the jobs of the crew members kept in CREW and crew_fields the keys kept of each
+
+    Returns: dict
+    """
+    options = {**DEFAULT_CREDITS, **get_config().get('credits', {})}
+    for key in ('cast_fields', 'crew_fields'):
+        unknown = [field for field in options[key] if field not in CREDIT_FIELDS]
+        if unknown != []:
+            raise ValueError(f"Unknown credits {key}: {unknown}, choose from {list(CREDIT_FIELDS)}")
+        if 'id' not in options[key] or 'name' not in options[key]:
+            raise ValueError(f"Credits {key} must keep 'id' and 'name'")
+    return options
+
+
+def output_format() -> str:
+    """
+    Format of page and merged outputs, typed parquet (list/struct columns) unless config.json sets "output_format": "csv"
+    """
+    return get_config().get('output_format', 'parquet')
+
+
+def init_client() -> None:
+    """
+    Build the TMDB session on first use: API key, response cache, the shared AIMDLimiter and the connection pool.
+    Responses are cached on disk unless disabled with {"cache": {"enabled": false}} in config.json
+    """
+    global _sess, _limiter, _adapter
+    if _sess is not None:
+        return
+    with _client_lock:
+        if _sess is not None:
+            return
+        config = get_config()
+        tmdb.API_KEY = config['tmdb_api_key']
+        cache_config = config.get('cache', {})
+        if cache_config.get('enabled', True):
+            sess = CachedSession(path=cache_config.get('path', str(data_dir() / 'tmdb_cache.sqlite')),
+                                 default_ttl=cache_config.get('default_ttl', DEFAULT_TTL),
+                                 max_bytes=cache_config.get('max_bytes', 1024 ** 3))
+            # Writes the access times of hits still held in memory
+            atexit.register(sess.close)
+        else:
+            sess = requests.Session()
+        # The adapter never retries, connection errors, server errors and 429s are all left to with_retries() so a
+        # request is sent at most MAX_ATTEMPTS times, Retry-After is honored and the shared limiter can shrink concurrency
+        _limiter = AIMDLimiter(config.get('max_in_flight', 20))
+        _adapter = TMDBAdapter(_limiter, config.get('pool_size', config.get('max_in_flight', 20)))
+        sess.mount("https://", _adapter)
+        tmdb.REQUESTS_SESSION = sess
+        tmdb.REQUESTS_TIMEOUT = tuple(config.get('timeout', TIMEOUT))
+        _sess = sess
+
+
+def __getattr__(name: str):
+    # Settings and clients that used to be built at import, now built on first access
+    if name in ('sess', 'limiter', 'adapter'):
+        init_client()
+        return globals()[f"_{name}"]
+    if name == 'config':
+        return get_config()
+    if name == 'OUTPUT_FORMAT':
+        return output_format()
+    if name == 'MOVIE_SCHEMA':
+        return movie_schema()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def year_dir(region: str, year: int) -> Path:
+    """
+    Subdirectory of data_dir() holding a region's page, merged and normalized outputs of a year
+
+    Args:
+        region: str
+            The country included in the subdirectory's name
+        year: int
+            The year included in the subdirectory's name
+    Returns: Path
+    """
+    return data_dir() / f"{region}_movie_data_{year}"
+
 
 def output_csv(region: str, year: int, df: pd.DataFrame, filename: str) -> None:
     """
@@ -43,41 +180,260 @@ def output_csv(region: str, year: int, df: pd.DataFrame, filename: str) -> None:
             name of the output csv file
     Returns: None
     """
-    data_dir = "./data"
-    output_dir = Path(f"{data_dir}/{region}_movie_data_{year}")
+    output_dir = year_dir(region, year)
     output_dir.mkdir(parents=True, exist_ok=True)
     df.to_csv(output_dir / filename, index=False)
 
 
+def output_parquet(region: str, year: int, df: pd.DataFrame, filename: str) -> None:
+    """
+    Create an output subdirectory and save a parquet file to it, nested columns keep their list/struct types
+
+    Args:
+        region: str
+            The country that the subdirectory will have included in its name
+        year: int
+            The year that the subdirectory will have included in its name
+        df: pd.Dataframe
+            dataframe object to save
+        filename: int
+            name of the output parquet file
+    Returns: None
+    """
+    output_dir = year_dir(region, year)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Movie dataframes are written with movie_schema(), anything else (e.g. normalized tables) keeps its inferred types
+    schema = movie_schema() if list(df.columns) == movie_schema().names else None
+    if schema != None and df.empty:
+        # An empty page's columns are float64, which Arrow can't convert to list<struct>
+        df = schema.empty_table().to_pandas()
+    df.to_parquet(output_dir / filename, index=False, schema=schema)
+
+
+def save_output(region: str, year: int, df: pd.DataFrame, name: str) -> None:
+    """
+    Save a page or merged dataframe in the configured output_format()
+
+    Args:
+        region: str
+            The country that the subdirectory will have included in its name
+        year: int
+            The year that the subdirectory will have included in its name
+        df: pd.Dataframe
+            dataframe object to save
+        name: str
+            name of the output file, without its extension
+    Returns: None
+    """
+    with METRICS.timer('write'):
+        if output_format() == 'csv':
+            output_csv(region, year, df, f"{name}.csv")
+        else:
+            output_parquet(region, year, df, f"{name}.parquet")
+    METRICS.inc('rows', len(df), stage='write')
+
+
+def read_output(path: Path) -> pd.DataFrame:
+    """
+    Read a saved page or merged output, nested columns come back as list[dict].
+    Outputs saved before BUDGET and REVENUE were columns of their own have their FINANCIAL dicts split into them,
+    outputs saved before CREW get an empty one.
+
+    Args:
+        path: Path
+            parquet or csv file to read
+    Returns: pd.DataFrame
+    """
+    if path.suffix == '.parquet':
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path)
+    return restore_types(df, from_csv=path.suffix != '.parquet')
+
+
+def restore_types(df: pd.DataFrame, from_csv: bool) -> pd.DataFrame:
+    """
+    Turn the nested columns of a dataframe read back from a page or merged output into list[dict]
+
+    Args:
+        df: pd.DataFrame
+            dataframe read from parquet or csv
+        from_csv: bool
+            Whether df was read from csv, where nested columns are str
+    Returns: pd.DataFrame
+    """
+    for column in NESTED_COLUMNS + ['FINANCIAL']:
+        if column not in df.columns:
+            continue
+        if from_csv:
+            # Reading from csv converts list and dict types to str.. Convert them back.
+            df[column] = df[column].apply(literal_eval)
+        elif column != 'FINANCIAL':
+            # pyarrow returns list columns as numpy arrays
+            df[column] = df[column].apply(list)
+    if 'FINANCIAL' in df.columns:
+        financial = pd.DataFrame(df.pop('FINANCIAL').tolist(), columns=['budget', 'revenue'], index=df.index)
+        df['BUDGET'] = financial['budget']
+        df['REVENUE'] = financial['revenue']
+    if 'CAST' in df.columns and 'CREW' not in df.columns:
+        df.insert(df.columns.get_loc('CAST') + 1, 'CREW', [[] for _ in range(len(df))])
+    return df
+
+
+def page_files(region: str, year: int) -> list:
+    """
+    List a year's page outputs in page order, merged outputs and any other stray files are ignored
+
+    Args:
+        region: str
+            Country included in the page filenames
+        year: int
+            Year included in the page filenames
+    Returns: list[Path]
+    """
+    sub_dir = year_dir(region, year)
+    pattern = re.compile(rf"{re.escape(region)}_movie_data_{year}-(\d+)\.{output_format()}")
+    pages = []
+    for path in sub_dir.glob(f"*.{output_format()}"):
+        match = pattern.fullmatch(path.name)
+        if match:
+            pages.append((int(match.group(1)), path))
+    return [path for _, path in sorted(pages)]
+
+
+def sort_by_revenue(df: pd.DataFrame, top_n: int=None) -> pd.DataFrame:
+    """
+    Sort a movie dataframe by revenue, highest first
+
+    Args:
+        df: pd.DataFrame
+            dataframe with BUDGET and REVENUE columns
+        top_n: int, default None
+            (Optional) Only keep the top_n highest earning movies, selected without sorting the whole dataframe
+    Returns: pd.DataFrame
+    """
+    df = df.astype({'BUDGET': 'int64', 'REVENUE': 'int64'})
+    if top_n != None:
+        return df.nlargest(top_n, 'REVENUE')
+    return df.sort_values(by='REVENUE', ascending=False, kind='stable')
+
+
+@movies_app.command("cache_info")
+def cache_info(clear: bool=False) -> None:
+    """
+    Show the size of the TMDB response cache, optionally emptying it
+
+    Args:
+        clear: bool, default False
+            (Optional) Remove every cached response
+    Returns: None
+    """
+    init_client()
+    if not isinstance(_sess, CachedSession):
+        print("Response cache is disabled")
+        return
+    if clear:
+        _sess.clear()
+    stats = _sess.stats()
+    print(f"Entries: {stats['entries']}, Size: {stats['bytes']} bytes")
+
+
+def explode_nested(df: pd.DataFrame, column: str, fields: list) -> pd.DataFrame:
+    """
+    Flatten a nested column into one row per list item, keeping the movie id each item belongs to
+
+    Args:
+        df: pd.DataFrame
+            dataframe with an ID column and the nested column
+        column: str
+            Nested column to flatten
+        fields: list[str]
+            Keys of each item to keep as columns
+    Returns: pd.DataFrame with a movie_id column followed by one column per field
+    """
+    exploded = df[['ID', column]].explode(column).dropna(subset=[column])
+    records = pd.DataFrame(exploded[column].tolist(), columns=fields)
+    records.insert(0, 'movie_id', exploded['ID'].to_numpy())
+    return records
+
+
+def normalize(df: pd.DataFrame) -> dict:
+    """
+    Split a wide movie dataframe into flat relational tables, deduplicated on each table's key.
+    When an entity repeats, its last row wins.
+
+    Args:
+        df: pd.DataFrame
+            dataframe of COLUMNS, nested columns holding list[dict]
+    Returns: dict[str, pd.DataFrame] of tables named after their MySQL tables
+    """
+    tables = {}
+    tables['movies'] = pd.DataFrame({'id': df['ID'], 'original_title': df['ORIGINAL_TITLE'], 'title': df['TITLE'],
+                                     'language': df['ORIGINAL_LANGUAGE'], 'release_date': df['RELEASE_DATE']})
+    tables['plots'] = pd.DataFrame({'plot': df['PLOT'], 'movie_id': df['ID']})
+    for column, entity, junction, key in [('GENRES', 'genres', 'movie_genres', 'genre_id'),
+                                          ('DIRECTORS', 'directors', 'movie_directors', 'director_id'),
+                                          ('CAST', 'actors', 'movie_actors', 'actor_id')]:
+        exploded = explode_nested(df, column, ['id', 'name'])
+        tables[entity] = exploded[['id', 'name']]
+        tables[junction] = exploded[['movie_id', 'id']].rename(columns={'id': key})
+    tables['countries'] = explode_nested(df, 'PRODUCTION_COUNTRIES', ['iso_3166_1', 'name']) \
+        .drop(columns='movie_id').rename(columns={'iso_3166_1': 'id'})
+    tables['companies'] = explode_nested(df, 'PRODUCTION_COMPANIES', ['id', 'name', 'origin_country']) \
+        .drop(columns='movie_id').rename(columns={'origin_country': 'country'})
+    tables['movie_revenue'] = pd.DataFrame({'movie_id': df['ID'], 'revenue': df['REVENUE'], 'budget': df['BUDGET']})
+    for name, table in tables.items():
+        tables[name] = table.drop_duplicates(subset=TABLE_KEYS[name], keep='last').reset_index(drop=True)
+    return tables
+
+
+def save_tables(region: str, year: int, tables: dict) -> None:
+    """
+    Save a year's normalized tables next to its merged output
+
+    Args:
+        region: str
+            The country that the subdirectory will have included in its name
+        year: int
+            The year that the subdirectory will have included in its name
+        tables: dict[str, pd.DataFrame]
+            Returned from normalize()
+    Returns: None
+    """
+    for name, table in tables.items():
+        save_output(region, year, table, f"{region}_movie_data_{year}-merged-{name}")
+
+
 @movies_app.command("merge_dfs")
-def merge_dfs(region: str, year: int, missing=None) -> pd.DataFrame:
+def merge_dfs(region: str, year: int, missing=None, csv: bool=False, top_n: int=None) -> pd.DataFrame:
     """
-    Create and save a merged dataframe from related csv's
+    Create and save a merged dataframe from related page outputs
     If called from within main(), will only merge if there are no missing pages for the selected year
 
     Args:
         region: str
-            Country that will be included in the csv filename
+            Country that will be included in the output filename
         year: int
-            Year that will be included in the csv filename
+            Year that will be included in the output filename
         missing: dict, default None
             (Optional) The dictionary to check for any pages missing
+        csv: bool, default False
+            (Optional) Also export the merged dataframe to csv
+        top_n: int, default None
+            (Optional) Only keep the year's top_n highest earning movies
     Returns: pd.DataFrame
     """
     if missing == None or missing[year] == []:
-        sub_dir = Path(f"./data/{region}_movie_data_{year}")
         try:
-            # IGNORE MERGED CSV's, IF ANY
-            csv_list = [file for file in sub_dir.glob("**/*") if 'merged' not in file.name]
+            page_list = page_files(region, year)
             logger.info(f"Merging {region} movie dataframes for YEAR: {year}")
-            df = pd.concat([pd.read_csv(csv) for csv in csv_list])
-            df.drop_duplicates(inplace=True)
-            # Reading from csv converts dict types to str.. Convert back to dict to sort by values.
-            df['FINANCIAL'] = df['FINANCIAL'].apply(literal_eval)
-            df.sort_values(by=['FINANCIAL'], key=lambda k: k.apply(lambda x: x['revenue']), ascending=False, inplace=True)
-            logger.info("Saving merged dataframe to csv file")
-            filename = f"{region}_movie_data_{year}-merged.csv"
-            output_csv(region=region, year=year, df=df, filename=filename)
+            df = pd.concat([read_output(page) for page in page_list])
+            df.drop_duplicates(subset=['ID'], inplace=True)
+            df = sort_by_revenue(df, top_n)
+            logger.info(f"Saving merged dataframe to {output_format()} file")
+            save_output(region=region, year=year, df=df, name=f"{region}_movie_data_{year}-merged")
+            if csv and output_format() != 'csv':
+                output_csv(region=region, year=year, df=df, filename=f"{region}_movie_data_{year}-merged.csv")
             return df
         except ValueError as e:
             logger.info(e)
@@ -98,10 +454,68 @@ def list_pages(region: str, year: int) -> list:
             Year to filter by
     Returns: a list[int] of all pages returned from search response
     """
-    response = discover.movie(region=region, primary_release_year=year, include_adult=False, with_runtime_gte='40')
+    return discover_year(region, year)[1]
+
+
+def configure_client(max_in_flight: int) -> None:
+    """
+    Size the TMDB client for a number of worker threads, the concurrency limit and the connection pool both match it
+
+    Args:
+        max_in_flight: int
+            Requests allowed in flight at once
+    Returns: None
+    """
+    init_client()
+    _limiter.reset(max_in_flight)
+    _adapter.resize(get_config().get('pool_size', max_in_flight))
+    POOL_STATS.reset()
+
+
+def client_stats() -> dict:
+    """
+    Connection reuse, pool and limiter wait times and throttling of the TMDB client
+
+    Returns: dict[str, float]
+    """
+    init_client()
+    return {**POOL_STATS.snapshot(), 'limiter_wait': round(_limiter.waited, 3), 'throttled': _limiter.throttled,
+            'limit': int(_limiter.limit)}
+
+
+def discover_movies(region: str, year: int, page: int=1) -> dict:
+    """
+    Send a discover.movie() request with its own Discover object so responses are never shared between threads
+
+    Args:
+        region: str
+            Country to filter by
+        year: int
+            Year to filter by
+        page: int, default 1
+            Page number to send a request to
+    Returns: dict of the discover response
+    """
+    init_client()
+    with METRICS.timer('discover'):
+        return tmdb.Discover().movie(region=region, page=page, primary_release_year=year, include_adult=False, with_runtime_gte='40')
+
+
+def discover_year(region: str, year: int) -> tuple:
+    """
+    Send the first discover.movie() request of a year, keeping its response so page 1 is never requested twice
+
+    Args:
+        region: str
+            Country to filter by
+        year: int
+            Year to filter by
+    Returns: tuple[int, list[int], dict] of the year, all of its pages and the page 1 response
+    """
+    response = with_retries(discover_movies, region, year)
     pages = [page for page in range(1, response['total_pages'] + 1)]
     logger.info(f"YEAR {year}: PAGES {pages}")
-    return pages
+    return year, pages, response
 
 
 def get_gen_info(movie: tmdb.Movies) -> tuple:
@@ -147,27 +561,42 @@ def get_directors(movie_credits: dict) -> list:
         return crew_list
 
 
-def get_cast(movie_credits: dict) -> list:
+def get_cast(movie_credits: dict, limit: int=None, fields: list=('id', 'name')) -> list:
     """
     Get a movie's cast members
 
     Args:
         movie_credits: Dict
             returned from the tmdb.Movies.credits() method
+        limit: int, default None
+            (Optional) Only keep the top billed cast members, lowest order first
+        fields: list[str], default ('id', 'name')
+            Keys kept of each cast member, everything else is unnecessary
     Returns: list[dict]
     """
     cast_list = movie_credits['cast']
-    # New list will contain a dict of only the 'id' and 'name' key-value pairs, everything else is unnecessary
-    new_cast_list = []
-    if cast_list != []:
-        for member in cast_list:
-            cast_dict = {}
-            cast_dict['id'] = member['id']
-            cast_dict['name'] = member['name']
-            new_cast_list.append(cast_dict) if cast_dict != {} else None
-        return new_cast_list
-    else:
-        return cast_list
+    if limit != None:
+        cast_list = heapq.nsmallest(limit, cast_list, key=lambda member: member.get('order', len(cast_list)))
+    return [{field: member.get(field) for field in fields} for member in cast_list]
+
+
+def get_crew(movie_credits: dict, jobs: list, fields: list=('id', 'name', 'job')) -> list:
+    """
+    Get a movie's crew members with one of the jobs, e.g. ['Screenplay', 'Writer', 'Producer']
+
+    Args:
+        movie_credits: Dict
+            returned from the tmdb.Movies.credits() method
+        jobs: list[str]
+            Jobs of the crew members kept
+        fields: list[str], default ('id', 'name', 'job')
+            Keys kept of each crew member
+    Returns: list[dict]
+    """
+    if jobs == []:
+        return []
+    jobs = set(jobs)
+    return [{field: member.get(field) for field in fields} for member in movie_credits['crew'] if member['job'] in jobs]
 
 
 def get_funders(movie: tmdb.Movies) -> tuple:
@@ -205,10 +634,133 @@ def get_financials(movie: tmdb.Movies) -> dict:
     return finance_dict
 
 
+class MovieRecord(NamedTuple):
+    """
+    A movie's extracted data, one field per column of COLUMNS. A page of records holds only what is kept,
+    not the tmdb.Movies objects and full credit lists it was extracted from
+    """
+    ID: int
+    TITLE: str
+    ORIGINAL_TITLE: str
+    RELEASE_DATE: str
+    ORIGINAL_LANGUAGE: str
+    PLOT: str
+    DIRECTORS: list
+    CAST: list
+    CREW: list
+    GENRES: list
+    PRODUCTION_COUNTRIES: list
+    PRODUCTION_COMPANIES: list
+    BUDGET: int
+    REVENUE: int
+
+
+def extract_movie(movie_id: int, movie: tmdb.Movies, movie_credits: dict) -> MovieRecord:
+    """
+    Extract a movie's data, its credits projected with credit_options()
+
+    Args:
+        movie_id: int
+            TMDB id of the movie
+        movie: tmdb.Movies object
+            Object containing the required data to extract
+        movie_credits: dict
+            Credits returned alongside or from the tmdb.Movies.credits() method
+    Returns: MovieRecord
+    """
+    gen_info = get_gen_info(movie)
+    funders = get_funders(movie)
+    financials = get_financials(movie)
+    options = credit_options()
+    return MovieRecord(movie_id, *gen_info, get_directors(movie_credits),
+                       get_cast(movie_credits, options['cast_limit'], options['cast_fields']),
+                       get_crew(movie_credits, options['crew_jobs'], options['crew_fields']), movie.genres,
+                       funders[0], funders[1], financials['budget'], financials['revenue'])
+
+
+class MovieBatch:
+    """
+    Column builder of a page of movies shared by every fetch path. Records are written straight into columns
+    pre-sized for the movies expected, which become the dataframe's (or Arrow table's) columns as they are
+
+    Args:
+        size: int
+            Number of movies expected, more can still be added
+    """
+    __slots__ = ('columns', 'count')
+
+    def __init__(self, size: int=0) -> None:
+        self.columns = {column: [None] * size for column in COLUMNS}
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, record: MovieRecord) -> None:
+        """
+        Add a movie's record to the columns
+        """
+        if self.count < len(self.columns['ID']):
+            for column, value in zip(self.columns.values(), record):
+                column[self.count] = value
+        else:
+            for column, value in zip(self.columns.values(), record):
+                column.append(value)
+        self.count += 1
+
+    def _trim(self) -> None:
+        # Slots of movies that failed are dropped
+        for column in self.columns.values():
+            del column[self.count:]
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Dataframe of the movies added, with COLUMNS
+        """
+        self._trim()
+        return pd.DataFrame(self.columns, columns=COLUMNS)
+
+    def to_arrow(self) -> pa.Table:
+        """
+        Arrow table of the movies added, with movie_schema()
+        """
+        self._trim()
+        return pa.Table.from_pydict(self.columns, schema=movie_schema())
+
+
+def fetch_movie(movie_id: int, append: str='credits') -> tuple:
+    """
+    Retrieve a movie's details and credits, in a single request when possible
+
+    Args:
+        movie_id: int
+            TMDB id of the movie to retrieve
+        append: str, default 'credits'
+            Comma separated sub-resources to request with append_to_response.
+            If 'credits' is not included, credits are fetched with a second request
+    Returns: tuple[tmdb.Movies, dict]
+    """
+    sub_resources = [resource.strip() for resource in append.split(',') if resource.strip() != '']
+    init_client()
+    movie = tmdb.Movies(movie_id)
+    # With credits appended, their time is part of movie_info
+    with METRICS.timer('movie_info'):
+        if sub_resources != []:
+            response = movie.info(append_to_response=','.join(sub_resources))
+        else:
+            response = movie.info()
+    if 'credits' in sub_resources:
+        credits = response['credits']
+    else:
+        with METRICS.timer('credits'):
+            credits = movie.credits()
+    return movie, credits
+
+
 @movies_app.command("get_data")
-def get_data(region: str, year: int, page: int=1, output=True) -> tuple:
+def get_data(region: str, year: int, page: int=1, output=True, append: str='credits') -> tuple:
     """
-    Obtain metadata for each film returned from discover.movie() response
+    Obtain metadata for each film returned from a discover.movie() request
 
     Args:
         region: str
@@ -218,46 +770,90 @@ def get_data(region: str, year: int, page: int=1, output=True) -> tuple:
         page: int
             Page number to send a request to
         output: bool, default True
-            Save data to csv output
-    Returns: tuple[str, int, int, pd.DataFrame]
+            Save data to output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+    Returns: tuple[str, int, int, pd.DataFrame, list[int]], see get_page_data()
     """
-    data_dict = {'ID': [], 'TITLE': [], 'ORIGINAL_TITLE': [], 'RELEASE_DATE': [], 'ORIGINAL_LANGUAGE': [], 'PLOT': [], 'DIRECTORS': [], 'CAST': [], 'GENRES': [], 'PRODUCTION_COUNTRIES': [], 'PRODUCTION_COMPANIES': [], 'FINANCIAL': []}
-    failed_page = None
-    response = discover.movie(region=region, page=page, primary_release_year=year, include_adult=False, with_runtime_gte='40')
     try:
-        for result in discover.results:
-            movie = tmdb.Movies(result['id'])
-            movie.info()
-            credits = movie.credits()
-            data_dict['ID'].append(result['id'])
-            gen_info = get_gen_info(movie)
-            data_dict['TITLE'].append(gen_info[0])
-            data_dict['ORIGINAL_TITLE'].append(gen_info[1])
-            data_dict['RELEASE_DATE'].append(gen_info[2])
-            data_dict['ORIGINAL_LANGUAGE'].append(gen_info[3])
-            data_dict['PLOT'].append(gen_info[4])
-            data_dict['DIRECTORS'].append(get_directors(credits))
-            data_dict['CAST'].append(get_cast(credits))
-            data_dict['GENRES'].append(movie.genres)
-            funders = get_funders(movie)
-            data_dict['PRODUCTION_COUNTRIES'].append(funders[0])
-            data_dict['PRODUCTION_COMPANIES'].append(funders[1])
-            data_dict['FINANCIAL'].append(get_financials(movie))
-
-        df = pd.DataFrame(data_dict)
-        df.sort_values(by=['FINANCIAL'], key=lambda k: k.apply(lambda x: x['revenue']), ascending=False, inplace=True)
-        filename = f"{region}_movie_data_{year}-{page}.csv"
-        if output:
-            logger.info(f"Saving YEAR: {year}, PAGE: {page} to csv")
-            output_csv(region, year, df, filename)
+        response = with_retries(discover_movies, region, year, page)
     except requests.exceptions.RequestException as e:
         logger.info(e)
         logger.info(f"Failed to get YEAR: {year}, PAGE: {page}")
-        failed_page = page
-    return region, year, failed_page, df
+        return region, year, page, None, []
+    return get_page_data(region, year, page, response, output, append)
 
 
-def retry_missing(region: str, year: int, mssng_pages, output=True) -> dict:
+def get_page_data(region: str, year: int, page: int, response: dict, output=True, append: str='credits') -> tuple:
+    """
+    Obtain metadata for each film of an already retrieved discover.movie() response
+
+    Args:
+        region: str
+            Country the response was filtered by
+        year: int
+            Year the response was filtered by
+        page: int
+            Page number of the response
+        response: dict
+            Returned from discover.movie()
+        output: bool, default True
+            Save data to output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+    Returns: tuple[str, int, int, pd.DataFrame, list[int]] of the region, year, the page if any movie failed,
+        the movies retrieved and the ids of the movies that failed
+    """
+    return fetch_page_movies(region, year, page, [result['id'] for result in response['results']], output, append)
+
+
+def fetch_page_movies(region: str, year: int, page: int, ids: list, output=True, append: str='credits',
+                      keep_saved: bool=False) -> tuple:
+    """
+    Fetch movies of a page one by one, a failed movie is recorded by id and the rest of the page is kept
+
+    Args:
+        region: str
+            Country the page was filtered by
+        year: int
+            Year the page was filtered by
+        page: int
+            Page number the movies are listed on
+        ids: list[int]
+            Ids of the movies to fetch
+        output: bool, default True
+            Save the page's movies to output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+        keep_saved: bool, default False
+            Add the movies to those already saved for the page, so only the ids that failed need fetching again
+    Returns: tuple[str, int, int, pd.DataFrame, list[int]], see get_page_data()
+    """
+    batch = MovieBatch(len(ids))
+    failed_ids = []
+    for movie_id in ids:
+        try:
+            movie, credits = with_retries(fetch_movie, movie_id, append)
+            with METRICS.timer('extract'):
+                batch.add(extract_movie(movie_id, movie, credits))
+        except requests.exceptions.RequestException as e:
+            logger.info(e)
+            logger.info(f"Failed to get MOVIE: {movie_id} of YEAR: {year}, PAGE: {page}")
+            failed_ids.append(movie_id)
+
+    df = batch.to_frame()
+    saved = year_dir(region, year) / f"{region}_movie_data_{year}-{page}.{output_format()}"
+    if keep_saved and saved.exists():
+        df = pd.concat([read_output(saved), df])
+        df = df.drop_duplicates(subset=['ID'], keep='last')
+    df = sort_by_revenue(df)
+    if output:
+        logger.info(f"Saving YEAR: {year}, PAGE: {page} to {output_format()}")
+        save_output(region, year, df, f"{region}_movie_data_{year}-{page}")
+    return region, year, page if failed_ids != [] else None, df, failed_ids
+
+
+def retry_missing(region: str, year: int, mssng_pages, output=True, append: str='credits') -> dict:
     """
     Attempt to retrieve any missing pages from earlier failed requests
 
@@ -269,44 +865,18 @@ def retry_missing(region: str, year: int, mssng_pages, output=True) -> dict:
         mssng_pages: dict
             Dictionary consisting of key-value pairs of {year: [list of page numbers missing]}
         output: bool, default True
-            Save data to csv output
+            Save data to output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
     Returns: dict[int, list[int]] of any pages still missing
     """
-    data_dict = {'ID': [], 'TITLE': [], 'ORIGINAL_TITLE': [], 'RELEASE_DATE': [], 'ORIGINAL_LANGUAGE': [], 'PLOT': [], 'DIRECTORS': [], 'CAST': [], 'GENRES': [], 'PRODUCTION_COUNTRIES': [], 'PRODUCTION_COMPANIES': [], 'FINANCIAL': []}
     logger.info("Attempting retrieval of missing pages...")
     for page in mssng_pages[year][:]:
-        try:
-            response = discover.movie(region=region, page=page, primary_release_year=year, include_adult=False, with_runtime_gte='40')
-            for result in discover.results:
-                movie = tmdb.Movies(result['id'])
-                movie.info()
-                credits = movie.credits()
-                data_dict['ID'].append(result['id'])
-                gen_info = get_gen_info(movie)
-                data_dict['TITLE'].append(gen_info[0])
-                data_dict['ORIGINAL_TITLE'].append(gen_info[1])
-                data_dict['RELEASE_DATE'].append(gen_info[2])
-                data_dict['ORIGINAL_LANGUAGE'].append(gen_info[3])
-                data_dict['PLOT'].append(gen_info[4])
-                data_dict['DIRECTORS'].append(get_directors(credits))
-                data_dict['CAST'].append(get_cast(credits))
-                data_dict['GENRES'].append(movie.genres)
-                funders = get_funders(movie)
-                data_dict['PRODUCTION_COUNTRIES'].append(funders[0])
-                data_dict['PRODUCTION_COMPANIES'].append(funders[1])
-                data_dict['FINANCIAL'].append(get_financials(movie))
-
-            df = pd.DataFrame(data_dict)
-            df.sort_values(by=['FINANCIAL'], key=lambda k: k.apply(lambda x: x['revenue']), ascending=False, inplace=True)
-            filename = f"{region}_movie_data_{year}-{page}.csv"
-            if output:
-                output_csv(region, year, df, filename)
-                logger.info(f"Successful retrieval of: YEAR {year} PAGE {page}")
+        if get_data(region, year, page, output, append)[2] == None:
+            logger.info(f"Successful retrieval of: YEAR {year} PAGE {page}")
             mssng_pages[year].remove(page)
             logger.info(mssng_pages)
-            data_dict = {'ID': [], 'TITLE': [], 'ORIGINAL_TITLE': [], 'RELEASE_DATE': [], 'ORIGINAL_LANGUAGE': [], 'PLOT': [], 'DIRECTORS': [], 'CAST': [], 'GENRES': [], 'PRODUCTION_COUNTRIES': [], 'PRODUCTION_COMPANIES': [], 'FINANCIAL': []}
-        except requests.exceptions.RequestException as e:
-            logger.info(e)
+        else:
             logger.info(f"Failed retrieval of: YEAR {year} PAGE {page}")
     return mssng_pages
 
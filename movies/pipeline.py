@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+
+from .movies import logger
+
+# Marks the end of a stage's input, one per worker thread
+_DONE = object()
+
+
+class Stage:
+    """
+    Pipeline stage: worker threads take items from a bounded queue, process them with func and pass
+    any result that is not None on to the next stage. put() blocks while the queue is full, so a slow
+    stage holds back the stages feeding it instead of letting work pile up in memory
+
+    Args:
+        name: str
+            Name used in logs and stats
+        func: callable
+            Processes one item, returns the item for the next stage or None
+        workers: int
+            Items processed at once
+        maxsize: int
+            Items allowed to wait in the stage's queue
+        downstream: Stage, default None
+            (Optional) Stage receiving this stage's results
+    """
+    def __init__(self, name: str, func, workers: int=1, maxsize: int=2, downstream=None) -> None:
+        self.name = name
+        self.func = func
+        self.downstream = downstream
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.errors = []
+        self.processed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{worker}", daemon=True) for worker in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item) -> None:
+        """
+        Hand an item to the stage, waiting while its queue is full
+        """
+        tm1 = time.perf_counter()
+        self.queue.put(item)
+        with self._lock:
+            self.blocked += time.perf_counter() - tm1
+
+    def close(self) -> None:
+        """
+        Wait for every queued item to be processed, then close the downstream stage
+        """
+        for _ in self.threads:
+            self.queue.put(_DONE)
+        for thread in self.threads:
+            thread.join()
+        if self.downstream != None:
+            self.downstream.close()
+
+    def stats(self) -> dict:
+        """
+        Items processed, seconds spent processing them and seconds producers waited on the full queue
+
+        Returns: dict[str, float]
+        """
+        with self._lock:
+            return {'processed': self.processed, 'errors': len(self.errors), 'busy': round(self.busy, 3),
+                    'blocked': round(self.blocked, 3)}
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                return
+            tm1 = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                logger.exception(f"Stage {self.name} failed on {item}")
+                with self._lock:
+                    self.errors.append((item, e))
+                continue
+            finally:
+                with self._lock:
+                    self.busy += time.perf_counter() - tm1
+            with self._lock:
+                self.processed += 1
+            if result is not None and self.downstream != None:
+                self.downstream.put(result)
@@ -0,0 +1,184 @@
+import email.utils
+import logging
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+
+from .metrics import METRICS
+
+logger: logging.Logger = logging
+
+# (connect, read) timeouts in seconds, a hung request fails fast and is retried instead of stalling a worker
+TIMEOUT = (5, 30)
+# Attempts per movie request and per page before giving up
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+
+
+def retry_after(response: requests.Response) -> float:
+    """
+    Seconds a response asks the client to wait before retrying
+
+    Args:
+        response: requests.Response
+            Response that may carry a Retry-After header, in seconds or as an HTTP date
+    Returns: float, or None if the response has no usable Retry-After header
+    """
+    if response is None or 'Retry-After' not in response.headers:
+        return None
+    value = response.headers['Retry-After']
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, wait: float=None) -> float:
+    """
+    Delay before the next attempt, exponential with full jitter so retries don't arrive in lockstep.
+    A server requested wait is always honored
+
+    Args:
+        attempt: int
+            Number of attempts already made
+        wait: float, default None
+            (Optional) Seconds requested by a Retry-After header
+    Returns: float
+    """
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    if wait != None:
+        return wait + delay / 4
+    return delay
+
+
+def retryable(e: requests.exceptions.RequestException) -> bool:
+    """
+    Whether a failed request is worth retrying: connection errors, timeouts, 429s and server errors
+    """
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(e, 'response', None)
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
+
+
+def with_retries(func, *args, attempts: int=MAX_ATTEMPTS, **kwargs):
+    """
+    Call func, retrying retryable request failures with jittered backoff that honors Retry-After
+
+    Args:
+        func: callable
+            Function sending one or more TMDB requests
+        attempts: int, default MAX_ATTEMPTS
+            Attempts before the last failure is raised
+    Returns: whatever func returns
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if attempt == attempts - 1 or not retryable(e):
+                raise
+            delay = backoff(attempt + 1, retry_after(getattr(e, 'response', None)))
+            METRICS.inc('retries', call=getattr(func, '__name__', 'call'))
+            logger.info(f"{e}, retrying in {delay:0.2f}s")
+            time.sleep(delay)
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit shared by every thread sending TMDB requests. The limit grows by one request per
+    limit successes and halves when TMDB answers 429, pausing everyone for its Retry-After
+
+    Args:
+        limit: int
+            Starting and maximum number of requests in flight
+        min_limit: int
+            The limit never shrinks below this
+        cooldown: float
+            Seconds after a decrease during which further 429s don't shrink the limit again
+    """
+    def __init__(self, limit: int=20, min_limit: int=1, cooldown: float=1.0) -> None:
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self._cond = threading.Condition()
+
+    def reset(self, limit: int) -> None:
+        """
+        Change the maximum number of requests in flight
+        """
+        with self._cond:
+            self.max_limit = limit
+            self.limit = float(limit)
+            self._cond.notify_all()
+
+    def acquire(self) -> None:
+        """
+        Wait for a free slot, and for any Retry-After pause to pass
+        """
+        tm1 = time.perf_counter()
+        with self._cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._cond.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+            self.waited += time.perf_counter() - tm1
+
+    def release(self, throttled: bool=False, wait: float=None) -> None:
+        """
+        Free a slot, additively increasing the limit on success and multiplicatively decreasing it on a 429
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled += 1
+                if now - self.decreased_at >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.decreased_at = now
+                    logger.info(f"TMDB throttled, concurrency limit lowered to {int(self.limit)}")
+                if wait != None:
+                    self.paused_until = max(self.paused_until, now + wait)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that sends every request through an AIMDLimiter, so 429s shrink concurrency across all threads
+
+    Args:
+        limiter: AIMDLimiter
+            Limiter shared by every request of the session
+    """
+    def __init__(self, limiter: AIMDLimiter, **kwargs) -> None:
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs) -> requests.Response:
+        self.limiter.acquire()
+        throttled = False
+        wait = None
+        try:
+            response = super().send(request, **kwargs)
+            throttled = response.status_code == 429
+            wait = retry_after(response) if throttled else None
+            return response
+        finally:
+            self.limiter.release(throttled, wait)
@@ -0,0 +1,215 @@
+import concurrent.futures
+import json
+import os
+from pathlib import Path
+import requests
+import socket
+import sqlite3
+import threading
+import time
+
+from .config import data_dir
+from .movies import discover_year, fetch_page_movies, get_data, logger
+from .retry import MAX_ATTEMPTS
+
+# Saved under data_dir() unless a crawl is given its own queue file
+QUEUE_FILE = 'work_queue.sqlite'
+# Seconds a claimed unit may run before another worker takes it over, e.g. after its worker died
+LEASE = 60 * 10
+# Seconds an idle worker waits before looking for new units
+POLL = 1.0
+
+
+class WorkQueue:
+    """
+    SQLite work queue of (region, year, page) units shared by worker processes, on one machine or several
+    sharing the file. Page 0 of a year is its discover unit, which enqueues the year's pages once processed
+
+    Args:
+        path: str
+            Location of the SQLite queue file, QUEUE_FILE under data_dir() by default
+        lease: float
+            Seconds before a claimed unit that was never completed can be claimed again
+    """
+    def __init__(self, path: str=None, lease: float=LEASE) -> None:
+        path = path if path != None else str(data_dir() / QUEUE_FILE)
+        self.lease = lease
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS units (
+                            region TEXT, year INTEGER, page INTEGER, ids TEXT, state TEXT, worker TEXT,
+                            attempts INTEGER, claimed_at REAL, PRIMARY KEY (region, year, page))""")
+
+    def reset(self) -> None:
+        """
+        Remove every unit
+        """
+        with self._lock:
+            self.conn.execute("DELETE FROM units")
+
+    def enqueue(self, units: list) -> None:
+        """
+        Add (region, year, page) units, units already queued or processed are left as they are
+        """
+        with self._lock:
+            self.conn.executemany("INSERT OR IGNORE INTO units VALUES (?, ?, ?, NULL, 'queued', NULL, 0, NULL)", units)
+
+    def claim(self, worker: str) -> tuple:
+        """
+        Take the next unit, discover units first so pages are known as early as possible
+
+        Args:
+            worker: str
+                Name of the claiming worker
+        Returns: tuple[str, int, int, list[int]] of the unit and the movie ids left to fetch (None for the whole page),
+            or None if no unit is available
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("""SELECT region, year, page, ids FROM units
+                                        WHERE state = 'queued' OR (state = 'claimed' AND claimed_at < ?)
+                                        ORDER BY page != 0, year, page LIMIT 1""", (now - self.lease,)).fetchone()
+                if row != None:
+                    self.conn.execute("""UPDATE units SET state = 'claimed', worker = ?, claimed_at = ?, attempts = attempts + 1
+                                      WHERE region = ? AND year = ? AND page = ?""", (worker, now, *row[:3]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row == None:
+            return None
+        return row[0], row[1], row[2], json.loads(row[3]) if row[3] != None else None
+
+    def complete(self, region: str, year: int, page: int, failed_ids: list=None) -> None:
+        """
+        Mark a unit done, or queue it again with the movie ids that failed (an empty list retries the whole page).
+        A unit that failed MAX_ATTEMPTS times is marked failed
+        """
+        with self._lock:
+            if failed_ids == None:
+                self.conn.execute("UPDATE units SET state = 'done', ids = NULL WHERE region = ? AND year = ? AND page = ?",
+                                  (region, year, page))
+            else:
+                self.conn.execute("""UPDATE units SET state = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, ids = ?
+                                  WHERE region = ? AND year = ? AND page = ?""",
+                                  (MAX_ATTEMPTS, json.dumps(failed_ids) if failed_ids != [] else None, region, year, page))
+
+    def counts(self) -> dict:
+        """
+        Number of units in each state
+
+        Returns: dict[str, int]
+        """
+        with self._lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM units GROUP BY state").fetchall())
+
+    def active(self) -> int:
+        """
+        Number of units queued or being processed
+        """
+        counts = self.counts()
+        return counts.get('queued', 0) + counts.get('claimed', 0)
+
+    def pages(self, region: str, year: int) -> dict:
+        """
+        State of every page unit of a year, its discover unit excluded
+
+        Returns: dict[int, str]
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT page, state FROM units WHERE region = ? AND year = ? AND page != 0 ORDER BY page",
+                                     (region, year)).fetchall()
+        return dict(rows)
+
+    def missing(self, region: str) -> dict:
+        """
+        Pages of a region that could not be fetched, by year. A failed discover unit is reported as page 0
+
+        Returns: dict[int, list[int]]
+        """
+        with self._lock:
+            years = self.conn.execute("SELECT DISTINCT year FROM units WHERE region = ? ORDER BY year", (region,)).fetchall()
+            failed = self.conn.execute("SELECT year, page FROM units WHERE region = ? AND state != 'done' ORDER BY year, page",
+                                       (region,)).fetchall()
+        missing = {year: [] for (year,) in years}
+        for year, page in failed:
+            missing[year].append(page)
+        return missing
+
+
+def process_unit(queue: WorkQueue, region: str, year: int, page: int, ids: list=None, append: str='credits') -> None:
+    """
+    Process a claimed unit and record its outcome in the queue
+
+    Args:
+        queue: WorkQueue
+            Queue the unit was claimed from
+        region: str
+            Country of the unit
+        year: int
+            Year of the unit
+        page: int
+            Page of the unit, 0 discovers the year and enqueues its pages
+        ids: list[int], default None
+            (Optional) Only fetch these movies, adding them to the page's saved output
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+    Returns: None
+    """
+    if page == 0:
+        try:
+            pages = discover_year(region, year)[1]
+        except requests.exceptions.RequestException as e:
+            logger.info(e)
+            logger.info(f"Failed to discover REGION: {region}, YEAR: {year}")
+            queue.complete(region, year, page, [])
+            return
+        queue.enqueue([(region, year, number) for number in pages])
+        queue.complete(region, year, page)
+        return
+    if ids != None:
+        _, _, failed_page, df, failed_ids = fetch_page_movies(region, year, page, ids, True, append, keep_saved=True)
+    else:
+        _, _, failed_page, df, failed_ids = get_data(region, year, page, True, append)
+    queue.complete(region, year, page, None if failed_page == None else failed_ids)
+
+
+def work(path: str=None, append: str='credits', threads: int=1, worker: str=None) -> int:
+    """
+    Worker loop: claim and process units until the queue has nothing left queued or in progress
+
+    Args:
+        path: str, default None
+            (Optional) Location of the SQLite queue file, QUEUE_FILE under data_dir() by default.
+            All workers of a crawl share it and write to the same data_dir()
+        append: str, default 'credits'
+            Sub-resources requested alongside each movie's details, see fetch_movie()
+        threads: int, default 1
+            Units processed at once by this worker
+        worker: str, default None
+            (Optional) Name of the worker, defaults to its host and process id
+    Returns: int of the number of units processed
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue(path)
+
+    def loop(name: str) -> int:
+        processed = 0
+        while True:
+            unit = queue.claim(name)
+            if unit == None:
+                if queue.active() == 0:
+                    return processed
+                time.sleep(POLL)
+                continue
+            process_unit(queue, *unit, append=append)
+            processed += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        processed = sum(executor.map(loop, [f"{worker}-{thread}" for thread in range(threads)]))
+    logger.info(f"Worker {worker} processed {processed} units")
+    return processed
@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+import asyncio
+import base64
+from functools import partial
+import hashlib
+import logging
+from logging import INFO
+import movies
+from movies.config import data_dir, get_config
+from movies.lazy import LazyModule
+from pathlib import Path
+import sqlite3
+import sys
+import threading
+
+logging.basicConfig(format='[%(levelname)-5s][%(asctime)s][%(module)s:%(lineno)04d] : %(message)s',
+                    level=INFO,
+                    stream=sys.stderr)
+logger: logging.Logger = logging
+
+pd = LazyModule('pandas')
+
+
+class SinkError(RuntimeError):
+    """
+    A year could not be written to a sink, it is not recorded as loaded
+    """
+
+
+class Sink(ABC):
+    """
+    Destination of merged years. A write receives a whole year, its merged dataframe and its normalized tables,
+    so every backend can batch it however suits it best. Backends only connect to their service when first used
+    """
+    name = 'sink'
+
+    @abstractmethod
+    def write(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        """
+        Write a merged year
+
+        Args:
+            region: str
+                Country of the year
+            year: int
+                Year written
+            df: pd.DataFrame
+                Merged dataframe of COLUMNS
+            tables: dict[str, pd.DataFrame]
+                Normalized tables of df, see movies.normalize()
+        Returns: None, raises SinkError if the year could not be written
+        """
+
+    async def awrite(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        """
+        Awaitable write(), blocking backends run on the event loop's default executor
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, partial(self.write, region, year, df, tables))
+
+    def close(self) -> None:
+        """
+        Release the backend's connections
+        """
+        pass
+
+
+class LocalSink(Sink):
+    """
+    Write every year as parquet (or csv) files under a local directory
+
+    Args:
+        root: str
+            Directory the files are written to, one sub directory per region and year. sink under data_dir() by default
+        output_format: str
+            'parquet' or 'csv'
+    """
+    name = 'local'
+
+    def __init__(self, root: str=None, output_format: str='parquet') -> None:
+        self.root = Path(root) if root != None else data_dir() / 'sink'
+        self.output_format = output_format
+
+    def write(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        year_dir = self.root / region / str(year)
+        year_dir.mkdir(parents=True, exist_ok=True)
+        for name, frame in {'merged': df, **tables}.items():
+            if self.output_format == 'parquet':
+                schema = movies.movie_schema() if list(frame.columns) == movies.movie_schema().names else None
+                frame.to_parquet(year_dir / f"{name}.parquet", index=False, schema=schema)
+            else:
+                frame.to_csv(year_dir / f"{name}.csv", index=False)
+
+
+class SQLiteSink(Sink):
+    """
+    Upsert every normalized table into a SQLite database, one transaction per year
+
+    Args:
+        path: str
+            Location of the SQLite database, movies.sqlite under data_dir() by default
+    """
+    name = 'sqlite'
+
+    def __init__(self, path: str=None) -> None:
+        self.path = path if path != None else str(data_dir() / 'movies.sqlite')
+        self.conn = None
+        self._lock = threading.Lock()
+
+    def write(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        with self._lock:
+            if self.conn == None:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self.conn:
+                for name, table in tables.items():
+                    columns = ', '.join(f'"{column}"' for column in table.columns)
+                    key = movies.TABLE_KEYS.get(name)
+                    key = f'"{key}"' if key != None else columns
+                    self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" ({columns}, PRIMARY KEY ({key}))')
+                    self.conn.executemany(f'INSERT OR REPLACE INTO "{name}" ({columns}) VALUES ({", ".join("?" * len(table.columns))})',
+                                          table.astype(object).where(table.notna(), None).itertuples(index=False, name=None))
+        logger.info(f"Loaded YEAR: {year} into {self.path}")
+
+    def close(self) -> None:
+        if self.conn != None:
+            self.conn.close()
+            self.conn = None
+
+
+class MySQLSink(Sink):
+    """
+    Load every year into MySQL with the batched upserts, or staged LOAD DATA files, of storage.py
+
+    Args:
+        chunk_size: int
+            Rows sent per multi-row INSERT
+        infile: bool
+            Load through LOAD DATA LOCAL INFILE instead
+    """
+    name = 'mysql'
+
+    def __init__(self, chunk_size: int=1000, infile: bool=False) -> None:
+        self.chunk_size = chunk_size
+        self.infile = infile
+
+    def write(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        import storage
+        if self.infile:
+            loaded = storage.to_mysql_infile(df=df, year=year, tables=tables)
+        else:
+            loaded = storage.to_mysql(df=df, year=year, chunk_size=self.chunk_size, tables=tables)
+        if not loaded:
+            raise SinkError(f"Failed to load YEAR: {year} into MySQL")
+
+
+class BlobSink(Sink):
+    """
+    Upload every year's merged output to Azure blob storage, see storage.blob_upload()
+
+    Args:
+        output_format: str
+            Merged output to upload, 'csv' or 'parquet'
+        compress: bool
+            Gzip the file before uploading it
+    """
+    name = 'blob'
+
+    def __init__(self, output_format: str='csv', compress: bool=False) -> None:
+        self.output_format = output_format
+        self.compress = compress
+
+    def write(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        import storage
+        if storage.blob_upload(region, year, output_format=self.output_format, compress=self.compress) == 'failed':
+            raise SinkError(f"Failed to upload YEAR: {year} to blob storage")
+
+
+class S3Sink(Sink):
+    """
+    Upload every year's merged parquet output to an S3-compatible bucket, skipping objects whose ETag already
+    matches the file's MD5. Requires boto3
+
+    Args:
+        bucket: str
+            Bucket to upload to
+        prefix: str
+            Key prefix of every object
+        endpoint_url: str
+            (Optional) Endpoint of an S3-compatible service, e.g. MinIO
+    """
+    name = 's3'
+
+    def __init__(self, bucket: str, prefix: str='movie_data', endpoint_url: str=None) -> None:
+        try:
+            import boto3
+        except ImportError as e:
+            raise ImportError("The s3 sink requires boto3, install it with 'pip install boto3'") from e
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def write(self, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+        filename = f"{region}_movie_data_{year}-merged.{movies.output_format()}"
+        data = (movies.year_dir(region, year) / filename).read_bytes()
+        md5 = hashlib.md5(data)
+        key = f"{self.prefix}/{region}_movie_data/{filename}"
+        try:
+            if self.client.head_object(Bucket=self.bucket, Key=key)['ETag'].strip('"') == md5.hexdigest():
+                logger.info(f"{key} is unchanged, skipping upload")
+                return
+        except self.client.exceptions.ClientError:
+            pass
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentMD5=base64.b64encode(md5.digest()).decode())
+        logger.info(f"Uploaded {key} successfully")
+
+
+SINKS = {sink.name: sink for sink in [LocalSink, SQLiteSink, MySQLSink, BlobSink, S3Sink]}
+
+
+def make_sinks(names: str) -> list:
+    """
+    Build the sinks of a run from a comma separated list of names, each configured by its entry
+    in the "sinks" section of config.json, e.g. {"sinks": {"sqlite": {"path": "./data/movies.sqlite"}}}
+
+    Args:
+        names: str
+            Comma separated SINKS keys, e.g. 'local,sqlite'
+    Returns: list[Sink]
+    """
+    sink_config = get_config().get('sinks', {})
+    sinks = []
+    for name in [name.strip() for name in names.split(',') if name.strip() != '']:
+        if name not in SINKS:
+            raise ValueError(f"Unknown sink '{name}', choose from {', '.join(SINKS)}")
+        sinks.append(SINKS[name](**sink_config.get(name, {})))
+    return sinks
+
+
+async def write_all(sinks: list, region: str, year: int, df: pd.DataFrame, tables: dict) -> None:
+    """
+    Write a year to every sink concurrently. Every sink finishes its write before the first failure is raised
+    """
+    results = await asyncio.gather(*[sink.awrite(region, year, df, tables) for sink in sinks], return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
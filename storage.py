@@ -1,13 +1,31 @@
+from __future__ import annotations
+
 from ast import literal_eval
-from azure.storage.blob import BlobServiceClient
+from collections import OrderedDict
+import concurrent.futures
+from functools import cached_property
+import gzip
+import hashlib
 import json
 import logging
 from logging import INFO
-import pandas as pd
-import pymysql.cursors
+from pathlib import Path
+import re
 import sys
+import tempfile
+import threading
+import time
 import typer
 
+import movies
+from movies.config import get_config
+from movies.lazy import LazyModule
+from movies.metrics import METRICS
+
+# pandas, PyMySQL and the Azure SDK are only imported by the commands that use them
+pd = LazyModule('pandas')
+pymysql = LazyModule('pymysql')
+
 logging.basicConfig(format='[%(levelname)-5s][%(asctime)s][%(module)s:%(lineno)04d] : %(message)s',
                     level=INFO,
                     stream=sys.stderr)
@@ -15,22 +33,107 @@ logger: logging.Logger = logging
 
 storage = typer.Typer()
 
-file = open('./config.json', 'r')
-config = json.loads(file.read())
+# A conn_str of file://<directory> stores blobs in a local directory instead, e.g. for tests
+LOCAL_BLOB_PREFIX = 'file://'
+# Default block size and parallel connections of each upload, tunable with "upload" in the storage_account config
+BLOCK_SIZE = 4 * 1024 * 1024
+MAX_CONCURRENCY = 4
 
-# Azure Storage Configuarations
-storage_account = config['storage_account']
-stor_conn_str = storage_account['conn_str']
-container_name = storage_account['container']
-container_movie_dir = storage_account['movie_dir']
 
-# MySQL Configurations
-database = config['database']
-user = database['user']
-passwd = database['passwd']
-db_name = database['db_name']
-
-blob_service_client = BlobServiceClient.from_connection_string(stor_conn_str)
+class Settings:
+    """
+    Azure Storage and MySQL configurations of config.json, read on first use so importing storage stays cheap
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+
+    @cached_property
+    def storage_account(self) -> dict:
+        return get_config()['storage_account']
+
+    @cached_property
+    def conn_str(self) -> str:
+        return self.storage_account['conn_str']
+
+    @cached_property
+    def container(self) -> str:
+        return self.storage_account['container']
+
+    @cached_property
+    def movie_dir(self) -> str:
+        return self.storage_account['movie_dir']
+
+    @cached_property
+    def block_size(self) -> int:
+        return self.storage_account.get('upload', {}).get('block_size', BLOCK_SIZE)
+
+    @cached_property
+    def max_concurrency(self) -> int:
+        return self.storage_account.get('upload', {}).get('max_concurrency', MAX_CONCURRENCY)
+
+    @cached_property
+    def database(self) -> dict:
+        return get_config()['database']
+
+    @cached_property
+    def user(self) -> str:
+        return self.database['user']
+
+    @cached_property
+    def passwd(self) -> str:
+        return self.database['passwd']
+
+    @cached_property
+    def db_name(self) -> str:
+        return self.database['db_name']
+
+    @cached_property
+    def host(self) -> str:
+        return self.database.get('host', 'localhost')
+
+    @cached_property
+    def blob_service_client(self):
+        from azure.storage.blob import BlobServiceClient
+        if self.conn_str.startswith(LOCAL_BLOB_PREFIX):
+            return None
+        return BlobServiceClient.from_connection_string(self.conn_str)
+
+    @cached_property
+    def entity_cache_config(self) -> dict:
+        # Set "entity_cache": {"warm": true} in config.json to load the entities already in MySQL before the first load,
+        # or {"enabled": false} to always upsert every entity
+        return get_config().get('entity_cache', {})
+
+    @property
+    def entity_cache(self) -> EntityCache:
+        """
+        EntityCache shared by every load of the run, None when disabled
+        """
+        with self._lock:
+            if 'entity_cache' not in self.__dict__:
+                config = self.entity_cache_config
+                self.__dict__['entity_cache'] = EntityCache(config.get('max_entries', 200000)) if config.get('enabled', True) else None
+            return self.__dict__['entity_cache']
+
+    def connect(self, **kwargs) -> pymysql.connections.Connection:
+        """
+        Open a MySQL connection returning rows as dicts
+        """
+        return pymysql.connect(host=self.host, user=self.user, password=self.passwd, database=self.db_name,
+                               cursorclass=pymysql.cursors.DictCursor, **kwargs)
+
+
+settings = Settings()
+# Former module level configurations, now read from settings
+SETTINGS_NAMES = {'stor_conn_str': 'conn_str', 'container_name': 'container', 'container_movie_dir': 'movie_dir',
+                  'user': 'user', 'passwd': 'passwd', 'db_name': 'db_name', 'host': 'host',
+                  'blob_service_client': 'blob_service_client', 'entity_cache': 'entity_cache'}
+
+
+def __getattr__(name: str):
+    if name in SETTINGS_NAMES:
+        return getattr(settings, SETTINGS_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @storage.command("containers")
@@ -38,28 +141,313 @@ def show_containers() -> str:
     """
     List all containers in a storage account
     """
-    all_containers = blob_service_client.list_containers(include_metadata=True)
+    all_containers = settings.blob_service_client.list_containers(include_metadata=True)
     for container in all_containers:
         print(f"Container: {container['name']}")
 
 
+class LocalBlobClient:
+    """
+    File system stand-in for the parts of BlobClient used by blob_upload(), content settings are kept in a sidecar json
+
+    Args:
+        root: str
+            Directory holding every container
+        container: str
+            Container (and virtual directories) of the blob
+        blob: str
+            Name of the blob
+    """
+    def __init__(self, root: str, container: str, blob: str) -> None:
+        self.path = Path(root) / container / blob
+        self.meta_path = self.path.with_name(f"{self.path.name}.properties.json")
+
+    def get_blob_properties(self):
+        from azure.core.exceptions import ResourceNotFoundError
+        from azure.storage.blob import ContentSettings
+        if not self.path.exists():
+            raise ResourceNotFoundError(f"{self.path} not found")
+        meta = json.loads(self.meta_path.read_text())
+        content_settings = ContentSettings(content_type=meta['content_type'], content_encoding=meta['content_encoding'],
+                                           content_md5=bytes.fromhex(meta['content_md5']))
+        return type('BlobProperties', (), {'content_settings': content_settings, 'size': self.path.stat().st_size})
+
+    def upload_blob(self, data: bytes, overwrite: bool=False, content_settings=None, **kwargs) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_bytes(data)
+        self.meta_path.write_text(json.dumps({'content_type': content_settings.content_type,
+                                              'content_encoding': content_settings.content_encoding,
+                                              'content_md5': bytes(content_settings.content_md5).hex()}))
+
+
+def get_blob_client(container: str, blob: str, block_size: int=None):
+    """
+    Blob client of a blob, uploading in blocks of block_size bytes (the configured block size by default)
+
+    Returns: BlobClient, or LocalBlobClient when conn_str starts with file://
+    """
+    if settings.conn_str.startswith(LOCAL_BLOB_PREFIX):
+        return LocalBlobClient(settings.conn_str[len(LOCAL_BLOB_PREFIX):], container, blob)
+    from azure.storage.blob import BlobClient
+    block_size = block_size or settings.block_size
+    return BlobClient.from_connection_string(settings.conn_str, container_name=container, blob_name=blob,
+                                             max_block_size=block_size, max_single_put_size=block_size)
+
+
 @storage.command("upload")
-def blob_upload(region: str, year: str) -> None:
+def blob_upload(region: str, year: str, output_format: str='csv', compress: bool=False, block_size: int=None,
+                max_concurrency: int=None) -> str:
     """
-    Upload a single file to an Azure blob container
+    Upload a year's merged output to an Azure blob container, unless the stored blob already has the same MD5
+
+    Args:
+        region: str
+            Country of the merged output
+        year: int
+            Year of the merged output
+        output_format: str, default 'csv'
+            (Optional) Merged output to upload, 'csv' or 'parquet'
+        compress: bool, default False
+            (Optional) Gzip the file before uploading it as <name>.gz
+        block_size: int, default None
+            (Optional) Bytes per uploaded block, BLOCK_SIZE unless configured
+        max_concurrency: int, default None
+            (Optional) Blocks uploaded in parallel, MAX_CONCURRENCY unless configured
+    Returns: str of 'uploaded', 'skipped' or 'failed'
     """
-    filename = f"{region}_movie_data_{year}-merged.csv"
-    container_sub_dir = f"{container_name}/{container_movie_dir}/{region}_movie_data"
+    filename = f"{region}_movie_data_{year}-merged.{output_format}"
+    from azure.core.exceptions import ResourceNotFoundError
+    from azure.storage.blob import ContentSettings
+    container_sub_dir = f"{settings.container}/{settings.movie_dir}/{region}_movie_data"
     try:
-        blob_client = blob_service_client.get_blob_client(container=container_sub_dir, blob=filename)
-        path = f"./data/{region}_movie_data_{year}/{filename}"
-
-        with open(path, "rb") as data:
-            logger.info(f"Uploading to Azure Storage as blob: {filename}")
-            blob_client.upload_blob(data, overwrite=True)
-            logger.info(f"Uploaded {filename} successfully")
+        data = (movies.year_dir(region, year) / filename).read_bytes()
+        content_type = 'text/csv' if output_format == 'csv' else 'application/vnd.apache.parquet'
+        content_encoding = None
+        if compress:
+            # mtime is fixed so the same file always compresses to the same bytes and MD5
+            data = gzip.compress(data, mtime=0)
+            filename = f"{filename}.gz"
+            content_encoding = 'gzip'
+        md5 = hashlib.md5(data).digest()
+        blob_client = get_blob_client(container_sub_dir, filename, block_size)
+        try:
+            stored = blob_client.get_blob_properties().content_settings.content_md5
+            if stored != None and bytes(stored) == md5:
+                logger.info(f"{filename} is unchanged, skipping upload")
+                return 'skipped'
+        except ResourceNotFoundError:
+            pass
+        logger.info(f"Uploading to Azure Storage as blob: {filename}")
+        with METRICS.timer('blob_upload'):
+            blob_client.upload_blob(data, overwrite=True, max_concurrency=max_concurrency or settings.max_concurrency,
+                                    content_settings=ContentSettings(content_type=content_type, content_encoding=content_encoding,
+                                                                     content_md5=md5))
+        METRICS.inc('bytes_uploaded', len(data))
+        logger.info(f"Uploaded {filename} successfully")
+        return 'uploaded'
     except Exception as e:
         print(e)
+        return 'failed'
+
+
+@storage.command("upload_all")
+def bulk_upload(region: str, year_start: int, year_end: int, workers: int=4, output_format: str='csv', compress: bool=False,
+                block_size: int=None, max_concurrency: int=None) -> dict:
+    """
+    Upload the merged outputs of a range of years concurrently, skipping blobs that are already up to date
+
+    Args:
+        region: str
+            Country of the merged outputs
+        year_start: int
+            First year to upload
+        year_end: int
+            Last year to upload
+        workers: int, default 4
+            (Optional) Years uploaded at once
+        see blob_upload() for the remaining options
+    Returns: dict[str, list[int]] of the years uploaded, skipped and failed
+    """
+    tm1 = time.perf_counter()
+    years = list(range(year_start, year_end + 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda year: blob_upload(region, year, output_format, compress, block_size, max_concurrency), years)
+        summary = {'uploaded': [], 'skipped': [], 'failed': []}
+        for year, result in zip(years, results):
+            summary[result].append(year)
+    tm2 = time.perf_counter()
+    logger.info(f"Uploaded {len(summary['uploaded'])} years, skipped {len(summary['skipped'])}, "
+                f"failed {len(summary['failed'])} in {tm2 - tm1:0.2f} seconds")
+    return summary
+
+
+def nested(value) -> list:
+    """
+    Return a nested column's list[dict], parsing it first if it was read back from csv as a str
+
+    Args:
+        value: str or list
+            Cell of a nested column
+    Returns: list[dict]
+    """
+    if isinstance(value, str):
+        return literal_eval(value)
+    return value
+
+
+# Upsert statement of every table, shared by the insert_* helpers and the batched loader.
+# PyMySQL's executemany() rewrites each chunk of rows into a single multi-row INSERT.
+UPSERTS = {
+    'movies': """INSERT INTO `movies` (`id`, `original_title`, `title`, `language`, `release_date`)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY
+                    UPDATE original_title=VALUES(original_title), title=VALUES(title), language=VALUES(language), release_date=VALUES(release_date)""",
+    'plots': """INSERT into `plots` (`plot`, `movie_id`)
+            VALUES (%s, %s)
+            ON DUPLICATE KEY
+            UPDATE plot=VALUES(plot)""",
+    'genres': """INSERT INTO `genres` (`id`, `name`)
+                    VALUES (%s, %s)
+                    ON DUPLICATE KEY
+                    UPDATE name=VALUES(name)""",
+    'movie_genres': """INSERT INTO `movie_genres` (`movie_id`, `genre_id`)
+            VALUES (%s, %s)
+            ON DUPLICATE KEY
+            UPDATE movie_id=VALUES(movie_id)""",
+    'directors': """INSERT INTO `directors` (`id`, `name`)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY
+                UPDATE name=VALUES(name)""",
+    'movie_directors': """INSERT INTO `movie_directors` (`movie_id`, `director_id`)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY
+                UPDATE movie_id=VALUES(movie_id)""",
+    'actors': """INSERT INTO `actors` (`id`, `name`)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY
+                UPDATE name=VALUES(name)""",
+    'movie_actors': """INSERT INTO `movie_actors` (`movie_id`, `actor_id`)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY
+                UPDATE movie_id=VALUES(movie_id)""",
+    'countries': """INSERT INTO `countries` (`id`, `name`)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY
+                UPDATE name=VALUES(name)""",
+    'companies': """INSERT INTO `companies` (`id`, `name`, `country`)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY
+                    UPDATE name=VALUES(name), country=VALUES(country)""",
+    'companies_no_country': """INSERT INTO `companies` (`id`, `name`)
+                    VALUES (%s, %s)
+                    ON DUPLICATE KEY
+                    UPDATE name=VALUES(name)""",
+    'movie_revenue': """INSERT INTO `movie_revenue` (`movie_id`, `revenue`, `budget`)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY
+            UPDATE revenue=VALUES(revenue)""",
+}
+
+
+# Tables of entities shared by many movies, keyed on their first column
+ENTITY_TABLES = ['genres', 'directors', 'actors', 'countries', 'companies', 'companies_no_country']
+
+
+class EntityCache:
+    """
+    Keys and content hashes of the entities already written to MySQL during this run, so the same genres,
+    people, countries and companies are only upserted again when they are new or changed.
+    Each table keeps its max_entries most recently used entities
+
+    Args:
+        max_entries: int
+            Entities remembered per table
+    """
+    def __init__(self, max_entries: int=200000) -> None:
+        self.max_entries = max_entries
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self.entities = {table: OrderedDict() for table in ENTITY_TABLES}
+        self.warmed = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entities = {table: OrderedDict() for table in ENTITY_TABLES}
+            self.skipped = 0
+            self.warmed = False
+
+    def filter(self, rows_by_table: dict) -> dict:
+        """
+        Drop the entity rows whose key was already written with the same content
+
+        Args:
+            rows_by_table: dict[str, list[tuple]]
+                Rows by UPSERTS key
+        Returns: dict[str, list[tuple]] of the rows that still need to be written
+        """
+        filtered = {}
+        with self._lock:
+            for table, rows in rows_by_table.items():
+                if table not in self.entities:
+                    filtered[table] = rows
+                    continue
+                seen = self.entities[table]
+                filtered[table] = []
+                for row in rows:
+                    if seen.get(row[0]) == hash(row):
+                        seen.move_to_end(row[0])
+                        self.skipped += 1
+                    else:
+                        filtered[table].append(row)
+        return filtered
+
+    def remember(self, rows_by_table: dict) -> None:
+        """
+        Record rows that were written, call it once their transaction is committed
+        """
+        with self._lock:
+            for table, rows in rows_by_table.items():
+                if table not in self.entities:
+                    continue
+                seen = self.entities[table]
+                for row in rows:
+                    seen[row[0]] = hash(row)
+                    seen.move_to_end(row[0])
+                while len(seen) > self.max_entries:
+                    seen.popitem(last=False)
+
+    def warm(self, cursor: pymysql.cursors.DictCursor) -> None:
+        """
+        Remember the entities already stored in MySQL
+        """
+        rows_by_table = {}
+        for table in ENTITY_TABLES:
+            target, columns, _ = parse_upsert(table)
+            column_list = ', '.join(f"`{column}`" for column in columns)
+            cursor.execute(f"SELECT {column_list} FROM `{target}` LIMIT %s", (self.max_entries,))
+            rows_by_table[table] = [tuple(row[column] for column in columns) for row in cursor.fetchall()]
+        self.remember(rows_by_table)
+        self.warmed = True
+        logger.info(f"Entity cache warmed with {sum(len(rows) for rows in rows_by_table.values())} entities")
+
+
+def dedup_entities(cursor: pymysql.cursors.DictCursor, rows_by_table: dict) -> dict:
+    """
+    Leave out the entity rows already written during the run, warming the cache first if configured
+
+    Args:
+        cursor: PyMySQL DictCursor object
+            Used to warm the cache
+        rows_by_table: dict[str, list[tuple]]
+            Rows by UPSERTS key
+    Returns: dict[str, list[tuple]] of the rows to write
+    """
+    entity_cache = settings.entity_cache
+    if entity_cache == None:
+        return rows_by_table
+    if settings.entity_cache_config.get('warm', False) and not entity_cache.warmed:
+        entity_cache.warm(cursor)
+    return entity_cache.filter(rows_by_table)
 
 
 def insert_movies(row, cursor: pymysql.cursors.DictCursor) -> None:
@@ -73,10 +461,7 @@ def insert_movies(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `movies` (`id`, `original_title`, `title`, `language`, `release_date`)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE original_title=VALUES(original_title), title=VALUES(title), language=VALUES(language), release_date=VALUES(release_date)"""
+    sql = UPSERTS['movies']
     cursor.execute(sql, (row.ID, row.ORIGINAL_TITLE, row.TITLE, 
                         row.ORIGINAL_LANGUAGE, row.RELEASE_DATE))
 
@@ -92,10 +477,7 @@ def insert_plots(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT into `plots` (`plot`, `movie_id`)
-            VALUES(%s, %s)
-            ON DUPLICATE KEY
-            UPDATE plot=VALUES(plot)"""
+    sql = UPSERTS['plots']
     cursor.execute(sql, (row.PLOT, row.ID))
 
 
@@ -110,13 +492,10 @@ def insert_genres(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `genres` (`id`, `name`)
-                    VALUES (%s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE name=VALUES(name)"""
+    sql = UPSERTS['genres']
     genres_list = row.GENRES
-    # Change from str back to list[dict]
-    genres_list = literal_eval(genres_list)
+    # Change from str back to list[dict] when read from csv
+    genres_list = nested(genres_list)
     if len(genres_list) >= 1:
         for genre in genres_list:
             id = genre['id']
@@ -135,12 +514,9 @@ def insert_movie_genres(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `movie_genres` (`movie_id`, `genre_id`)
-            VALUES (%s, %s)
-            ON DUPLICATE KEY
-            UPDATE movie_id=VALUES(movie_id)"""
+    sql = UPSERTS['movie_genres']
     genres_list = row.GENRES
-    genres_list = literal_eval(genres_list)
+    genres_list = nested(genres_list)
     movie_id = row.ID
     if len(genres_list) >= 1:
         for genre in genres_list:
@@ -159,12 +535,9 @@ def insert_directors(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `directors` (`id`, `name`)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY
-                UPDATE name=VALUES(name)"""
+    sql = UPSERTS['directors']
     director_list = row.DIRECTORS
-    director_list = literal_eval(director_list)
+    director_list = nested(director_list)
     if len(director_list) >= 1:
         for director in director_list:
             id = director['id']
@@ -183,12 +556,9 @@ def insert_movie_directors(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `movie_directors` (`movie_id`, `director_id`)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY
-                UPDATE movie_id=VALUES(movie_id)"""
+    sql = UPSERTS['movie_directors']
     director_list = row.DIRECTORS
-    director_list = literal_eval(director_list)
+    director_list = nested(director_list)
     movie_id = row.ID
     if len(director_list) >= 1:
         for director in director_list:
@@ -207,12 +577,9 @@ def insert_actors(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `actors` (`id`, `name`)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY
-                UPDATE name=VALUES(name)"""
+    sql = UPSERTS['actors']
     cast_list = row.CAST
-    cast_list = literal_eval(cast_list)
+    cast_list = nested(cast_list)
     if len(cast_list) >= 1:
         for member in cast_list:
             id = member['id']
@@ -231,12 +598,9 @@ def insert_movie_actors(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `movie_actors` (`movie_id`, `actor_id`)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY
-                UPDATE movie_id=VALUES(movie_id)"""
+    sql = UPSERTS['movie_actors']
     cast_list = row.CAST
-    cast_list = literal_eval(cast_list)
+    cast_list = nested(cast_list)
     movie_id = row.ID
     if len(cast_list) >= 1:
         for actor in cast_list:
@@ -255,12 +619,9 @@ def insert_countries(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `countries` (`id`, `name`)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY
-                UPDATE name=VALUES(name)"""
+    sql = UPSERTS['countries']
     country_list = row.PRODUCTION_COUNTRIES
-    country_list = literal_eval(country_list)
+    country_list = nested(country_list)
     if len(country_list) >= 1:
         for country in country_list:
             id = country['iso_3166_1']
@@ -280,7 +641,7 @@ def insert_companies(row, cursor: pymysql.cursors.DictCursor) -> None:
     Returns: None
     """
     company_list = row.PRODUCTION_COMPANIES
-    company_list = literal_eval(company_list)
+    company_list = nested(company_list)
     if len(company_list) >= 1:
         for company in company_list:
             id = company['id']
@@ -288,16 +649,10 @@ def insert_companies(row, cursor: pymysql.cursors.DictCursor) -> None:
             country_id = company['origin_country']
 
             if country_id != 'no info':
-                sql = """INSERT INTO `companies` (`id`, `name`, `country`)
-                    VALUES(%s, %s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE name=VALUES(name), country=VALUES(country)"""
+                sql = UPSERTS['companies']
                 cursor.execute(sql, (id, name, country_id))
             else:
-                sql = """INSERT INTO `companies` (`id`, `name`)
-                    VALUES (%s, %s)
-                    ON DUPLICATE KEY
-                    UPDATE name=VALUES(name)"""
+                sql = UPSERTS['companies_no_country']
                 cursor.execute(sql, (id, name))
 
 
@@ -312,18 +667,184 @@ def insert_movie_revenue(row, cursor: pymysql.cursors.DictCursor) -> None:
             executes SQL statement
     Returns: None
     """
-    sql = """INSERT INTO `movie_revenue` (`movie_id`, `revenue`, `budget`)
-            VALUES (%s, %s, %s)
-            ON DUPLICATE KEY
-            UPDATE revenue=VALUES(revenue)"""
+    sql = UPSERTS['movie_revenue']
     movie_id = row.ID
-    fin_dict = row.FINANCIAL
-    revenue = fin_dict['revenue']
-    budget = fin_dict['budget']
+    revenue = row.REVENUE
+    budget = row.BUDGET
     cursor.execute(sql, (movie_id, revenue, budget))
 
 
-def to_mysql(df: pd.DataFrame, year: int) -> None:
+def collect_rows(df: pd.DataFrame) -> dict:
+    """
+    Collect the rows of every table across a whole DataFrame, deduplicated on each table's key.
+    When a key repeats, the last row wins, as it would with one upsert per row.
+
+    Args:
+        df: pd.DataFrame
+            DataFrame object to collect rows from
+    Returns: dict[str, list[tuple]] of rows by UPSERTS key
+    """
+    tables = {table: {} for table in UPSERTS}
+    for row in df.itertuples(index=False):
+        movie_id = row.ID
+        tables['movies'][movie_id] = (movie_id, row.ORIGINAL_TITLE, row.TITLE, row.ORIGINAL_LANGUAGE, row.RELEASE_DATE)
+        tables['plots'][movie_id] = (row.PLOT, movie_id)
+        for genre in nested(row.GENRES):
+            tables['genres'][genre['id']] = (genre['id'], genre['name'])
+            tables['movie_genres'][(movie_id, genre['id'])] = (movie_id, genre['id'])
+        for director in nested(row.DIRECTORS):
+            tables['directors'][director['id']] = (director['id'], director['name'])
+            tables['movie_directors'][(movie_id, director['id'])] = (movie_id, director['id'])
+        # CAST is only parsed once for both the actors and movie_actors tables
+        for member in nested(row.CAST):
+            tables['actors'][member['id']] = (member['id'], member['name'])
+            tables['movie_actors'][(movie_id, member['id'])] = (movie_id, member['id'])
+        for country in nested(row.PRODUCTION_COUNTRIES):
+            tables['countries'][country['iso_3166_1']] = (country['iso_3166_1'], country['name'])
+        for company in nested(row.PRODUCTION_COMPANIES):
+            if company['origin_country'] != 'no info':
+                tables['companies'][company['id']] = (company['id'], company['name'], company['origin_country'])
+            else:
+                tables['companies_no_country'][company['id']] = (company['id'], company['name'])
+        tables['movie_revenue'][movie_id] = (movie_id, row.REVENUE, row.BUDGET)
+    return {table: list(rows.values()) for table, rows in tables.items()}
+
+
+def table_rows(tables: dict) -> dict:
+    """
+    Turn normalized tables (see movies.normalize()) into the rows of every UPSERTS statement
+
+    Args:
+        tables: dict[str, pd.DataFrame]
+            Flat tables named after their MySQL tables, already deduplicated
+    Returns: dict[str, list[tuple]] of rows by UPSERTS key
+    """
+    rows = {table: list(tables[table].itertuples(index=False, name=None)) for table in UPSERTS if table in tables}
+    companies = tables['companies']
+    has_country = companies['country'] != 'no info'
+    rows['companies'] = list(companies[has_country].itertuples(index=False, name=None))
+    rows['companies_no_country'] = list(companies.loc[~has_country, ['id', 'name']].itertuples(index=False, name=None))
+    return rows
+
+
+def bulk_upsert(cursor: pymysql.cursors.DictCursor, table: str, rows: list, chunk_size: int=1000) -> None:
+    """
+    Upsert rows into a MySQL table in chunks
+
+    Args:
+        cursor: PyMySQL DictCursor object
+            executes SQL statement
+        table: str
+            UPSERTS key of the statement to run
+        rows: list[tuple]
+            Values of each row
+        chunk_size: int, default 1000
+            Rows sent per multi-row INSERT
+    Returns: None
+    """
+    for start in range(0, len(rows), chunk_size):
+        cursor.executemany(UPSERTS[table], rows[start:start + chunk_size])
+
+
+def parse_upsert(table: str) -> tuple:
+    """
+    Split an UPSERTS statement into the parts needed to merge a staging table into its target
+
+    Args:
+        table: str
+            UPSERTS key
+    Returns: tuple[str, list[str], str] of the target table, its column names and the ON DUPLICATE KEY UPDATE assignments
+    """
+    match = re.search(r"INSERT\s+into\s+`(\w+)`\s*\(([^)]*)\).*ON DUPLICATE KEY\s+UPDATE\s+(.*)$", UPSERTS[table],
+                      re.IGNORECASE | re.DOTALL)
+    columns = [column.strip().strip('`') for column in match.group(2).split(',')]
+    return match.group(1), columns, match.group(3).strip()
+
+
+def tsv_value(value) -> str:
+    """
+    Format a value for LOAD DATA's default tab separated format, escaping backslashes, tabs and newlines
+
+    Args:
+        value: any
+            Value to format, None becomes NULL
+    Returns: str
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def write_tsv(rows: list, path: Path) -> None:
+    """
+    Write rows to a tab separated file readable by LOAD DATA LOCAL INFILE
+
+    Args:
+        rows: list[tuple]
+            Values of each row
+        path: Path
+            File to write
+    Returns: None
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as tsv:
+        for row in rows:
+            tsv.write('\t'.join(tsv_value(value) for value in row) + '\n')
+
+
+def to_mysql_infile(df: pd.DataFrame, year: int, tables: dict=None) -> bool:
+    """
+    Load a Pandas DataFrame into MySQL for large backfills. Every table's rows are written to a temporary TSV,
+    bulk loaded into a staging table with LOAD DATA LOCAL INFILE and merged into the real table with a single
+    INSERT ... SELECT ... ON DUPLICATE KEY UPDATE, all inside one transaction.
+
+    Args:
+        df: pd.DataFrame
+            DataFrame object to load
+        year: int
+            Passed to the function from main(). Simply logs the year back after completion.
+        tables: dict[str, pd.DataFrame], default None
+            (Optional) Normalized tables of df, see movies.normalize(). Collected from df row by row if not given
+    Returns: bool, False if the load failed and was rolled back
+    """
+    rows_by_table = table_rows(tables) if tables != None else collect_rows(df)
+    conn = settings.connect(local_infile=True)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir, conn.cursor() as cursor:
+            rows_by_table = dedup_entities(cursor, rows_by_table)
+            conn.begin()
+            for table, rows in rows_by_table.items():
+                if rows == []:
+                    continue
+                target, columns, update = parse_upsert(table)
+                column_list = ', '.join(f"`{column}`" for column in columns)
+                path = Path(tmp_dir) / f"{table}.tsv"
+                write_tsv(rows, path)
+                with METRICS.timer('mysql', table=table):
+                    # Temporary tables start empty on every connection. TRUNCATE would implicitly commit the transaction
+                    cursor.execute(f"CREATE TEMPORARY TABLE `stage_{table}` LIKE `{target}`")
+                    cursor.execute(f"LOAD DATA LOCAL INFILE %s INTO TABLE `stage_{table}` CHARACTER SET utf8mb4 ({column_list})",
+                                   (str(path),))
+                    cursor.execute(f"""INSERT INTO `{target}` ({column_list})
+                                    SELECT {column_list} FROM `stage_{table}`
+                                    ON DUPLICATE KEY
+                                    UPDATE {update}""")
+                METRICS.inc('rows', len(rows), stage='mysql', table=table)
+            conn.commit()
+            if settings.entity_cache != None:
+                settings.entity_cache.remember(rows_by_table)
+            logger.info(f"Loaded YEAR: {year} into MySQL from staged files")
+        loaded = True
+
+    except pymysql.Error as e:
+        logger.info(e)
+        conn.rollback()
+        loaded = False
+
+    conn.close()
+    return loaded
+
+
+def to_mysql(df: pd.DataFrame, year: int, batch: bool=True, chunk_size: int=1000, tables: dict=None) -> bool:
     """
     Insert Pandas DataFrame rows into a MySQL table.
 
@@ -332,38 +853,92 @@ def to_mysql(df: pd.DataFrame, year: int) -> None:
             DataFrame object to iterate over
         year: int
             Passed to the function from main(). Simply logs the year back after completion.
-    Returns: None
+        batch: bool, default True
+            Collect every table's rows first and write them with chunked multi-row upserts,
+            instead of one upsert per row and table
+        chunk_size: int, default 1000
+            Rows sent per multi-row INSERT when batch is True
+        tables: dict[str, pd.DataFrame], default None
+            (Optional) Normalized tables of df, see movies.normalize(). Collected from df row by row if not given
+    Returns: bool, False if the load failed and was rolled back
     """
+    conn = settings.connect()
     try:
-        conn = pymysql.connect(host='localhost',
-                            user=user,
-                            password=passwd,
-                            database=db_name,
-                            cursorclass=pymysql.cursors.DictCursor)
-        
         with conn.cursor() as cursor:
-            for row in df.itertuples(index=False):
-                insert_movies(row=row, cursor=cursor)
-                insert_plots(row=row, cursor=cursor)
-                insert_genres(row=row, cursor=cursor)
-                insert_movie_genres(row=row, cursor=cursor)
-                insert_directors(row=row, cursor=cursor)
-                insert_movie_directors(row=row, cursor=cursor)
-                insert_actors(row=row, cursor=cursor)
-                insert_movie_actors(row=row, cursor=cursor)
-                insert_countries(row=row, cursor=cursor)
-                insert_companies(row=row, cursor=cursor)
-                insert_movie_revenue(row=row, cursor=cursor)
+            if batch:
+                rows_by_table = table_rows(tables) if tables != None else collect_rows(df)
+                rows_by_table = dedup_entities(cursor, rows_by_table)
+                for table, rows in rows_by_table.items():
+                    with METRICS.timer('mysql', table=table):
+                        bulk_upsert(cursor, table, rows, chunk_size)
+                    METRICS.inc('rows', len(rows), stage='mysql', table=table)
+            else:
+                for row in df.itertuples(index=False):
+                    insert_movies(row=row, cursor=cursor)
+                    insert_plots(row=row, cursor=cursor)
+                    insert_genres(row=row, cursor=cursor)
+                    insert_movie_genres(row=row, cursor=cursor)
+                    insert_directors(row=row, cursor=cursor)
+                    insert_movie_directors(row=row, cursor=cursor)
+                    insert_actors(row=row, cursor=cursor)
+                    insert_movie_actors(row=row, cursor=cursor)
+                    insert_countries(row=row, cursor=cursor)
+                    insert_companies(row=row, cursor=cursor)
+                    insert_movie_revenue(row=row, cursor=cursor)
 
             conn.commit()
+            if batch and settings.entity_cache != None:
+                settings.entity_cache.remember(rows_by_table)
+        loaded = True
     
     except pymysql.Error as e:
         logger.info(e)
         conn.rollback()
+        loaded = False
 
     conn.close()
+    return loaded
 
 
 
+@storage.command("load")
+def load_merged(region: str, year: int, batch: bool=True, chunk_size: int=1000, infile: bool=False) -> None:
+    """
+    Load a saved merged output (parquet or csv) into MySQL and report how long it took, to compare the row by row,
+    batched and staged file loaders
+    """
+    merged = movies.year_dir(region, year) / f"{region}_movie_data_{year}-merged"
+    suffixes = [f".{suffix}" for suffix in dict.fromkeys([movies.output_format(), 'parquet', 'csv'])]
+    path = next((merged.with_suffix(suffix) for suffix in suffixes if merged.with_suffix(suffix).exists()), None)
+    if path == None:
+        print(f"No merged output found for YEAR: {year}")
+        return
+    # read_output() restores nested columns from csv and splits the FINANCIAL column of older outputs
+    df = movies.read_output(path)
+    # Use the normalized tables saved with the merged output, in whichever format they were saved, if any
+    tables = {}
+    for table in UPSERTS:
+        if table == 'companies_no_country':
+            continue
+        table_path = next((merged.with_name(f"{merged.name}-{table}{suffix}") for suffix in suffixes
+                           if merged.with_name(f"{merged.name}-{table}{suffix}").exists()), None)
+        if table_path == None:
+            tables = None
+            break
+        tables[table] = movies.read_output(table_path)
+    tm1 = time.perf_counter()
+    if infile:
+        loaded = to_mysql_infile(df=df, year=year, tables=tables)
+        mode = 'staged files'
+    else:
+        loaded = to_mysql(df=df, year=year, batch=batch, chunk_size=chunk_size, tables=tables)
+        mode = 'batched' if batch else 'row by row'
+    tm2 = time.perf_counter()
+    if loaded:
+        print(f"Loaded {len(df)} movies in {tm2 - tm1:0.2f} seconds ({mode})")
+    else:
+        print(f"Failed to load YEAR: {year} ({mode}), it was rolled back")
+
+
 if __name__ == "__main__":
     storage()
\ No newline at end of file
@@ -0,0 +1,106 @@
+from datetime import date
+import pandas as pd
+from pathlib import Path
+import requests
+import sys
+import tempfile
+import typer
+import unittest
+from unittest.mock import patch
+
+root_dir = str(Path(__file__).resolve().parent.parent)
+sys.path.append(root_dir)
+
+import main
+import movies
+import sinks
+
+
+class TestMain(unittest.TestCase):
+
+    def tables(self) -> dict:
+        return {
+            'movies': pd.DataFrame({'id': [603, 604], 'title': ['The Matrix', 'The Matrix Reloaded'], 'budget': [63000000, None]}),
+            'movie_genres': pd.DataFrame({'movie_id': [603, 603, 604], 'genre_id': [28, 878, 28]}),
+        }
+
+    @patch('main.to_mysql', return_value=False)
+    @patch('main.blob_upload', return_value='uploaded')
+    @patch('movies.write_watermark')
+    @patch('movies.normalize', return_value={})
+    @patch('movies.patch_merged')
+    @patch('movies.changed_ids', return_value={603})
+    @patch('movies.read_watermark', return_value=date(2023, 1, 1))
+    def test_incremental_keeps_watermark(self, mock_read_watermark, mock_changed_ids, mock_patch_merged, mock_normalize,
+                                         mock_write_watermark, mock_blob_upload, mock_to_mysql):
+        mock_patch_merged.return_value = ({1999: pd.DataFrame({'ID': [603]})}, [])
+        # every movie was patched but the year didn't make it into MySQL, the next run reads the same changes again
+        main.incremental('US')
+        mock_to_mysql.assert_called_once()
+        mock_write_watermark.assert_not_called()
+
+        mock_to_mysql.return_value = True
+        main.incremental('US')
+        mock_write_watermark.assert_called_once_with('US', date.today())
+
+
+    @patch('main.to_mysql', return_value=False)
+    @patch('main.blob_upload', return_value='uploaded')
+    def test_load_year_marks_only_success(self, mock_blob_upload, mock_to_mysql):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = movies.RunManifest(f"{tmp}/manifest.sqlite")
+            manifest.add_pages('US', 1999, [1])
+            manifest.mark('US', 1999, 1, 'fetched')
+            merged = (1999, pd.DataFrame({'ID': [603]}), self.tables())
+            # a rolled back load is not recorded, --resume loads the year again
+            with self.assertRaises(sinks.SinkError):
+                main.load_year('US', merged, manifest)
+            self.assertTrue(manifest.reached('US', 1999, 'uploaded'))
+            self.assertFalse(manifest.reached('US', 1999, 'loaded'))
+
+            with patch('storage.blob_upload', return_value='failed'), self.assertRaises(sinks.SinkError):
+                main.load_year('US', merged, manifest, sinks=[sinks.BlobSink()])
+            self.assertFalse(manifest.reached('US', 1999, 'loaded'))
+
+    @patch('main.to_mysql', return_value=True)
+    @patch('main.blob_upload', side_effect=['failed', 'uploaded'])
+    def test_load_year_retries_failed_upload(self, mock_blob_upload, mock_to_mysql):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = movies.RunManifest(f"{tmp}/manifest.sqlite")
+            manifest.add_pages('US', 1999, [1])
+            manifest.mark('US', 1999, 1, 'fetched')
+            merged = (1999, pd.DataFrame({'ID': [603]}), self.tables())
+            with self.assertRaises(sinks.SinkError):
+                main.load_year('US', merged, manifest)
+            self.assertFalse(manifest.reached('US', 1999, 'uploaded'))
+            self.assertTrue(manifest.reached('US', 1999, 'loaded'))
+            # a successful load doesn't hide the failed upload, --resume uploads the year without loading it again
+            main.load_year('US', merged, manifest)
+            self.assertEqual(mock_blob_upload.call_count, 2)
+            mock_to_mysql.assert_called_once()
+            self.assertTrue(manifest.reached('US', 1999, 'uploaded'))
+
+    @patch('movies.get_page_data')
+    @patch('movies.discover_year')
+    def test_main_survives_failed_discover(self, mock_discover_year, mock_get_page_data):
+        def discover_year(region, year):
+            if year == 1999:
+                raise requests.exceptions.ConnectionError()
+            return year, [1], {'results': []}
+        mock_discover_year.side_effect = discover_year
+        mock_get_page_data.side_effect = lambda region, year, page, response, output, append: (region, year, None, pd.DataFrame(), [])
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(movies.get_config(), {'data_dir': tmp}):
+            # a year that can't be discovered is given up on, the others are still fetched
+            main.main('US', 1999, 2000, blob=False, sql=False, max_in_flight=2)
+            mock_get_page_data.assert_called_once_with('US', 2000, 1, {'results': []}, True, 'credits')
+            manifest = movies.RunManifest()
+            self.assertEqual(manifest.pages('US', 1999, states=['failed']), [0])
+            self.assertTrue(manifest.reached('US', 2000, 'fetched'))
+
+    def test_resume_needs_threads_engine(self):
+        # the async engine doesn't record pages, resuming it would quietly fetch everything again
+        with self.assertRaises(typer.BadParameter):
+            main.main('US', 1999, 1999, engine='async', resume=True)
+
+if __name__ == '__main__':
+    unittest.main()
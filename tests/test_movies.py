@@ -1,25 +1,75 @@
+import copy
+from datetime import date
+import json
+import os
 import pandas as pd
 from pathlib import Path
+import re
+import requests
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import tmdbsimple as tmdb
 import unittest
 from unittest.mock import patch, MagicMock
+import multiprocessing
 
 # Having trouble importing movies module. Add the root project directory to Python path to find it.
 root_dir = str(Path(__file__).resolve().parent.parent)
 sys.path.append(root_dir)
 
 import movies
+from benchmarks import Catalog, MockTMDB
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from movies.cache import CachedSession
+from movies.client import POOL_STATS, TMDBAdapter
+from movies.retry import AIMDLimiter, retry_after, with_retries
+
+# Seconds importing movies, storage, sinks and main may take in a fresh interpreter, pandas alone takes about as long
+IMPORT_BUDGET = 0.5
+# Imported by the commands that need them, never at import
+HEAVY_MODULES = ['pandas', 'pyarrow', 'azure', 'pymysql']
+
+def setUpModule():
+    # Responses are cached in a temporary directory instead of the repository's data directory
+    global cache_dir, env
+    cache_dir = tempfile.TemporaryDirectory()
+    path = os.path.join(cache_dir.name, 'config.json')
+    with open(path, 'w') as file:
+        json.dump({**movies.get_config(), 'cache': {'path': os.path.join(cache_dir.name, 'tmdb_cache.sqlite')}}, file)
+    env = patch.dict(os.environ, {'TMDB_CONFIG': path})
+    env.start()
+    movies.reset_config()
+
+
+def tearDownModule():
+    env.stop()
+    movies.reset_config()
+    cache_dir.cleanup()
+
+
+def claim_all(path, claimed):
+    queue = movies.WorkQueue(path)
+    while True:
+        unit = queue.claim(str(os.getpid()))
+        if unit == None:
+            return
+        claimed.put(unit[2])
+        queue.complete(*unit[:3])
+
 
 class TestMovies(unittest.TestCase):
 
     # Use patch decorator to mock functions using http requests
-    @patch('movies.discover.movie')
-    def test_list_pages(self, mock_discover_movie):
+    @patch('movies.tmdb.Discover')
+    def test_list_pages(self, mock_tmdb_Discover):
         # Control the value that the mocked object returns to my function
+        mock_discover_movie = mock_tmdb_Discover.return_value.movie
         mock_discover_movie.return_value = {'total_pages': 6}
         result = movies.list_pages('US', 1914)
-        mock_discover_movie.assert_called_with(region='US', primary_release_year=1914, include_adult=False, with_runtime_gte='40')
+        mock_discover_movie.assert_called_with(region='US', page=1, primary_release_year=1914, include_adult=False, with_runtime_gte='40')
 
         self.assertIsInstance(result, list)
         # returned result should match expected value
@@ -27,6 +77,71 @@ class TestMovies(unittest.TestCase):
         for item in result:
             self.assertIsInstance(item, int, 'each result item should be int value')
 
+    @patch('movies.tmdb.Discover')
+    def test_discover_year(self, mock_tmdb_Discover):
+        response = {'total_pages': 3, 'results': [{'id': 603}]}
+        mock_discover_movie = mock_tmdb_Discover.return_value.movie
+        mock_discover_movie.return_value = response
+        result = movies.discover_year('US', 1999)
+        mock_discover_movie.assert_called_once_with(region='US', page=1, primary_release_year=1999, include_adult=False, with_runtime_gte='40')
+        self.assertEqual(result, (1999, [1, 2, 3], response))
+
+    @patch('movies.tmdb.Discover')
+    def test_discover_movies_not_shared(self, mock_tmdb_Discover):
+        mock_tmdb_Discover.side_effect = lambda: MagicMock()
+        threads = [threading.Thread(target=movies.discover_movies, args=('US', 1999, page)) for page in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every request gets its own Discover object, nothing reads another thread's response
+        self.assertEqual(mock_tmdb_Discover.call_count, 4)
+
+    @patch('movies.movies.fetch_movie')
+    @patch('movies.tmdb.Discover')
+    def test_get_page_data(self, mock_tmdb_Discover, mock_fetch_movie):
+        movie = MagicMock(title='The Matrix', original_title='The Matrix', release_date='1999-03-30', original_language='en',
+                          overview='plot', genres=[], production_countries=[], production_companies=[],
+                          budget=63000000, revenue=463517383)
+        mock_fetch_movie.return_value = (movie, {'cast': [], 'crew': []})
+        result = movies.get_page_data('US', 1999, 1, {'total_pages': 1, 'results': [{'id': 603}]}, output=False)
+        # the page 1 response is reused, discover should not be requested again
+        mock_tmdb_Discover.assert_not_called()
+        self.assertIsNone(result[2])
+        self.assertEqual(list(result[3]['ID']), [603])
+
+    @patch('movies.movies.with_retries')
+    def test_fetch_page_movies(self, mock_with_retries):
+        def movie(revenue):
+            return MagicMock(title='t', original_title='t', release_date='1999-03-30', original_language='en', overview='p',
+                             genres=[], production_countries=[], production_companies=[], budget=0, revenue=revenue)
+        fetched = {603: (movie(3), {'cast': [], 'crew': []}), 605: (movie(1), {'cast': [], 'crew': []})}
+        def fetch(func, movie_id, append):
+            if movie_id not in fetched:
+                raise requests.exceptions.ConnectionError()
+            return fetched[movie_id]
+        mock_with_retries.side_effect = fetch
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                # a failed movie doesn't throw away the rest of the page
+                result = movies.get_page_data('US', 1999, 2, {'results': [{'id': 603}, {'id': 604}, {'id': 605}]})
+                self.assertEqual(result[2], 2)
+                self.assertEqual(result[4], [604])
+                self.assertEqual(list(result[3]['ID']), [603, 605])
+
+                # only the failed id is fetched again and added to the saved page
+                fetched[604] = (movie(2), {'cast': [], 'crew': []})
+                mock_with_retries.reset_mock()
+                result = movies.fetch_page_movies('US', 1999, 2, [604], keep_saved=True)
+                self.assertEqual(mock_with_retries.call_count, 1)
+                self.assertIsNone(result[2])
+                saved = movies.read_output(Path(f'./data/US_movie_data_1999/US_movie_data_1999-2.{movies.OUTPUT_FORMAT}'))
+                self.assertEqual(list(saved['ID']), [603, 604, 605])
+            finally:
+                os.chdir(cwd)
+
     @patch('movies.tmdb.Movies')
     def test_get_gen_info(self, mock_tmdb_Movies):
         # mock the object returned from tmdb.Movies()
@@ -87,6 +202,37 @@ class TestMovies(unittest.TestCase):
                 self.assertIsInstance(k, str, 'dictionary key should be a str')
                 self.assertIsInstance(v, (str, int), 'key values can be str or int')
 
+    def test_credit_projection(self):
+        catalog = Catalog(years=[1999], pages=1, per_page=1, cast_mean=200, cast_max=400)
+        credits = copy.deepcopy(catalog.credits[1])
+        credits['cast'].reverse()
+        # the top billed cast members are kept whatever order TMDB lists them in
+        cast = movies.get_cast(credits, limit=3, fields=['id', 'name', 'order'])
+        self.assertEqual([member['order'] for member in cast], [0, 1, 2])
+        self.assertEqual(movies.get_cast({'cast': []}, limit=3), [])
+        crew = movies.get_crew(credits, ['Screenplay', 'Producer'])
+        self.assertEqual({member['job'] for member in crew}, {'Screenplay', 'Producer'})
+        self.assertEqual(len(crew), sum(member['job'] in ('Screenplay', 'Producer') for member in credits['crew']))
+
+        config = {'credits': {'cast_limit': 5, 'cast_fields': ['id', 'name', 'character'], 'crew_jobs': ['Writer']}}
+        with patch('movies.movies.get_config', return_value=config):
+            movies.movie_schema.cache_clear()
+            try:
+                batch = movies.MovieBatch(1)
+                batch.add(movies.extract_movie(1, MagicMock(**copy.deepcopy(catalog.movies[1])), catalog.credits[1]))
+                table = batch.to_arrow()
+                self.assertEqual([field.name for field in table.schema.field('CAST').type.value_type], ['id', 'name', 'character'])
+                record = table.to_pylist()[0]
+                self.assertEqual(len(record['CAST']), 5)
+                self.assertEqual(record['CAST'][0]['character'], 'Character 0')
+                self.assertTrue(all(member['job'] == 'Writer' for member in record['CREW']))
+
+                config['credits']['cast_fields'] = ['id', 'popularity']
+                with self.assertRaises(ValueError):
+                    movies.credit_options()
+            finally:
+                movies.movie_schema.cache_clear()
+
     @patch('movies.tmdb.Movies')
     def test_get_funders(self, mock_tmdb_Movies):
         movie = MagicMock()
@@ -117,18 +263,643 @@ class TestMovies(unittest.TestCase):
             self.assertIsInstance(k, str)
             self.assertIsInstance(v, int)
 
+    @patch('movies.tmdb.Movies')
+    def test_fetch_movie(self, mock_tmdb_Movies):
+        movie = MagicMock()
+        movie.info.return_value = {'id': 603, 'title': 'The Matrix', 'credits': {'cast': [], 'crew': []}}
+        mock_tmdb_Movies.return_value = movie
+        result = movies.fetch_movie(603, 'credits, keywords')
+        # details and credits should come back from a single request
+        movie.info.assert_called_once_with(append_to_response='credits,keywords')
+        movie.credits.assert_not_called()
+        self.assertEqual(result, (movie, {'cast': [], 'crew': []}))
+
+    @patch('movies.tmdb.Movies')
+    def test_fetch_movie_without_append(self, mock_tmdb_Movies):
+        movie = MagicMock()
+        movie.credits.return_value = {'cast': [], 'crew': []}
+        mock_tmdb_Movies.return_value = movie
+        result = movies.fetch_movie(603, '')
+        movie.info.assert_called_once_with()
+        movie.credits.assert_called_once()
+        self.assertEqual(result[1], {'cast': [], 'crew': []})
+
+    @patch('movies.async_engine.fetch_movie')
+    @patch('movies.movies.tmdb.Discover')
+    def test_run_async(self, mock_Discover, mock_fetch_movie):
+        # two pages of two movies each for every year
+        def discover_movie(region, page, primary_release_year, include_adult, with_runtime_gte):
+            ids = [primary_release_year * 10 + page * 2, primary_release_year * 10 + page * 2 + 1]
+            return {'total_pages': 2, 'results': [{'id': id} for id in ids]}
+        mock_Discover.return_value.movie.side_effect = discover_movie
+
+        in_flight = [0, 0]
+        lock = threading.Lock()
+        def fetch_movie(movie_id, append):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            if movie_id == 20013:
+                raise requests.exceptions.HTTPError(response=self.fake_response(404))
+            movie = MagicMock(title='t', original_title='t', release_date='2000-01-01', original_language='en',
+                              overview='plot', genres=[], production_countries=[], production_companies=[],
+                              budget=0, revenue=movie_id)
+            return movie, {'cast': [], 'crew': []}
+        mock_fetch_movie.side_effect = fetch_movie
+
+        dfs, missing, failed_ids = movies.run_async('US', 2000, 2001, output=False, max_in_flight=3, rate=1000, burst=1000)
+        self.assertEqual(missing, {2000: [], 2001: []})
+        self.assertEqual(list(dfs[2000]['ID']), [20005, 20004, 20003, 20002])
+        # a failed movie is reported by id, the rest of its page is kept
+        self.assertEqual(failed_ids, {2000: {}, 2001: {1: [20013]}})
+        self.assertEqual(list(dfs[2001]['ID']), [20015, 20014, 20012])
+        self.assertEqual(list(dfs[2001].columns), movies.COLUMNS)
+        self.assertLessEqual(in_flight[1], 3, 'concurrent requests should never exceed max_in_flight')
+
+    @patch('movies.async_engine.backoff', return_value=0)
+    @patch('movies.async_engine.fetch_movie')
+    @patch('movies.movies.tmdb.Discover')
+    def test_run_async_retries_discover(self, mock_Discover, mock_fetch_movie, mock_backoff):
+        # every year's first discover request fails with a 503, page 2 fails more times than one retry pass allows
+        failures = {(2000, 1): 1, (2001, 1): 1, (2000, 2): movies.MAX_ATTEMPTS + 1}
+        def discover_movie(region, page, primary_release_year, include_adult, with_runtime_gte):
+            if failures.get((primary_release_year, page), 0) > 0:
+                failures[(primary_release_year, page)] -= 1
+                raise requests.exceptions.HTTPError(response=self.fake_response(503))
+            return {'total_pages': 2, 'results': [{'id': primary_release_year * 10 + page}]}
+        mock_Discover.return_value.movie.side_effect = discover_movie
+        movie = MagicMock(title='t', original_title='t', release_date='2000-01-01', original_language='en', overview='plot',
+                          genres=[], production_countries=[], production_companies=[], budget=0, revenue=0)
+        mock_fetch_movie.return_value = (movie, {'cast': [], 'crew': []})
+
+        dfs, missing, failed_ids = movies.run_async('US', 2000, 2001, output=False, rate=1000, burst=1000)
+        # a transient failure of one year's discover doesn't abort the others, failed pages are requeued by the fetcher
+        self.assertEqual(missing, {2000: [], 2001: []})
+        self.assertEqual(sorted(dfs[2000]['ID']), [20001, 20002])
+        self.assertEqual(sorted(dfs[2001]['ID']), [20011, 20012])
+
+    @patch('movies.async_engine.backoff', return_value=0)
+    @patch('movies.async_engine.fetch_movie')
+    @patch('movies.movies.tmdb.Discover')
+    def test_run_async_final_retries(self, mock_Discover, mock_fetch_movie, mock_backoff):
+        mock_Discover.return_value.movie.side_effect = lambda region, page, primary_release_year, include_adult, with_runtime_gte: \
+            {'total_pages': 1, 'results': [{'id': primary_release_year * 10 + i} for i in range(2)]}
+        # the first request for movie 20001 fails for good, the final retry gets it
+        failures = {20001: 1}
+        buckets = []
+        def fetch_movie(movie_id, append):
+            buckets.append(movies.adapter.bucket)
+            if failures.get(movie_id, 0) > 0:
+                failures[movie_id] -= 1
+                raise requests.exceptions.HTTPError(response=self.fake_response(404))
+            movie = MagicMock(title='t', original_title='t', release_date='2000-01-01', original_language='en',
+                              overview='plot', genres=[], production_countries=[], production_companies=[],
+                              budget=0, revenue=movie_id)
+            return movie, {'cast': [], 'crew': []}
+        mock_fetch_movie.side_effect = fetch_movie
+        finished = []
+
+        dfs, missing, failed_ids = movies.run_async('US', 2000, 2001, output=False, rate=1000, burst=1000,
+                                                    on_year=lambda *year: finished.append(year))
+        self.assertEqual(missing, {2000: [], 2001: []})
+        self.assertEqual(failed_ids, {2000: {}, 2001: {}})
+        self.assertEqual(list(dfs[2000]['ID']), [20001, 20000])
+        # the retry went through the fetcher's rate limit, and each year was handed over once it was final
+        self.assertEqual(len(buckets), 5)
+        self.assertNotIn(None, buckets)
+        self.assertEqual(sorted(year[:3] for year in finished), [(2000, [], {}), (2001, [], {})])
+        self.assertEqual(list(dict(year[::3] for year in finished)[2000]['ID']), [20001, 20000])
+
+    def fake_response(self, status_code, body=b'', headers={}):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = body
+        response.headers.update(headers)
+        return response
+
+    @patch('requests.Session.request')
+    def test_cached_session(self, mock_request):
+        mock_request.return_value = self.fake_response(200, b'{"id": 603}', {'ETag': '"abc"'})
+        with tempfile.TemporaryDirectory() as tmp:
+            sess = CachedSession(path=f"{tmp}/cache.sqlite", ttls=[(r'/movie/\d+', 60)])
+            url = 'https://api.themoviedb.org/3/movie/603'
+            first = sess.request('GET', url, params={'api_key': 'secret', 'append_to_response': 'credits'})
+            # a different api key is still the same endpoint and params
+            second = sess.request('GET', url, params={'api_key': 'other', 'append_to_response': 'credits'})
+            self.assertEqual(mock_request.call_count, 1)
+            self.assertEqual(first.json(), second.json())
+            self.assertEqual((sess.stats()['hits'], sess.stats()['misses']), (1, 1))
+
+            # once stale, the entry is revalidated with its ETag and a 304 serves the cached body
+            sess.ttls = [(re.compile(r'/movie/\d+'), 0)]
+            mock_request.return_value = self.fake_response(304)
+            third = sess.request('GET', url, params={'api_key': 'secret', 'append_to_response': 'credits'})
+            self.assertEqual(mock_request.call_args.kwargs['headers']['If-None-Match'], '"abc"')
+            self.assertEqual(third.json(), {'id': 603})
+            self.assertEqual(sess.stats()['revalidated'], 1)
+            sess.conn.close()
+
+    @patch('requests.Session.request')
+    def test_cached_session_eviction(self, mock_request):
+        mock_request.return_value = self.fake_response(200, b'0123456789')
+        with tempfile.TemporaryDirectory() as tmp:
+            sess = CachedSession(path=f"{tmp}/cache.sqlite", max_bytes=25)
+            for movie_id in range(3):
+                sess.request('GET', f'https://api.themoviedb.org/3/movie/{movie_id}')
+            # the least recently used entry is evicted to stay under the size cap
+            self.assertEqual(sess.stats()['entries'], 2)
+            self.assertEqual(sess.stats()['bytes'], 20)
+            sess.request('GET', 'https://api.themoviedb.org/3/movie/0')
+            self.assertEqual(mock_request.call_count, 4)
+            sess.conn.close()
+
+    @patch('requests.Session.request')
+    def test_cached_session_batches_access_times(self, mock_request):
+        mock_request.return_value = self.fake_response(200, b'0123456789')
+        with tempfile.TemporaryDirectory() as tmp:
+            sess = CachedSession(path=f"{tmp}/cache.sqlite", max_bytes=25)
+            for movie_id in range(2):
+                sess.request('GET', f'https://api.themoviedb.org/3/movie/{movie_id}')
+            stored = sess.conn.execute("SELECT accessed_at FROM responses WHERE key LIKE '%/movie/0?'").fetchone()[0]
+            # a hit doesn't write its access time straight away
+            time.sleep(0.01)
+            sess.request('GET', 'https://api.themoviedb.org/3/movie/0')
+            self.assertEqual(sess.conn.execute("SELECT accessed_at FROM responses WHERE key LIKE '%/movie/0?'").fetchone()[0], stored)
+            # but it is written before an eviction, so the entry hit last is kept
+            sess.request('GET', 'https://api.themoviedb.org/3/movie/2')
+            keys = [row[0] for row in sess.conn.execute("SELECT key FROM responses ORDER BY key")]
+            self.assertEqual(keys, ['https://api.themoviedb.org/3/movie/0?', 'https://api.themoviedb.org/3/movie/2?'])
+            sess.request('GET', 'https://api.themoviedb.org/3/movie/2')
+            sess.close()
+            accessed = CachedSession(path=f"{tmp}/cache.sqlite").conn.execute(
+                "SELECT accessed_at FROM responses WHERE key LIKE '%/movie/2?'").fetchone()[0]
+            self.assertGreater(accessed, stored)
+            sess.conn.close()
+
+    @patch('movies.retry.time.sleep')
+    @patch('movies.incremental.tmdb.Changes')
+    def test_changed_ids(self, mock_Changes, mock_sleep):
+        # the first request fails once with a 503 and is retried
+        failures = [self.fake_response(503)]
+        def changes_movie(start_date, end_date, page):
+            if failures:
+                raise requests.exceptions.HTTPError(response=failures.pop())
+            return {'total_pages': 2, 'results': [{'id': hash((start_date, page)) % 1000}, {'id': 603}]}
+        mock_Changes.return_value.movie.side_effect = changes_movie
+        result = movies.changed_ids(date(2023, 1, 1), date(2023, 1, 20))
+        # 20 days is split into a 14 day and a 6 day window, each with two pages
+        windows = [(c.kwargs['start_date'], c.kwargs['end_date']) for c in mock_Changes.return_value.movie.call_args_list]
+        self.assertEqual(windows, [('2023-01-01', '2023-01-14'), ('2023-01-01', '2023-01-14'), ('2023-01-01', '2023-01-14'),
+                                   ('2023-01-15', '2023-01-20'), ('2023-01-15', '2023-01-20')])
+        self.assertIn(603, result)
+
+    def test_watermark(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f"{tmp}/watermark.json"
+            self.assertIsNone(movies.read_watermark('US', path))
+            movies.write_watermark('US', date(2023, 1, 20), path)
+            movies.write_watermark('GB', date(2023, 1, 1), path)
+            self.assertEqual(movies.read_watermark('US', path), date(2023, 1, 20))
+
+    @patch('movies.incremental.fetch_movie')
+    def test_patch_merged(self, mock_fetch_movie):
+        movie = MagicMock(title='The Matrix', original_title='The Matrix', release_date='1999-03-30', original_language='en',
+                          overview='plot', genres=[{'id': 28, 'name': 'Action'}], production_countries=[], production_companies=[],
+                          budget=63000000, revenue=467222728)
+        mock_fetch_movie.return_value = (movie, {'cast': [], 'crew': []})
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                merged = pd.DataFrame({'ID': [603, 550], 'TITLE': ['Matrix', 'Fight Club'], 'ORIGINAL_TITLE': ['Matrix', 'Fight Club'],
+                                       'RELEASE_DATE': ['1999-03-30', '1999-10-15'], 'ORIGINAL_LANGUAGE': ['en', 'en'], 'PLOT': ['a', 'b'],
+                                       'DIRECTORS': [[], []], 'CAST': [[], []], 'GENRES': [[], []],
+                                       'PRODUCTION_COUNTRIES': [[], []], 'PRODUCTION_COMPANIES': [[], []],
+                                       'BUDGET': [63000000, 63000000], 'REVENUE': [463517383, 100853753]})
+                movies.save_output('US', 1999, merged, 'US_movie_data_1999-merged')
+                patched, failed = movies.patch_merged('US', {603, 27205})
+                self.assertEqual(failed, [])
+                self.assertEqual(list(patched), [1999])
+                self.assertEqual(list(patched[1999]['ID']), [603])
+                self.assertEqual(patched[1999]['GENRES'][0], [{'id': 28, 'name': 'Action'}])
+                result = movies.read_merged('US')[1999]
+                self.assertEqual(list(result['ID']), [603, 550])
+                self.assertEqual(result['TITLE'][0], 'The Matrix')
+                self.assertEqual(result['REVENUE'][0], 467222728)
+                self.assertEqual(result['GENRES'][0], [{'id': 28, 'name': 'Action'}])
+                # the normalized tables saved with the merged output are regenerated
+                genres = movies.read_output(movies.year_dir('US', 1999) / f"US_movie_data_1999-merged-movie_genres.{movies.output_format()}")
+                self.assertEqual(list(genres.itertuples(index=False, name=None)), [(603, 28)])
+            finally:
+                os.chdir(cwd)
+
     @patch('pandas.DataFrame.to_csv')
     def test_output_csv(self, mock_to_csv):
-        data_dir = './data'
+        data_dir = movies.data_dir()
         region = 'US'
         year = '2077'
         df = pd.DataFrame({'a': [1, 2, 3], 'b': [4, 5, 6]})
         filename = f'{region}_movie_data_{year}-1.csv'
         movies.output_csv(region, year, df, filename)
-        test_dir = Path(f"{data_dir}/{region}_movie_data_{year}")
+        test_dir = data_dir / f"{region}_movie_data_{year}"
         self.assertTrue(test_dir.is_dir())
         mock_to_csv.assert_called_with(test_dir/filename, index=False)
 
+    def test_read_output(self):
+        df = pd.DataFrame({'ID': [603], 'TITLE': ['The Matrix'], 'ORIGINAL_TITLE': ['The Matrix'], 'RELEASE_DATE': ['1999-03-30'],
+                           'ORIGINAL_LANGUAGE': ['en'], 'PLOT': ['plot'], 'DIRECTORS': [[{'id': 9339, 'name': 'Lilly Wachowski'}]],
+                           'CAST': [[{'id': 6384, 'name': 'Keanu Reeves'}]], 'GENRES': [[]],
+                           'PRODUCTION_COUNTRIES': [[{'iso_3166_1': 'US', 'name': 'United States of America'}]],
+                           'PRODUCTION_COMPANIES': [[{'id': 79, 'name': 'Village Roadshow Pictures', 'origin_country': 'US'}]],
+                           'FINANCIAL': [{'budget': 63000000, 'revenue': 463517383}]})
+        with tempfile.TemporaryDirectory() as tmp:
+            df.to_parquet(f"{tmp}/page.parquet", index=False)
+            df.to_csv(f"{tmp}/page.csv", index=False)
+            # nested fields come back typed from parquet, and parsed from csv
+            # FINANCIAL dicts of older outputs are split into BUDGET and REVENUE
+            for path in (Path(f"{tmp}/page.parquet"), Path(f"{tmp}/page.csv")):
+                result = movies.read_output(path)
+                self.assertEqual(result['CAST'][0], [{'id': 6384, 'name': 'Keanu Reeves'}])
+                self.assertEqual(result['GENRES'][0], [])
+                self.assertNotIn('FINANCIAL', result.columns)
+                self.assertEqual((result['BUDGET'][0], result['REVENUE'][0]), (63000000, 463517383))
+
+    def test_save_empty_page(self):
+        # every movie of the page failed, the page is still saved with typed columns
+        df = movies.sort_by_revenue(movies.MovieBatch(3).to_frame())
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                movies.save_output('US', 2000, df, 'US_movie_data_2000-1')
+                result = movies.read_output(movies.year_dir('US', 2000) / f"US_movie_data_2000-1.{movies.output_format()}")
+                self.assertEqual(list(result.columns), movies.COLUMNS)
+                self.assertEqual(len(result), 0)
+            finally:
+                os.chdir(cwd)
+
+    def test_sort_by_revenue(self):
+        df = pd.DataFrame({'ID': [1, 2, 3, 4], 'BUDGET': [0, 0, 0, 0], 'REVENUE': [10, 40, 20, 30]})
+        self.assertEqual(list(movies.sort_by_revenue(df)['ID']), [2, 4, 3, 1])
+        top = movies.sort_by_revenue(df, top_n=2)
+        self.assertEqual(list(top['ID']), [2, 4])
+        self.assertEqual(top['REVENUE'].dtype, 'int64')
+
+    def test_movie_batch(self):
+        def movie(title, revenue, companies):
+            return MagicMock(title=title, original_title=title, release_date='1999-03-30', original_language='en', overview='plot',
+                             genres=[{'id': 28, 'name': 'Action'}], production_countries=[], production_companies=companies,
+                             budget=63000000, revenue=revenue)
+        credits = {'cast': [{'id': 6384, 'name': 'Keanu Reeves', 'order': 0, 'character': 'Neo'}],
+                   'crew': [{'id': 9339, 'name': 'Lilly Wachowski', 'job': 'Director'}, {'id': 1, 'name': 'Editor', 'job': 'Editor'}]}
+        batch = movies.MovieBatch(3)
+        batch.add(movies.extract_movie(603, movie('The Matrix', 463517383,
+                                                  [{'id': 79, 'logo_path': None, 'name': 'Village Roadshow Pictures', 'origin_country': ''}]),
+                                       credits))
+        batch.add(movies.extract_movie(604, movie('The Matrix Reloaded', 741847937, []), {'cast': [], 'crew': []}))
+        # slots of movies that were never added are dropped
+        self.assertEqual(len(batch), 2)
+        expected = pd.DataFrame({'ID': [603, 604], 'TITLE': ['The Matrix', 'The Matrix Reloaded'],
+                                 'ORIGINAL_TITLE': ['The Matrix', 'The Matrix Reloaded'], 'RELEASE_DATE': ['1999-03-30', '1999-03-30'],
+                                 'ORIGINAL_LANGUAGE': ['en', 'en'], 'PLOT': ['plot', 'plot'],
+                                 'DIRECTORS': [[{'id': 9339, 'name': 'Lilly Wachowski'}], []],
+                                 'CAST': [[{'id': 6384, 'name': 'Keanu Reeves'}], []], 'CREW': [[], []],
+                                 'GENRES': [[{'id': 28, 'name': 'Action'}], [{'id': 28, 'name': 'Action'}]],
+                                 'PRODUCTION_COUNTRIES': [[], []],
+                                 'PRODUCTION_COMPANIES': [[{'id': 79, 'name': 'Village Roadshow Pictures', 'origin_country': 'no info'}], []],
+                                 'BUDGET': [63000000, 63000000], 'REVENUE': [463517383, 741847937]})
+        pd.testing.assert_frame_equal(batch.to_frame(), expected)
+        # more movies than expected are still added
+        for movie_id in [605, 606]:
+            batch.add(movies.extract_movie(movie_id, movie('t', 0, []), {'cast': [], 'crew': []}))
+        table = batch.to_arrow()
+        self.assertEqual(table.column('ID').to_pylist(), [603, 604, 605, 606])
+        self.assertEqual(table.schema, movies.movie_schema())
+
+    def test_normalize(self):
+        df = pd.DataFrame({'ID': [603, 604], 'TITLE': ['The Matrix', 'The Matrix Reloaded'], 'ORIGINAL_TITLE': ['The Matrix', 'The Matrix Reloaded'],
+                           'RELEASE_DATE': ['1999-03-30', '2003-05-15'], 'ORIGINAL_LANGUAGE': ['en', 'en'], 'PLOT': ['a', 'b'],
+                           'DIRECTORS': [[{'id': 9339, 'name': 'Lilly Wachowski'}], [{'id': 9339, 'name': 'Lilly Wachowski'}]],
+                           'CAST': [[{'id': 6384, 'name': 'Keanu Reeves'}, {'id': 2975, 'name': 'Laurence Fishburne'}],
+                                    [{'id': 6384, 'name': 'Keanu Reeves'}]],
+                           'GENRES': [[{'id': 28, 'name': 'Action'}], []],
+                           'PRODUCTION_COUNTRIES': [[{'iso_3166_1': 'US', 'name': 'United States of America'}], []],
+                           'PRODUCTION_COMPANIES': [[{'id': 79, 'name': 'Village Roadshow Pictures', 'origin_country': 'US'}],
+                                                    [{'id': 79, 'name': 'Village Roadshow Pictures', 'origin_country': 'US'}]],
+                           'BUDGET': [63000000, 150000000], 'REVENUE': [463517383, 741847937]})
+        tables = movies.normalize(df)
+        # entities are deduplicated across every movie, junction rows keep one row per pair
+        self.assertEqual(list(tables['actors'].itertuples(index=False, name=None)), [(2975, 'Laurence Fishburne'), (6384, 'Keanu Reeves')])
+        self.assertEqual(list(tables['movie_actors'].itertuples(index=False, name=None)), [(603, 6384), (603, 2975), (604, 6384)])
+        self.assertEqual(list(tables['directors']['id']), [9339])
+        self.assertEqual(list(tables['movie_genres'].columns), ['movie_id', 'genre_id'])
+        self.assertEqual(list(tables['companies'].itertuples(index=False, name=None)), [(79, 'Village Roadshow Pictures', 'US')])
+        self.assertEqual(list(tables['countries'].columns), ['id', 'name'])
+        self.assertEqual(list(tables['plots'].itertuples(index=False, name=None)), [('a', 603), ('b', 604)])
+        self.assertEqual(list(tables['movie_revenue'].itertuples(index=False, name=None)),
+                         [(603, 463517383, 63000000), (604, 741847937, 150000000)])
+
+    def test_merge_stream(self):
+        def page(ids):
+            return pd.DataFrame({'ID': ids, 'TITLE': 't', 'ORIGINAL_TITLE': 't', 'RELEASE_DATE': '2000-01-01', 'ORIGINAL_LANGUAGE': 'en',
+                                 'PLOT': 'p', 'DIRECTORS': [[] for _ in ids], 'CAST': [[{'id': id, 'name': 'actor'}] for id in ids],
+                                 'GENRES': [[] for _ in ids], 'PRODUCTION_COUNTRIES': [[] for _ in ids],
+                                 'PRODUCTION_COMPANIES': [[] for _ in ids], 'BUDGET': 0, 'REVENUE': [id % 7 for id in ids]})
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                for number, ids in enumerate([list(range(0, 10)), list(range(5, 15)), list(range(15, 25))], start=1):
+                    movies.save_output('US', 2000, page(ids), f'US_movie_data_2000-{number}')
+                # stray files are not pages
+                movies.save_output('US', 2000, page([99]), 'US_movie_data_2000-1 (copy)')
+                expected = movies.merge_dfs('US', 2000)
+
+                stats = movies.merge_stream('US', 2000, chunk_rows=4, spill_rows=6)
+                self.assertEqual(stats['pages'], 3)
+                self.assertEqual(stats['duplicates'], 5)
+                self.assertGreater(stats['runs'], 1)
+                self.assertEqual(stats['rows_written'], 25)
+                result = movies.read_output(Path('./data/US_movie_data_2000/US_movie_data_2000-merged.parquet'))
+                self.assertEqual(list(result['ID']), list(expected['ID']))
+                self.assertEqual(result['CAST'][3], expected['CAST'].iloc[3])
+
+                movies.merge_stream('US', 2000, csv=True, top_n=3, chunk_rows=4)
+                result = movies.read_output(Path('./data/US_movie_data_2000/US_movie_data_2000-merged.csv'))
+                self.assertEqual(list(result['REVENUE']), [6, 6, 6])
+            finally:
+                os.chdir(cwd)
+
+    def test_merge_stream_empty_year(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                # a year whose only page has no movies is merged into empty outputs, csv included
+                movies.save_output('US', 2000, movies.sort_by_revenue(movies.MovieBatch().to_frame()), 'US_movie_data_2000-1')
+                stats = movies.merge_stream('US', 2000, csv=True)
+                self.assertEqual(stats['rows_written'], 0)
+                for suffix in ('parquet', 'csv'):
+                    result = movies.read_output(Path(f'./data/US_movie_data_2000/US_movie_data_2000-merged.{suffix}'))
+                    self.assertEqual(list(result.columns), movies.COLUMNS)
+                    self.assertEqual(len(result), 0)
+            finally:
+                os.chdir(cwd)
+
+    def test_run_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'manifest.sqlite')
+            manifest = movies.RunManifest(path)
+            self.assertEqual(manifest.year_state('US', 2000), 'pending')
+            manifest.add_pages('US', 2000, [1, 2, 3])
+            manifest.mark('US', 2000, 1, 'fetched')
+            manifest.mark('US', 2000, 2, 'failed')
+            # an interrupted run is picked up from a fresh manifest on the same file
+            manifest = movies.RunManifest(path)
+            manifest.add_pages('US', 2000, [1, 2, 3])
+            self.assertEqual(manifest.pages('US', 2000, states=['pending', 'failed']), [2, 3])
+            self.assertEqual(manifest.year_state('US', 2000), 'pending')
+            manifest.mark('US', 2000, 2, 'fetched')
+            manifest.mark('US', 2000, 3, 'fetched')
+            self.assertTrue(manifest.reached('US', 2000, 'fetched'))
+            # every stage of a year is recorded on its own, a load doesn't imply an upload
+            manifest.mark_year('US', 2000, 'merged')
+            manifest.mark_year('US', 2000, 'loaded')
+            self.assertTrue(manifest.reached('US', 2000, 'merged'))
+            self.assertFalse(manifest.reached('US', 2000, 'uploaded'))
+            self.assertTrue(manifest.reached('US', 2000, 'loaded'))
+            with self.assertRaises(ValueError):
+                manifest.mark_year('US', 2000, 'fetched')
+            manifest.reset('US', 1999, 2000)
+            self.assertEqual(manifest.pages('US', 2000), [])
+            self.assertFalse(manifest.reached('US', 2000, 'merged'))
+
+    def throttled_error(self, wait):
+        response = requests.Response()
+        response.status_code = 429
+        response.headers['Retry-After'] = wait
+        return requests.exceptions.HTTPError(response=response)
+
+    @patch('movies.retry.time.sleep')
+    def test_with_retries(self, mock_sleep):
+        calls = MagicMock(side_effect=[self.throttled_error('3'), requests.exceptions.ConnectTimeout(), 'ok'])
+        self.assertEqual(with_retries(calls, 603), 'ok')
+        self.assertEqual(calls.call_count, 3)
+        # the first wait is at least what TMDB asked for
+        self.assertGreaterEqual(mock_sleep.call_args_list[0].args[0], 3)
+
+        not_found = requests.Response()
+        not_found.status_code = 404
+        calls = MagicMock(side_effect=requests.exceptions.HTTPError(response=not_found))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            with_retries(calls, 603)
+        self.assertEqual(calls.call_count, 1)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(self.throttled_error('2').response), 2)
+        self.assertIsNone(retry_after(requests.Response()))
+        self.assertIsNone(retry_after(self.throttled_error('soon').response))
+
+    def test_aimd_limiter(self):
+        limiter = AIMDLimiter(8, cooldown=60)
+        limiter.acquire()
+        limiter.release(throttled=True, wait=0.05)
+        self.assertEqual(limiter.limit, 4)
+        # every thread waits out the Retry-After
+        tm1 = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - tm1, 0.04)
+        # a burst of 429s only shrinks the limit once per cooldown
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.limit, 4)
+        limiter.acquire()
+        limiter.release()
+        self.assertAlmostEqual(limiter.limit, 4.25)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.throttled, 2)
+
+    def test_tmdb_adapter_reuses_connections(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+            def log_message(self, *args):
+                pass
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            session = requests.Session()
+            session.mount('http://', TMDBAdapter(AIMDLimiter(4), 4))
+            POOL_STATS.reset()
+            for _ in range(5):
+                # tmdbsimple's Connection: close header is dropped so the connection stays open
+                session.get(f'http://127.0.0.1:{server.server_address[1]}/3/movie/603', headers={'Connection': 'close'})
+            stats = POOL_STATS.snapshot()
+            self.assertEqual(stats['requests'], 5)
+            self.assertEqual(stats['connections'], 1)
+            self.assertEqual(stats['reused'], 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_work_queue_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'queue.sqlite')
+            movies.WorkQueue(path).enqueue([('US', 2000, page) for page in range(1, 41)])
+            context = multiprocessing.get_context('fork')
+            claimed = context.Queue()
+            workers = [context.Process(target=claim_all, args=(path, claimed)) for _ in range(3)]
+            for process in workers:
+                process.start()
+            pages = [claimed.get(timeout=30) for _ in range(40)]
+            for process in workers:
+                process.join(timeout=30)
+            # every unit is claimed by exactly one worker process
+            self.assertEqual(sorted(pages), list(range(1, 41)))
+            self.assertEqual(movies.WorkQueue(path).counts(), {'done': 40})
+
+    @patch('movies.shard.get_data')
+    @patch('movies.shard.fetch_page_movies')
+    @patch('movies.shard.discover_year')
+    def test_work(self, mock_discover_year, mock_fetch_page_movies, mock_get_data):
+        mock_discover_year.side_effect = lambda region, year: (year, [1, 2], {})
+        # page 2 of 2001 loses a movie the first time, only that movie is fetched again
+        mock_get_data.side_effect = lambda region, year, page, output, append: \
+            (region, year, page, pd.DataFrame(), [7]) if (year, page) == (2001, 2) else (region, year, None, pd.DataFrame(), [])
+        mock_fetch_page_movies.return_value = ('US', 2001, None, pd.DataFrame(), [])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'queue.sqlite')
+            queue = movies.WorkQueue(path)
+            queue.enqueue([('US', 2000, 0), ('US', 2001, 0)])
+            processed = movies.work(path, threads=2)
+            self.assertEqual(processed, 7)
+            mock_fetch_page_movies.assert_called_once_with('US', 2001, 2, [7], True, 'credits', keep_saved=True)
+            self.assertEqual(queue.counts(), {'done': 6})
+            self.assertEqual(queue.missing('US'), {2000: [], 2001: []})
+            self.assertEqual(queue.pages('US', 2001), {1: 'done', 2: 'done'})
+
+    def test_stage_pipeline(self):
+        loaded = []
+        release = threading.Event()
+        def merge(year):
+            release.wait(5)
+            if year == 2002:
+                raise ValueError('bad year')
+            return year * 10
+        load = movies.Stage('load', loaded.append, workers=2)
+        merge_stage = movies.Stage('merge', merge, maxsize=1, downstream=load)
+        merge_stage.put(2000)
+        merge_stage.put(2001)
+        # the merge stage is busy and its queue is full, the producer is held back
+        producer = threading.Thread(target=merge_stage.put, args=(2002,))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join(5)
+        merge_stage.close()
+        self.assertEqual(sorted(loaded), [20000, 20010])
+        self.assertEqual(merge_stage.stats()['processed'], 2)
+        self.assertEqual(merge_stage.errors[0][0], 2002)
+        self.assertGreater(merge_stage.stats()['blocked'], 0.1)
+
+    def test_metrics(self):
+        metrics = movies.Metrics()
+        for seconds in [0.02, 0.03, 0.2, 4.0]:
+            metrics.observe('stage_seconds', seconds, stage='mysql', table='movies')
+        with metrics.timer('write'):
+            pass
+        metrics.inc('rows', 500, table='movies', stage='mysql')
+        metrics.inc('requests', status='200')
+        metrics.inc('requests', status='200')
+        with tempfile.TemporaryDirectory() as tmp:
+            report = metrics.write_report(os.path.join(tmp, 'report.json'), {'client': {'reused': 3}})
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'report.json')))
+        mysql = [stage for stage in report['stages'] if stage['stage'] == 'mysql'][0]
+        self.assertEqual((mysql['table'], mysql['count'], mysql['p50'], mysql['max']), ('movies', 4, 0.05, 4.0))
+        self.assertIn({'name': 'requests', 'status': '200', 'value': 2}, report['counters'])
+        self.assertEqual(report['rows_per_second'], {'mysql/movies': round(500 / 4.25, 1)})
+        self.assertEqual(report['client'], {'reused': 3})
+        text = metrics.prometheus()
+        self.assertIn('tmdb_stage_seconds_bucket{stage="mysql",table="movies",le="0.05"} 2', text)
+        self.assertIn('tmdb_stage_seconds_count{stage="write"} 1', text)
+        self.assertIn('tmdb_requests_total{status="200"} 2', text)
+
+    def test_get_data_mock_tmdb(self):
+        catalog = Catalog(years=[1999], pages=2, per_page=5, cast_max=50)
+        # throttled requests are retried after their Retry-After and the page is still complete
+        with MockTMDB(catalog, throttle_rate=0.3, retry_after=0.01) as server, server.patch_tmdb(movies.adapter):
+            year, pages, response = movies.discover_year('US', 1999)
+            result = movies.get_page_data('US', 1999, 1, response, output=False)
+        self.assertEqual(pages, [1, 2])
+        self.assertIsNone(result[2])
+        self.assertEqual(sorted(result[3]['ID']), catalog.discover[(1999, 1)])
+        movie_id = catalog.discover[(1999, 1)][0]
+        row = result[3].set_index('ID').loc[movie_id]
+        self.assertEqual(len(row['CAST']), len(catalog.credits[movie_id]['cast']))
+        self.assertGreater(server.counts[429], 0)
+
+    @patch('movies.retry.time.sleep')
+    def test_single_retry_layer(self, mock_sleep):
+        catalog = Catalog(years=[1999], pages=1, per_page=1)
+        # a movie TMDB keeps failing is requested MAX_ATTEMPTS times in all, the adapter doesn't retry on its own
+        with MockTMDB(catalog, error_rate=1.0) as server, server.patch_tmdb(movies.adapter):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                with_retries(movies.fetch_movie, catalog.discover[(1999, 1)][0])
+        self.assertEqual(server.counts, {503: movies.MAX_ATTEMPTS})
+
+    @patch('movies.async_engine.backoff', return_value=0)
+    @patch.object(movies.TokenBucket, 'take', autospec=True)
+    def test_run_async_rate_limits_requests(self, mock_take, mock_backoff):
+        catalog = Catalog(years=[1999], pages=2, per_page=5, cast_max=5)
+        # without credits appended every movie takes two requests, retries of throttled ones included
+        with MockTMDB(catalog, throttle_rate=0.3, retry_after=0.01) as server, server.patch_tmdb(movies.adapter):
+            dfs, missing, failed_ids = movies.run_async('US', 1999, 1999, output=False, append='')
+        self.assertEqual(missing, {1999: []})
+        self.assertEqual(len(dfs[1999]), 10)
+        self.assertGreater(server.counts[429], 0)
+        # every request sent took a token, and the adapter stops taking them once the run is over
+        self.assertEqual(mock_take.call_count, sum(server.counts.values()))
+        self.assertIsNone(movies.adapter.bucket)
+
+    def test_import_budget(self):
+        code = ("import sys, time; tm1 = time.perf_counter(); import movies, storage, sinks, main; "
+                f"print(time.perf_counter() - tm1); print(*[m for m in {HEAVY_MODULES} if m in sys.modules])")
+        env = {name: value for name, value in os.environ.items() if name != 'TMDB_CONFIG'}
+        env['PYTHONPATH'] = root_dir
+        with tempfile.TemporaryDirectory() as tmp:
+            # imported from outside the repository, where there is no config.json to read
+            result = subprocess.run([sys.executable, '-c', code], cwd=tmp, env=env, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        elapsed, loaded = result.stdout.split('\n')[:2]
+        self.assertEqual(loaded, '')
+        self.assertLess(float(elapsed), IMPORT_BUDGET)
+
+    def test_config_read_on_first_use(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config.json')
+            with open(path, 'w') as file:
+                file.write('{"tmdb_api_key": "key", "output_format": "csv"}')
+            movies.reset_config()
+            try:
+                with patch.dict(os.environ, {'TMDB_CONFIG': path}):
+                    self.assertEqual(movies.output_format(), 'csv')
+                    self.assertEqual(movies.OUTPUT_FORMAT, 'csv')
+                with patch.dict(os.environ, {'TMDB_CONFIG': os.path.join(tmp, 'missing.json')}):
+                    # already read, the file is not opened again
+                    self.assertEqual(movies.get_config()['tmdb_api_key'], 'key')
+                    movies.reset_config()
+                    with self.assertRaises(FileNotFoundError):
+                        movies.get_config()
+            finally:
+                movies.reset_config()
+
     @patch('pandas.DataFrame.to_csv')
     def test_merge_dfs(self, mock_to_csv):
         region = 'US'
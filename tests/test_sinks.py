@@ -0,0 +1,95 @@
+import asyncio
+from datetime import date
+import os
+import pandas as pd
+from pathlib import Path
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+root_dir = str(Path(__file__).resolve().parent.parent)
+sys.path.append(root_dir)
+
+import movies
+import sinks
+
+
+class TestSinks(unittest.TestCase):
+
+    def tables(self, title: str='The Matrix') -> dict:
+        return {
+            'movies': pd.DataFrame({'id': [603, 604], 'title': [title, 'The Matrix Reloaded'], 'budget': [63000000, None]}),
+            'movie_genres': pd.DataFrame({'movie_id': [603, 603, 604], 'genre_id': [28, 878, 28]}),
+        }
+
+    def test_local_sink(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sink = sinks.LocalSink(root=tmp, output_format='csv')
+            sink.write('US', 1999, pd.DataFrame({'ID': [603]}), self.tables())
+            year_dir = Path(tmp) / 'US' / '1999'
+            self.assertEqual(sorted(path.name for path in year_dir.iterdir()), ['merged.csv', 'movie_genres.csv', 'movies.csv'])
+            self.assertEqual(pd.read_csv(year_dir / 'movies.csv')['id'].tolist(), [603, 604])
+
+    def test_sqlite_sink_upserts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sink = sinks.SQLiteSink(path=f"{tmp}/movies.sqlite")
+            sink.write('US', 1999, None, self.tables())
+            # Writing the year again replaces its rows instead of duplicating them
+            sink.write('US', 1999, None, self.tables(title='Matrix'))
+            sink.close()
+            conn = sqlite3.connect(f"{tmp}/movies.sqlite")
+            self.assertEqual(conn.execute('SELECT id, title, budget FROM movies ORDER BY id').fetchall(),
+                             [(603, 'Matrix', 63000000.0), (604, 'The Matrix Reloaded', None)])
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM movie_genres').fetchone()[0], 3)
+            conn.close()
+
+    def test_data_dir(self):
+        with tempfile.TemporaryDirectory() as tmp, patch.dict(movies.get_config(), {'data_dir': tmp}):
+            movies.save_output('US', 1999, pd.DataFrame({'ID': [603]}), 'US_movie_data_1999-1')
+            self.assertEqual(movies.page_files('US', 1999), [Path(tmp) / 'US_movie_data_1999' / f"US_movie_data_1999-1.{movies.output_format()}"])
+            self.assertEqual(sinks.LocalSink().root, Path(tmp) / 'sink')
+            # run state follows the data root too
+            movies.RunManifest()
+            movies.WorkQueue()
+            movies.write_watermark('US', date(2023, 1, 20))
+            movies.METRICS.write_report()
+            for name in ('run_manifest.sqlite', movies.QUEUE_FILE, 'incremental_watermark.json', movies.REPORT_FILE):
+                self.assertTrue((Path(tmp) / name).exists(), name)
+            self.assertEqual(movies.read_watermark('US'), date(2023, 1, 20))
+        # the default and relative directories don't move with the working directory
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(root_dir)
+            try:
+                self.assertEqual(movies.data_dir(), Path(tmp) / 'data')
+                with patch.dict(movies.get_config(), {'data_dir': 'outputs'}):
+                    self.assertEqual(movies.data_dir(), Path(tmp) / 'outputs')
+            finally:
+                os.chdir(cwd)
+        # a sink has to implement write
+        with self.assertRaises(TypeError):
+            sinks.Sink()
+
+    def test_make_sinks(self):
+        with patch.dict(movies.get_config(), {'sinks': {'sqlite': {'path': './data/other.sqlite'}}}):
+            local, sqlite = sinks.make_sinks('local, sqlite')
+        self.assertIsInstance(local, sinks.LocalSink)
+        self.assertEqual(sqlite.path, './data/other.sqlite')
+        with self.assertRaises(ValueError):
+            sinks.make_sinks('local,ftp')
+
+    @patch('storage.to_mysql')
+    def test_write_all(self, mock_to_mysql):
+        df = pd.DataFrame({'ID': [603]})
+        tables = self.tables()
+        local = MagicMock(spec=sinks.LocalSink)
+        local.awrite = lambda *args: sinks.Sink.awrite(local, *args)
+        asyncio.run(sinks.write_all([local, sinks.MySQLSink(chunk_size=10)], 'US', 1999, df, tables))
+        local.write.assert_called_once_with('US', 1999, df, tables)
+        mock_to_mysql.assert_called_once_with(df=df, year=1999, chunk_size=10, tables=tables)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+from ast import literal_eval
+import gzip
+import os
+import pandas as pd
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+root_dir = str(Path(__file__).resolve().parent.parent)
+sys.path.append(root_dir)
+
+import movies
+import storage
+
+
+class FakeCursor:
+    """
+    Records every statement sent to MySQL, a round trip per execute() or executemany() call
+    """
+    def __init__(self):
+        self.round_trips = 0
+        self.rows = {}
+
+    def execute(self, sql, args):
+        self.round_trips += 1
+        self.rows.setdefault(sql, []).append(args)
+
+    def executemany(self, sql, args):
+        self.round_trips += 1
+        for row in args:
+            self.rows.setdefault(sql, []).append(row)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        storage.settings.entity_cache.clear()
+
+    def movies_df(self):
+        return pd.DataFrame({
+            'ID': [603, 604],
+            'TITLE': ['The Matrix', 'The Matrix Reloaded'],
+            'ORIGINAL_TITLE': ['The Matrix', 'The Matrix Reloaded'],
+            'RELEASE_DATE': ['1999-03-30', '2003-05-15'],
+            'ORIGINAL_LANGUAGE': ['en', 'en'],
+            'PLOT': ['plot', 'plot'],
+            'DIRECTORS': ["[{'id': 9339, 'name': 'Lilly Wachowski'}, {'id': 9340, 'name': 'Lana Wachowski'}]",
+                          "[{'id': 9339, 'name': 'Lilly Wachowski'}, {'id': 9340, 'name': 'Lana Wachowski'}]"],
+            'CAST': ["[{'id': 6384, 'name': 'Keanu Reeves'}, {'id': 2975, 'name': 'Laurence Fishburne'}]",
+                     "[{'id': 6384, 'name': 'Keanu Reeves'}, {'id': 530, 'name': 'Carrie-Anne Moss'}]"],
+            'CREW': ["[]", "[]"],
+            'GENRES': ["[{'id': 28, 'name': 'Action'}, {'id': 878, 'name': 'Science Fiction'}]",
+                       "[{'id': 28, 'name': 'Action'}]"],
+            'PRODUCTION_COUNTRIES': ["[{'iso_3166_1': 'US', 'name': 'United States of America'}]",
+                                     "[{'iso_3166_1': 'US', 'name': 'United States of America'}]"],
+            'PRODUCTION_COMPANIES': ["[{'id': 79, 'name': 'Village Roadshow Pictures', 'origin_country': 'US'}]",
+                                     "[{'id': 79, 'name': 'Village Roadshow Pictures', 'origin_country': 'US'}, {'id': 1, 'name': 'Silver', 'origin_country': 'no info'}]"],
+            'BUDGET': [63000000, 150000000],
+            'REVENUE': [463517383, 741847937],
+        })
+
+    def test_collect_rows(self):
+        tables = storage.collect_rows(self.movies_df())
+        self.assertEqual(sorted(tables['actors']), [(530, 'Carrie-Anne Moss'), (2975, 'Laurence Fishburne'), (6384, 'Keanu Reeves')])
+        self.assertEqual(len(tables['movie_actors']), 4)
+        self.assertEqual(tables['genres'], [(28, 'Action'), (878, 'Science Fiction')])
+        self.assertEqual(tables['companies'], [(79, 'Village Roadshow Pictures', 'US')])
+        self.assertEqual(tables['companies_no_country'], [(1, 'Silver')])
+        self.assertEqual(tables['movie_revenue'], [(603, 463517383, 63000000), (604, 741847937, 150000000)])
+
+    @patch('storage.pymysql.connect')
+    def test_to_mysql_batch_matches_row_by_row(self, mock_connect):
+        row_cursor = FakeCursor()
+        mock_connect.return_value.cursor.return_value = row_cursor
+        storage.to_mysql(self.movies_df(), 1999, batch=False)
+
+        batch_cursor = FakeCursor()
+        mock_connect.return_value.cursor.return_value = batch_cursor
+        storage.to_mysql(self.movies_df(), 1999, batch=True, chunk_size=2)
+
+        # Same rows reach every table, deduplicated, in far fewer round trips
+        self.assertEqual({sql: set(rows) for sql, rows in row_cursor.rows.items()},
+                         {sql: set(rows) for sql, rows in batch_cursor.rows.items()})
+        self.assertEqual(sum(len(rows) for rows in batch_cursor.rows.values()), 27)
+        self.assertEqual(row_cursor.round_trips, 33)
+        self.assertEqual(batch_cursor.round_trips, 16)
+        mock_connect.return_value.commit.assert_called()
+
+    def test_table_rows_match_collect_rows(self):
+        df = self.movies_df()
+        typed = df.copy()
+        for column in movies.NESTED_COLUMNS:
+            typed[column] = typed[column].apply(literal_eval)
+        # rows from the normalized tables are the same rows collected from the wide frame
+        expected = storage.collect_rows(df)
+        result = storage.table_rows(movies.normalize(typed))
+        self.assertEqual(set(expected), set(result))
+        for table in expected:
+            self.assertEqual(set(expected[table]), set(result[table]), table)
+
+    @patch('storage.pymysql.connect')
+    def test_entity_cache(self, mock_connect):
+        first = FakeCursor()
+        mock_connect.return_value.cursor.return_value = first
+        storage.to_mysql(self.movies_df(), 1999)
+
+        second = FakeCursor()
+        mock_connect.return_value.cursor.return_value = second
+        df = self.movies_df()
+        df.loc[1, 'CAST'] = "[{'id': 6384, 'name': 'Keanu Reeves'}, {'id': 530, 'name': 'Carrie-Anne Moss (renamed)'}]"
+        storage.to_mysql(df, 2003)
+        # only the renamed actor is upserted again, every other entity was written by the first load
+        self.assertEqual(second.rows[storage.UPSERTS['actors']], [(530, 'Carrie-Anne Moss (renamed)')])
+        for table in ['genres', 'directors', 'countries', 'companies', 'companies_no_country']:
+            self.assertNotIn(storage.UPSERTS[table], second.rows, table)
+        self.assertEqual(len(second.rows[storage.UPSERTS['movie_actors']]), 4)
+
+    def test_entity_cache_rollback_and_eviction(self):
+        cache = storage.EntityCache(max_entries=2)
+        rows = {'actors': [(1, 'a'), (2, 'b'), (3, 'c')], 'movies': [(1,)]}
+        # nothing is remembered until a load commits
+        self.assertEqual(cache.filter(rows), rows)
+        cache.remember(rows)
+        self.assertEqual(cache.filter(rows)['actors'], [(1, 'a')])
+        self.assertEqual(cache.filter(rows)['movies'], [(1,)])
+
+    @patch('storage.to_mysql', return_value=True)
+    def test_load_merged_csv(self, mock_to_mysql):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                year_dir = Path('./data/US_movie_data_1999')
+                year_dir.mkdir(parents=True)
+                # a legacy csv output, with FINANCIAL dicts instead of BUDGET and REVENUE
+                df = self.movies_df()
+                df['FINANCIAL'] = [str({'budget': b, 'revenue': r}) for b, r in zip(df.pop('BUDGET'), df.pop('REVENUE'))]
+                df.to_csv(year_dir / 'US_movie_data_1999-merged.csv', index=False)
+                storage.load_merged('US', 1999)
+                loaded = mock_to_mysql.call_args.kwargs['df']
+                self.assertEqual(list(loaded['REVENUE']), [463517383, 741847937])
+                self.assertEqual(loaded['CAST'][0][0], {'id': 6384, 'name': 'Keanu Reeves'})
+                self.assertIsNone(mock_to_mysql.call_args.kwargs['tables'])
+                self.assertEqual(set(storage.collect_rows(loaded)['movie_revenue']),
+                                 {(603, 463517383, 63000000), (604, 741847937, 150000000)})
+
+                # normalized tables saved as csv are used too
+                for name, table in movies.normalize(loaded).items():
+                    table.to_csv(year_dir / f'US_movie_data_1999-merged-{name}.csv', index=False)
+                storage.load_merged('US', 1999)
+                self.assertEqual(sorted(mock_to_mysql.call_args.kwargs['tables']['genres']['id']), [28, 878])
+            finally:
+                os.chdir(cwd)
+
+    def test_bulk_upload(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, patch('movies.config.START_DIR', tmp):
+            os.chdir(tmp)
+            try:
+                for year in [1999, 2000]:
+                    Path(f'./data/US_movie_data_{year}').mkdir(parents=True)
+                    self.movies_df().to_csv(f'./data/US_movie_data_{year}/US_movie_data_{year}-merged.csv', index=False)
+                with patch.object(storage.settings, 'conn_str', f'file://{tmp}/blobs'):
+                    self.assertEqual(storage.bulk_upload('US', 1999, 2001, workers=3),
+                                     {'uploaded': [1999, 2000], 'skipped': [], 'failed': [2001]})
+                    # unchanged files are not uploaded again
+                    self.assertEqual(storage.bulk_upload('US', 1999, 2000)['skipped'], [1999, 2000])
+                    Path('./data/US_movie_data_2000/US_movie_data_2000-merged.csv').write_text('ID\n603\n')
+                    self.assertEqual(storage.bulk_upload('US', 1999, 2000)['uploaded'], [2000])
+
+                    self.assertEqual(storage.blob_upload('US', 1999, compress=True), 'uploaded')
+                    self.assertEqual(storage.blob_upload('US', 1999, compress=True), 'skipped')
+                blob_dir = Path(tmp) / 'blobs' / storage.settings.container / storage.settings.movie_dir / 'US_movie_data'
+                self.assertEqual(gzip.decompress((blob_dir / 'US_movie_data_1999-merged.csv.gz').read_bytes()),
+                                 Path('./data/US_movie_data_1999/US_movie_data_1999-merged.csv').read_bytes())
+            finally:
+                os.chdir(cwd)
+
+    def test_tsv_value(self):
+        self.assertEqual(storage.tsv_value("It's\ta\\b\nc"), "It's\\ta\\\\b\\nc")
+        self.assertEqual(storage.tsv_value(None), '\\N')
+        self.assertEqual(storage.tsv_value(603), '603')
+
+    def test_parse_upsert(self):
+        self.assertEqual(storage.parse_upsert('companies'),
+                         ('companies', ['id', 'name', 'country'], 'name=VALUES(name), country=VALUES(country)'))
+
+    @patch('storage.pymysql.connect')
+    def test_to_mysql_infile(self, mock_connect):
+        cursor = FakeCursor()
+        staged = {}
+        def execute(sql, args=None):
+            FakeCursor.execute(cursor, sql, args)
+            # read each staged file while the temporary directory still exists
+            if sql.startswith('LOAD DATA'):
+                staged[sql.split('`')[1]] = Path(args[0]).read_text(encoding='utf-8')
+        cursor.execute = execute
+        mock_connect.return_value.cursor.return_value = cursor
+        storage.to_mysql_infile(self.movies_df(), 1999)
+
+        self.assertTrue(mock_connect.call_args.kwargs['local_infile'])
+        self.assertEqual(staged['stage_genres'], '28\tAction\n878\tScience Fiction\n')
+        merges = [sql for sql in cursor.rows if sql.startswith('INSERT INTO `actors`')]
+        self.assertEqual(len(merges), 1)
+        self.assertIn('SELECT `id`, `name` FROM `stage_actors`', merges[0])
+        # nothing that implicitly commits runs inside the transaction
+        self.assertFalse([sql for sql in cursor.rows if sql.startswith('TRUNCATE')])
+        mock_connect.return_value.commit.assert_called_once()
+        mock_connect.return_value.rollback.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()